@@ -4,6 +4,16 @@ from langchain.prompts import PromptTemplate
 from pydantic import BaseModel
 from langchain_openai import ChatOpenAI  # Changed to use OpenAI interface
 from typing import Optional, Dict, Any
+import time
+from conversation_memory import HybridSummaryMemory
+from context_builder import count_tokens
+from map_reduce import map_reduce_document
+from llm_scheduler import get_scheduler
+from tracing import get_tracer, span, llm_callbacks
+from http_transport import get_http_client, get_async_http_client, get_openai_client
+
+# 可以在每次调用时覆盖的采样参数，修改它们不需要重建LLM客户端和对话链
+SAMPLING_PARAMS = ("temperature", "max_tokens", "top_p", "presence_penalty", "frequency_penalty")
 
 class MyModel(BaseModel):
     class Config:
@@ -21,7 +31,7 @@ class LangChainChatBot:
          api_key: Deepseek API密钥
          model_name: Deepseek模型名称
          model_configs: 模型配置参数
-         memory_type: 记忆类型 ("buffer" 或 "summary")
+         memory_type: 记忆类型 ("hybrid"、"buffer" 或 "summary")
          base_url: DeepSeek API的基础URL
         """
         # 初始化基本属性
@@ -29,6 +39,9 @@ class LangChainChatBot:
         self.model_name = model_name
         self.model_configs = model_configs or {}
         self.base_url = base_url
+        # 所有LLM调用都经过进程内共享的调度器
+        self.scheduler = get_scheduler()
+        self.tracer = get_tracer()
         
         # 初始化各组件
         self._initialize_llm()
@@ -48,15 +61,22 @@ class LangChainChatBot:
             # repetition_penalty is not directly supported in the OpenAI interface
             # but can be mapped to presence_penalty or frequency_penalty
             "presence_penalty": 0.1,  # Similar to repetition_penalty
+            # 重试由LLM调度器统一处理，避免客户端内部重试叠加
+            "max_retries": 0,
             **self.model_configs.get("llm_kwargs", {})
         }
         
+        # 所有机器人共享同一个保活连接池，不必每次对话重新建立TCP/TLS连接
         self.llm = ChatOpenAI(
             api_key=self.api_key,
             model_name=self.model_name,
             base_url=self.base_url,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
             **llm_kwargs
         )
+        # 创建后修改的采样参数，每次调用时传入
+        self.llm_overrides = {}
     
     def _initialize_prompt(self):
         """初始化提示词模板"""
@@ -88,7 +108,14 @@ class LangChainChatBot:
         初始化对话记忆
         :param memory_type: 记忆类型
         """
-        if memory_type == "summary":
+        if memory_type == "hybrid":
+            # 最近几轮原样保留，更早的对话在后台合并为摘要，不增加请求延迟
+            self.memory = HybridSummaryMemory(
+                llm=self.llm,
+                max_turns=self.model_configs.get("memory_max_turns", 6),
+                max_token_limit=self.model_configs.get("memory_max_tokens", 1500)
+            )
+        elif memory_type == "summary":
             self.memory = ConversationSummaryMemory(
                 llm=self.llm,
                 return_messages=True
@@ -104,17 +131,32 @@ class LangChainChatBot:
             llm=self.llm,
             memory=self.memory,
             prompt=self.prompt,
+            llm_kwargs=dict(self.llm_overrides),
             verbose=False
         )
     
     def update_model_config(self, config_updates: Dict[str, Any]):
         """
-        更新模型配置
+        更新模型配置。llm_kwargs 与已有的参数合并：只包含采样参数时作为每次调用的参数覆盖生效，
+        其余参数（如超时）才需要重建LLM客户端，重建后仍使用共享连接池
         :param config_updates: 要更新的配置参数
         """
-        self.model_configs.update(config_updates)
-        self._initialize_llm()  # Changed from _initialize_model
-        self._initialize_conversation_chain()
+        llm_kwargs = config_updates.get("llm_kwargs")
+        self.model_configs.update({key: value for key, value in config_updates.items() if key != "llm_kwargs"})
+        if llm_kwargs is None:
+            return
+        self.model_configs["llm_kwargs"] = {**self.model_configs.get("llm_kwargs", {}), **llm_kwargs}
+        if all(key in SAMPLING_PARAMS for key in llm_kwargs):
+            self.llm_overrides.update(llm_kwargs)
+            self.conversation.llm_kwargs = dict(self.llm_overrides)
+        else:
+            # 之前的采样参数覆盖已合并在 model_configs 中，随重建的LLM客户端一起生效
+            self._initialize_llm()
+            self.conversation.llm = self.llm
+            self.conversation.llm_kwargs = {}
+            # 生成对话摘要的记忆也使用新的客户端
+            if getattr(self.memory, "llm", None) is not None:
+                self.memory.llm = self.llm
     
     def update_pipeline_config(self, 
                              temperature: Optional[float] = None,
@@ -140,16 +182,17 @@ class LangChainChatBot:
             llm_kwargs["presence_penalty"] = presence_penalty
             
         self.model_configs["llm_kwargs"] = llm_kwargs
-        self._initialize_llm()
-        self._initialize_conversation_chain()
+        # 作为每次调用的参数覆盖，不重建LLM客户端和对话链
+        self.llm_overrides.update({key: value for key, value in llm_kwargs.items() if key in SAMPLING_PARAMS})
+        self.conversation.llm_kwargs = dict(self.llm_overrides)
     
     def set_memory_type(self, memory_type: str):
         """
         设置记忆类型
-        :param memory_type: "buffer" 或 "summary"
+        :param memory_type: "hybrid"、"buffer" 或 "summary"
         """
         self._initialize_memory(memory_type)
-        self._initialize_conversation_chain()
+        self.conversation.memory = self.memory
     
     def customize_prompt(self, new_template: str):
         """
@@ -160,7 +203,7 @@ class LangChainChatBot:
             input_variables=["history", "input"],
             template=new_template
         )
-        self._initialize_conversation_chain()
+        self.conversation.prompt = self.prompt
     
     def generate_response(self, user_input: str) -> str:
         """
@@ -169,17 +212,93 @@ class LangChainChatBot:
         :return: AI的回复
         """
         try:
-            response = self.conversation.predict(input=user_input)
-            return response.strip()
+            with self.tracer.turn("chat"):
+                response = self.scheduler.run(
+                    lambda: self.conversation.predict(input=user_input, callbacks=llm_callbacks())
+                )
+                return response.strip()
         except Exception as e:
             return f"发生错误: {str(e)}"
-        
-    def process_file(self, file_path: str) -> str:
     
+    async def agenerate_response(self, user_input: str) -> str:
+        """
+        异步生成回复，可在同一个事件循环上并发处理大量对话
+        :param user_input: 用户输入的文本
+        :return: AI的回复
+        """
+        try:
+            with self.tracer.turn("chat", mode="async"):
+                response = await self.scheduler.arun(
+                    lambda: self.conversation.apredict(input=user_input, callbacks=llm_callbacks())
+                )
+                return response.strip()
+        except Exception as e:
+            return f"发生错误: {str(e)}"
+    
+    def stream_response(self, user_input: str):
+        """
+        流式生成回复，逐个产出模型生成的文本片段
+        
+        生成结束后写入对话记忆；首个片段延迟和总耗时记录在 self.last_stream_stats 中
+        :param user_input: 用户输入的文本
+        :return: 文本片段生成器
+        """
+        start = time.perf_counter()
+        time_to_first_token = None
+        parts = []
+        try:
+            with self.tracer.turn("chat", mode="stream"):
+                # 与ConversationChain使用相同的模板和记忆构建提示词
+                with span("prompt_build"):
+                    history = self.memory.load_memory_variables({})[self.memory.memory_key]
+                    prompt = self.prompt.format(history=history, input=user_input)
+                
+                for chunk in self.scheduler.stream(
+                    lambda: self.llm.stream(prompt, config={"callbacks": llm_callbacks()}, **self.llm_overrides)
+                ):
+                    token = chunk.content
+                    if not token:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start
+                    parts.append(token)
+                    yield token
+                
+                self.last_stream_stats = {
+                    "time_to_first_token": time_to_first_token,
+                    "total_latency": time.perf_counter() - start
+                }
+                with span("memory_update"):
+                    self.memory.save_context({"input": user_input}, {"response": "".join(parts).strip()})
+        except Exception as e:
+            yield f"发生错误: {str(e)}"
+        
+    def process_file(self, file_path: str,
+                     map_reduce: Optional[bool] = None,
+                     chunk_tokens: int = 3000,
+                     max_concurrency: int = 4) -> str:
+        """
+        处理文件内容
+        :param file_path: 文件路径
+        :param map_reduce: 是否分块并行处理；为None时文件超过 chunk_tokens 自动启用
+        :param chunk_tokens: 分块处理时每块的token上限
+        :param max_concurrency: 分块处理时同时进行的LLM调用数上限
+        :return: AI的回复
+        """
         try:
             with open(file_path, 'r', encoding='utf-8') as file:
                 file_content = file.read()
             
+            if map_reduce is None:
+                map_reduce = count_tokens(file_content) > chunk_tokens
+            if map_reduce:
+                # 长文档分块并行提取，再合并为关键词/摘要/大纲格式
+                llm = self.llm.bind(**self.llm_overrides) if self.llm_overrides else self.llm
+                response = map_reduce_document(llm, file_content, chunk_tokens, max_concurrency,
+                                               scheduler=self.scheduler)
+                self.memory.save_context({"input": f"请处理以下文件：{file_path}"}, {"response": response})
+                return response
+            
             # 构建提示词，将文件内容作为用户输入
             user_input = f"请处理以下文本内容：\n\n{file_content}"
         
@@ -209,9 +328,8 @@ def direct_deepseek_call(api_key: str, user_input: str,
     :param system_prompt: 系统提示
     :return: 模型的响应
     """
-    from openai import OpenAI
-    
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    # 按API密钥缓存客户端，复用共享连接池
+    client = get_openai_client(api_key, base_url)
     
     response = client.chat.completions.create(
         model=model_name,
@@ -219,11 +337,37 @@ def direct_deepseek_call(api_key: str, user_input: str,
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_input},
         ],
-        stream=True
+        stream=False
     )
     
     return response.choices[0].message.content
 
+def direct_deepseek_stream(api_key: str, user_input: str, 
+                           model_name: str = "deepseek-chat", 
+                           base_url: str = "https://api.deepseek.com",
+                           system_prompt: str = "You are a helpful assistant"):
+    """
+    直接使用OpenAI客户端接口流式调用DeepSeek API，逐个产出生成的文本片段
+    
+    参数同 direct_deepseek_call
+    :return: 文本片段生成器
+    """
+    # 按API密钥缓存客户端，复用共享连接池
+    client = get_openai_client(api_key, base_url)
+    
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input},
+        ],
+        stream=True
+    )
+    
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 def main():
     """使用示例"""
     import os
@@ -278,7 +422,7 @@ def main():
     bot.set_memory_type("summary")
     
     # 修改现有的启动提示
-    print("聊天机器人已启动！输入 'quit' 退出，输入 'clear' 清除对话历史，输入 'direct' 使用直接调用，输入 'upload' 上传txt文件。")
+    print("聊天机器人已启动！输入 'quit' 退出，输入 'clear' 清除对话历史，输入 'direct' 使用直接调用，输入 'upload' 上传txt文件，输入 'stream' 流式回答下一个问题。")
     
     while True:
         user_input = input("\n你: ")
@@ -304,6 +448,17 @@ def main():
             else:
                 print("文件路径无效或不是txt文件！")
             continue   
+        elif user_input.lower() == 'stream':
+            stream_input = input("流式回答 - 输入问题: ")
+            print("\nAI: ", end="", flush=True)
+            for token in bot.stream_response(stream_input):
+                print(token, end="", flush=True)
+            stats = getattr(bot, "last_stream_stats", None)
+            if stats and stats["time_to_first_token"] is not None:
+                print(f"\n[首字延迟: {stats['time_to_first_token']:.2f}s, 总耗时: {stats['total_latency']:.2f}s]")
+            else:
+                print()
+            continue
             
         response = bot.generate_response(user_input)
         print(f"\nAI: {response}")
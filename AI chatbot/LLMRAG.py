@@ -1,22 +1,110 @@
-from langchain.chains import ConversationChain
 from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
 from langchain.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 from typing import Optional, Dict, Any
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.chains import RetrievalQA
 import os
+import glob
+import time
+import threading
+import uuid
+import codecs
 import datetime
 import argparse
-import requests
 import json
 import logging
-from langchain.prompts import ChatPromptTemplate
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, DirectoryLoader
-from langchain_community.vectorstores import FAISS
-from transformers import AutoModel, AutoTokenizer
-import torch
+from langchain.docstore.document import Document
+from lexical_index import LexicalIndex
+from text_splitter import SentenceTokenSplitter
+from snapshots import IndexSnapshot, SnapshotStore, SnapshotWatcher
+from db_delivery import DatabaseDeliveryQueue
+from async_support import run_blocking, get_async_client
+from context_builder import ContextBuilder, count_tokens
+from conversation_memory import HybridSummaryMemory
+from map_reduce import map_reduce_document
+from llm_scheduler import get_scheduler
+from tracing import get_tracer, span, current_trace, llm_callbacks
+from http_transport import get_http_client, get_async_http_client, get_openai_client
+from ocr_pages import IMAGE_EXTENSIONS
+
+# torch、transformers、FAISS、嵌入模型、文档加载器、检索链等重量级依赖在首次使用时才导入，
+# 不使用RAG的普通对话不需要为它们付出导入时间和内存
+
+# 可以在每次调用时覆盖的采样参数，修改它们不需要重建LLM客户端
+SAMPLING_PARAMS = ("temperature", "max_tokens", "top_p", "presence_penalty", "frequency_penalty")
+
+# 定义可能的编码列表，按优先级排序
+TEXT_ENCODINGS = ["utf-8", "gb18030", "utf-16", "big5", "latin-1"]
+# 编码检测时使用的采样字节数
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+def _line_slice(raw: bytes, start: int, end: int) -> bytes:
+    """取 raw[start:end]，两端对齐到换行符之后，不在多字节字符中间截断"""
+    if start > 0:
+        newline = raw.find(b"\n", start, end)
+        start = newline + 1 if newline != -1 else start
+    if end < len(raw):
+        newline = raw.rfind(b"\n", start, end)
+        end = newline + 1 if newline != -1 else end
+    return raw[start:end]
+
+def detect_encoding(raw: bytes, sample_size: int = ENCODING_SAMPLE_SIZE) -> str:
+    """
+    根据字节内容检测文本编码
+    
+    优先识别BOM；能按UTF-8严格解码全部字节时直接使用UTF-8（最常见的情况，也避免统计检测误判）；
+    否则若安装了 charset_normalizer 或 chardet，则对采样字节做统计检测；
+    否则按 TEXT_ENCODINGS 顺序对采样字节做增量解码试探。
+    
+    :param raw: 文件的全部字节
+    :param sample_size: 用于检测的采样字节数
+    :return: 编码名称
+    """
+    if raw.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if raw.startswith(codecs.BOM_UTF16_LE) or raw.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16"
+    
+    try:
+        raw.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    
+    # 从文件头、中、尾各取一段作为统计样本，避免只看开头；各段在换行处切分
+    if len(raw) <= sample_size:
+        sample = raw
+    else:
+        part = sample_size // 3
+        middle = len(raw) // 2
+        sample = b"".join([
+            _line_slice(raw, 0, part),
+            _line_slice(raw, middle, middle + part),
+            _line_slice(raw, len(raw) - part, len(raw)),
+        ])
+    
+    try:
+        from charset_normalizer import from_bytes
+        best = from_bytes(sample).best()
+        if best is not None:
+            return best.encoding
+    except ImportError:
+        try:
+            import chardet
+            guess = chardet.detect(sample)
+            if guess.get("encoding") and guess.get("confidence", 0) >= 0.5:
+                return guess["encoding"].lower()
+        except ImportError:
+            pass
+    
+    # 没有统计检测库时，对文件头部样本做增量解码，容忍末尾被截断的多字节字符
+    head = raw[:sample_size]
+    for encoding in TEXT_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head, final=len(head) == len(raw))
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
 
 class LangChainChatBot:
     def __init__(self, 
@@ -35,6 +123,11 @@ class LangChainChatBot:
         self.model_name = model_name
         self.model_configs = model_configs or {}
         self.base_url = base_url
+        # 所有LLM调用都经过进程内共享的调度器，多会话服务中每个会话有自己的ID
+        self.scheduler = get_scheduler()
+        self.session_id = None
+        # 每轮对话的阶段耗时、token用量和缓存命中记录到进程内共享的追踪器
+        self.tracer = get_tracer()
         
         # 初始化各组件
         self._initialize_llm()
@@ -45,20 +138,50 @@ class LangChainChatBot:
         # RAG相关属性
         self.embedding_model = None
         self.tokenizer = None
-        self.vector_store = None
-        self.retriever = None
-        self.qa_chain = None
+        # 默认向量库的当前快照：向量存储、倒排索引、来源/上传时间/文档类型/命名空间的位图索引、
+        # 检索器和版本号，向量库变化时整体替换
+        self.index_snapshot = None
+        self.retrieval_filters = None
+        # 切换到命名空间后使用的检索器
+        self.namespace_retriever = None
+        # 是否启用RAG问答；启用后按 qa_prompt 和检索结果直接构建提示词
+        self.rag_enabled = False
+        self.qa_prompt = None
+        # 最近一次流式回复的首字延迟和总耗时
+        self.last_stream_stats = None
         self.documents = []
+        # 按token预算组装RAG上下文；检索时多取一些候选，由预算决定最终使用多少
+        self.context_builder = ContextBuilder(max_tokens=self.model_configs.get("context_max_tokens", 2000))
+        self.retrieval_k = self.model_configs.get("retrieval_k", 8)
+        # 按客户或投资组合划分的命名空间分片，首次使用时创建
+        self.namespace_store = None
+        self.active_namespaces = None
+        # 已加载的向量库快照版本和监视新快照的后台线程
+        self.snapshot_version = None
+        self.snapshot_watcher = None
+        # 按模型名称缓存的嵌入模型
+        self._embedding_models = {}
+        # 入库去重状态（登记默认向量存储中已有的文本块）和最近一次去重统计
+        self._deduplicator = None
+        self.last_dedup_stats = None
+        # 回答缓存只服务RAG问答，在向量库就绪后才创建
+        self.answer_cache = None
+        # 入库时在后台预计算的文档总结，首次使用时创建
+        self.summary_precomputer = None
+        # 入库和快照切换串行执行，查询不需要获取这把锁
+        self._ingest_lock = threading.RLock()
+        # 多个会话并发使用机器人时，命名空间存储和总结预计算器只创建一次
+        self._lazy_lock = threading.Lock()
         
         # 数据库相关属性
         self.db_url = db_url
         self.db_token = db_token
         self.use_async_db = use_async_db
+        # 异步模式下通过后台队列批量发送，不阻塞对话
+        self.db_queue = DatabaseDeliveryQueue(db_url, db_token) if use_async_db and db_url else None
         
-        # Embedding模型保存路径
+        # Embedding模型保存路径，目录在首次保存嵌入模型信息时创建
         self.embedding_model_path = embedding_model_path
-        # 确保embedding模型目录存在
-        os.makedirs(self.embedding_model_path, exist_ok=True)
         
         print(f"Using Deepseek API with model: {self.model_name}")
         print(f"Embedding模型保存路径: {self.embedding_model_path}")
@@ -66,6 +189,7 @@ class LangChainChatBot:
     def _initialize_embeddings(self, model_path="paraphrase-multilingual-MiniLM-L12-v2"):
         """初始化嵌入模型 - 使用 transformers 库从 Hugging Face 加载模型"""
         try:
+            from transformers import AutoModel, AutoTokenizer
             # 使用 Hugging Face 上的模型
             self.embedding_model = AutoModel.from_pretrained(model_path, trust_remote_code=True)  # 加载模型
             self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)  # 加载对应的 tokenizer
@@ -84,15 +208,22 @@ class LangChainChatBot:
             "temperature": 0.7,
             "top_p": 0.95,
             "presence_penalty": 0.1,
+            # 重试由LLM调度器统一处理，避免客户端内部重试叠加
+            "max_retries": 0,
             **self.model_configs.get("llm_kwargs", {})
         }
         
+        # 所有机器人共享同一个保活连接池，不必每次对话重新建立TCP/TLS连接
         self.llm = ChatOpenAI(
             api_key=self.api_key,
             model_name=self.model_name,
             base_url=self.base_url,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
             **llm_kwargs
         )
+        # 创建后修改的采样参数，每次调用时传入
+        self.llm_overrides = {}
     
     def _initialize_prompt(self):
         """初始化提示词模板"""
@@ -124,30 +255,90 @@ class LangChainChatBot:
         初始化对话记忆
         :param memory_type: 记忆类型
         """
-        if memory_type == "summary":
-            self.memory = ConversationSummaryMemory(
+        self.memory_type = memory_type
+        self.memory = self._create_memory(memory_type)
+    
+    def _create_memory(self, memory_type: str):
+        """
+        创建一个新的对话记忆对象，多会话服务为每个会话单独创建
+        :param memory_type: 记忆类型 "buffer"（默认）、"summary" 或 "hybrid"；"hybrid" 会在后台调用LLM合并较早的对话，需要显式选择
+        """
+        if memory_type == "hybrid":
+            # 最近几轮原样保留，更早的对话在后台合并为摘要，不增加请求延迟
+            return HybridSummaryMemory(
+                llm=self.llm,
+                max_turns=self.model_configs.get("memory_max_turns", 6),
+                max_token_limit=self.model_configs.get("memory_max_tokens", 1500),
+                memory_key="history"
+            )
+        elif memory_type == "summary":
+            return ConversationSummaryMemory(
                 llm=self.llm,
                 return_messages=True,
                 memory_key="history"
             )
         else:  # default to buffer
-            self.memory = ConversationBufferMemory(
+            return ConversationBufferMemory(
                 return_messages=True,
                 memory_key="history"
             )
             
     def _initialize_conversation_chain(self):
-        """初始化对话链"""
-        self.conversation = ConversationChain(
-            llm=self.llm,
-            memory=self.memory,
-            prompt=self.prompt,
-            verbose=False
-        )
+        """重置对话链，在下次访问 conversation 时按当前的LLM、记忆和提示模板重新创建"""
+        self._conversation = None
+    
+    @property
+    def conversation(self):
+        """对话链：生成回复时直接格式化提示词调用LLM，不经过对话链，因此只在访问时创建"""
+        if self._conversation is None:
+            from langchain.chains import ConversationChain
+            self._conversation = ConversationChain(
+                llm=self.llm,
+                memory=self.memory,
+                prompt=self.prompt,
+                llm_kwargs=dict(self.llm_overrides),
+                verbose=False
+            )
+        return self._conversation
+    
+    def _bound_llm(self):
+        """带上当前采样参数覆盖的LLM，用于分块总结等直接接收LLM对象的调用"""
+        return self.llm.bind(**self.llm_overrides) if self.llm_overrides else self.llm
+    
+    # 以下属性读取当前快照；同一次查询需要多个部分时应先取一次 index_snapshot 再使用其字段
+    @property
+    def vector_store(self):
+        return self.index_snapshot.vector_store if self.index_snapshot is not None else None
+    
+    @property
+    def lexical_index(self):
+        return self.index_snapshot.lexical_index if self.index_snapshot is not None else None
+    
+    @property
+    def metadata_index(self):
+        return self.index_snapshot.metadata_index if self.index_snapshot is not None else None
+    
+    @property
+    def index_version(self):
+        return self.index_snapshot.version if self.index_snapshot is not None else None
+    
+    @property
+    def retriever(self):
+        """当前检索使用的检索器：切换到命名空间时为命名空间检索器，否则为当前快照的混合检索器"""
+        if self.active_namespaces:
+            return self.namespace_retriever
+        return self.index_snapshot.retriever if self.index_snapshot is not None else None
+    
+    @property
+    def qa_chain(self):
+        # 不兼容变更：回答时直接用 qa_prompt 和检索结果构建提示词，不再创建 RetrievalQA 链；
+        # 判断是否启用RAG请使用 rag_enabled，检索文档请使用 retriever
+        raise AttributeError("qa_chain 已移除：请使用 rag_enabled 判断是否启用RAG问答，使用 retriever 检索文档")
 
     def generate_embeddings(self, texts):
         """生成嵌入向量"""
         try:
+            import torch
             # 对输入文本进行编码
             inputs = self.tokenizer(texts, padding=True, truncation=True, return_tensors="pt")
             with torch.no_grad():  # 禁用梯度计算
@@ -160,12 +351,29 @@ class LangChainChatBot:
     
     def update_model_config(self, config_updates: Dict[str, Any]):
         """
-        更新模型配置
+        更新模型配置。llm_kwargs 与已有的参数合并：只包含采样参数时作为每次调用的参数覆盖生效，
+        其余参数（如超时）才需要重建LLM客户端，重建后仍使用共享连接池
         :param config_updates: 要更新的配置参数
         """
-        self.model_configs.update(config_updates)
-        self._initialize_llm()
-        self._initialize_conversation_chain()
+        llm_kwargs = config_updates.get("llm_kwargs")
+        self.model_configs.update({key: value for key, value in config_updates.items() if key != "llm_kwargs"})
+        if llm_kwargs is None:
+            return
+        self.model_configs["llm_kwargs"] = {**self.model_configs.get("llm_kwargs", {}), **llm_kwargs}
+        if all(key in SAMPLING_PARAMS for key in llm_kwargs):
+            self.llm_overrides.update(llm_kwargs)
+            if self._conversation is not None:
+                self._conversation.llm_kwargs = dict(self.llm_overrides)
+        else:
+            # 之前的采样参数覆盖已合并在 model_configs 中，随重建的LLM客户端一起生效
+            self._initialize_llm()
+            self._initialize_conversation_chain()
+            self._rebind_memory_llm(self.memory)
+    
+    def _rebind_memory_llm(self, memory):
+        """重建LLM客户端后，让生成对话摘要的记忆也使用新的客户端"""
+        if getattr(memory, "llm", None) is not None and memory.llm is not self.llm:
+            memory.llm = self.llm
     
     def update_pipeline_config(self, 
                              temperature: Optional[float] = None,
@@ -191,13 +399,15 @@ class LangChainChatBot:
             llm_kwargs["presence_penalty"] = presence_penalty
             
         self.model_configs["llm_kwargs"] = llm_kwargs
-        self._initialize_llm()
-        self._initialize_conversation_chain()
+        # 作为每次调用的参数覆盖，不重建LLM客户端和对话链
+        self.llm_overrides.update({key: value for key, value in llm_kwargs.items() if key in SAMPLING_PARAMS})
+        if self._conversation is not None:
+            self._conversation.llm_kwargs = dict(self.llm_overrides)
     
     def set_memory_type(self, memory_type: str):
         """
         设置记忆类型
-        :param memory_type: "buffer" 或 "summary"
+        :param memory_type: "hybrid"、"buffer" 或 "summary"
         """
         self._initialize_memory(memory_type)
         self._initialize_conversation_chain()
@@ -211,41 +421,355 @@ class LangChainChatBot:
             input_variables=["history", "input"],
             template=new_template
         )
-        self._initialize_conversation_chain()
+        # 生成回复时按 self.prompt 构建提示词，已创建的对话链直接替换模板
+        if self._conversation is not None:
+            self._conversation.prompt = self.prompt
     
-    def generate_response(self, user_input: str) -> str:
+    def generate_response(self, user_input: str, session=None) -> str:
         """
         生成回复
         :param user_input: 用户输入的文本
+        :param session: 会话状态（session_id、对话记忆 memory、检索过滤条件 retrieval_filters、
+                        命名空间 active_namespaces / namespace_retriever），如 session_server.ChatSession；
+                        为None时使用机器人自身的状态
         :return: AI的回复
         """
+        state = session if session is not None else self
         try:
-            # 如果已启用RAG且QA链已初始化，则使用RAG进行回答
-            if self.qa_chain is not None:
-                # 获取检索到的文档内容
-                docs = self.retriever.get_relevant_documents(user_input)
-                context = "\n\n".join([doc.page_content for doc in docs])
+            with self.tracer.turn(self._trace_name(state), state.session_id):
+                # 本轮的检索、缓存查找和写入都使用同一个向量库快照
+                snapshot = self.index_snapshot
+                cached, query_embedding = self._lookup_precomputed_answer(user_input, snapshot, state)
+                if cached is not None:
+                    response, metadata = cached
+                else:
+                    # 已启用RAG时按token预算组装检索上下文，否则使用对话模板和当前记忆
+                    prompt, metadata = self._prepare_prompt(user_input, snapshot, state, query_embedding)
+                    result = self.scheduler.run(
+                        lambda: self.llm.invoke(prompt, config={"callbacks": llm_callbacks()}, **self.llm_overrides),
+                        session_id=state.session_id
+                    )
+                    response = result.content.strip()
+                    self._store_cached_answer(user_input, query_embedding, response, metadata, snapshot)
+                self._record_turn(user_input, response, metadata, state.memory)
+                return response
+        except Exception as e:
+            import traceback
+            error_msg = f"发生错误: {str(e)}\n{traceback.format_exc()}"
+            print(error_msg)
+            return f"发生错误: {str(e)}"
+    
+    def stream_response(self, user_input: str, session=None):
+        """
+        流式生成回复，逐个产出模型生成的文本片段
+        
+        生成结束后同样写入对话记忆并发送到数据库；首个片段延迟和总耗时记录在
+        会话（未指定会话时为机器人）的 last_stream_stats 中，并随元数据一起发送
+        :param user_input: 用户输入的文本
+        :param session: 会话状态，同 generate_response
+        :return: 文本片段生成器
+        """
+        state = session if session is not None else self
+        start = time.perf_counter()
+        time_to_first_token = None
+        parts = []
+        try:
+            with self.tracer.turn(self._trace_name(state), state.session_id, mode="stream"):
+                snapshot = self.index_snapshot
+                cached, query_embedding = self._lookup_precomputed_answer(user_input, snapshot, state)
+                if cached is not None:
+                    response, metadata = cached
+                    tokens = [response]
+                else:
+                    prompt, metadata = self._prepare_prompt(user_input, snapshot, state, query_embedding)
+                    tokens = (
+                        chunk.content
+                        for chunk in self.scheduler.stream(
+                            lambda: self.llm.stream(prompt, config={"callbacks": llm_callbacks()}, **self.llm_overrides),
+                            session_id=state.session_id
+                        )
+                    )
                 
-                # 使用QA链回答问题
-                result = self.qa_chain({"query": user_input})
-                response = result["result"].strip()
+                for token in tokens:
+                    if not token:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start
+                    parts.append(token)
+                    yield token
                 
-                metadata = {
-                    "rag_enabled": True,
-                    "document_sources": [doc.metadata for doc in docs],
-                    "context_used": context[:500] + "..." if len(context) > 500 else context
+                response = "".join(parts).strip()
+                state.last_stream_stats = {
+                    "time_to_first_token": time_to_first_token,
+                    "total_latency": time.perf_counter() - start
                 }
-            else:
-                # 使用普通对话链
-                response = self.conversation.predict(input=user_input)
-                metadata = {"rag_enabled": False}
+                metadata.update(state.last_stream_stats)
+                if cached is None:
+                    self._store_cached_answer(user_input, query_embedding, response, metadata, snapshot)
+                self._record_turn(user_input, response, metadata, state.memory)
+        except Exception as e:
+            import traceback
+            error_msg = f"发生错误: {str(e)}\n{traceback.format_exc()}"
+            print(error_msg)
+            yield f"发生错误: {str(e)}"
+    
+    async def agenerate_response(self, user_input: str, session=None) -> str:
+        """
+        异步生成回复：LLM调用和数据库记录走异步HTTP，检索在共享线程池中执行，
+        可在同一个事件循环上并发处理大量对话
+        :param user_input: 用户输入的文本
+        :param session: 会话状态，同 generate_response
+        :return: AI的回复
+        """
+        state = session if session is not None else self
+        try:
+            with self.tracer.turn(self._trace_name(state), state.session_id, mode="async"):
+                snapshot = self.index_snapshot
+                cached, query_embedding = await run_blocking(self._lookup_precomputed_answer, user_input, snapshot, state)
+                if cached is not None:
+                    response, metadata = cached
+                else:
+                    # 检索和上下文组装在线程池中执行
+                    prompt, metadata = await run_blocking(self._prepare_prompt, user_input, snapshot, state,
+                                                          query_embedding)
+                    result = await self.scheduler.arun(
+                        lambda: self.llm.ainvoke(prompt, config={"callbacks": llm_callbacks()}, **self.llm_overrides),
+                        session_id=state.session_id
+                    )
+                    response = result.content.strip()
+                    self._store_cached_answer(user_input, query_embedding, response, metadata, snapshot)
+                await self._arecord_turn(user_input, response, metadata, state.memory)
+                return response
+        except Exception as e:
+            import traceback
+            error_msg = f"发生错误: {str(e)}\n{traceback.format_exc()}"
+            print(error_msg)
+            return f"发生错误: {str(e)}"
+    
+    async def astream_response(self, user_input: str, session=None):
+        """
+        异步流式生成回复，逐个产出模型生成的文本片段，统计信息同 stream_response
+        :param user_input: 用户输入的文本
+        :param session: 会话状态，同 generate_response
+        :return: 异步文本片段生成器
+        """
+        state = session if session is not None else self
+        start = time.perf_counter()
+        time_to_first_token = None
+        parts = []
+        try:
+            with self.tracer.turn(self._trace_name(state), state.session_id, mode="astream"):
+                snapshot = self.index_snapshot
+                cached, query_embedding = await run_blocking(self._lookup_precomputed_answer, user_input, snapshot, state)
+                if cached is not None:
+                    response, metadata = cached
+                    parts.append(response)
+                    time_to_first_token = time.perf_counter() - start
+                    yield response
+                else:
+                    # 检索和上下文组装在线程池中执行
+                    prompt, metadata = await run_blocking(self._prepare_prompt, user_input, snapshot, state,
+                                                          query_embedding)
+                    
+                    async for chunk in self.scheduler.astream(
+                        lambda: self.llm.astream(prompt, config={"callbacks": llm_callbacks()}, **self.llm_overrides),
+                        session_id=state.session_id
+                    ):
+                        token = chunk.content
+                        if not token:
+                            continue
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start
+                        parts.append(token)
+                        yield token
                 
-            # 将对话添加到记忆中，以便普通对话仍能访问上下文
-            self.memory.chat_memory.add_user_message(user_input)
-            self.memory.chat_memory.add_ai_message(response)
-            
-            # 如果设置了数据库URL，则将响应发送到数据库
-            if hasattr(self, 'db_url') and self.db_url:
+                response = "".join(parts).strip()
+                state.last_stream_stats = {
+                    "time_to_first_token": time_to_first_token,
+                    "total_latency": time.perf_counter() - start
+                }
+                metadata.update(state.last_stream_stats)
+                if cached is None:
+                    self._store_cached_answer(user_input, query_embedding, response, metadata, snapshot)
+                await self._arecord_turn(user_input, response, metadata, state.memory)
+        except Exception as e:
+            import traceback
+            error_msg = f"发生错误: {str(e)}\n{traceback.format_exc()}"
+            print(error_msg)
+            yield f"发生错误: {str(e)}"
+    
+    def _lookup_precomputed_answer(self, user_input: str, snapshot: Optional[IndexSnapshot], state):
+        """
+        查找可以直接返回的回答：要求总结已上传文档的问题优先使用预计算的总结，否则查找回答缓存
+        :param user_input: 用户输入的文本
+        :param snapshot: 本轮使用的向量库快照
+        :param state: 本轮的会话状态（或机器人自身）
+        :return: 同 _lookup_cached_answer
+        """
+        summary = self._lookup_summary(user_input, snapshot, state)
+        if summary is not None:
+            return summary, None
+        return self._lookup_cached_answer(user_input, snapshot, state)
+    
+    def _lookup_summary(self, user_input: str, snapshot: Optional[IndexSnapshot], state):
+        """
+        启用RAG问答时，问题要求总结某篇已上传的文档且其总结已预计算完成，返回该总结；
+        只在当前检索范围（默认向量存储或已切换的命名空间）中仍然存在的文档中查找
+        :param user_input: 用户输入的文本
+        :param snapshot: 本轮使用的向量库快照
+        :param state: 本轮的会话状态（或机器人自身）
+        :return: (总结, 元数据) 或 None
+        """
+        from summary_precompute import SUMMARY_INTENT
+        # 设置了检索过滤条件时无法确定总结的文档是否在检索范围内，按普通问题检索回答
+        if not self._rag_enabled(state) or state.retrieval_filters or not SUMMARY_INTENT.search(user_input):
+            return None
+        precomputer = self._get_summary_precomputer()
+        if precomputer is None:
+            return None
+        with span("summary_lookup") as attrs:
+            hit = precomputer.store.find(
+                user_input, state.active_namespaces,
+                present=lambda namespace, source: self._source_indexed(source, namespace, snapshot)
+            )
+            attrs["hit"] = hit is not None
+        trace = current_trace()
+        if trace is not None:
+            trace.attrs["summary_hit"] = hit is not None
+        if hit is None:
+            return None
+        source, entry = hit
+        print(f"使用预计算的文档总结: {source}")
+        return entry["summary"], {
+            "rag_enabled": True,
+            "summary_precomputed": True,
+            "summary_created": entry["created"],
+            "document_sources": [{"source": source}]
+        }
+    
+    def _source_indexed(self, source: str, namespace: str, snapshot: Optional[IndexSnapshot]) -> bool:
+        """来源是否仍在默认向量库快照（namespace 为空）或命名空间分片中"""
+        if namespace:
+            shard = self._get_namespace_store().get(namespace)
+            metadata_index = shard.metadata_index if shard is not None else None
+        else:
+            metadata_index = snapshot.metadata_index if snapshot is not None else None
+        return metadata_index is not None and metadata_index.has_source(source)
+    
+    def _lookup_cached_answer(self, user_input: str, snapshot: Optional[IndexSnapshot], state):
+        """
+        在回答缓存中查找相似问题。只有RAG问答会被缓存：其提示词不包含对话历史，
+        同一版本向量库下相似问题的回答可以复用
+        :param user_input: 用户输入的文本
+        :param snapshot: 本轮使用的向量库快照
+        :param state: 本轮的会话状态（或机器人自身）
+        :return: ((回答, 元数据) 或 None, 问题的嵌入向量或None)
+        """
+        # 设置了检索过滤条件或切换到命名空间时检索范围与缓存的回答不同，不使用缓存
+        if (self.answer_cache is None or not self.rag_enabled or snapshot is None
+                or state.retrieval_filters or state.active_namespaces):
+            return None, None
+        with span("cache_lookup") as attrs:
+            from retrieval import embed_query
+            query_embedding = embed_query(snapshot.vector_store, user_input)
+            hit = self.answer_cache.lookup(user_input, query_embedding, snapshot.version)
+            attrs["hit"] = hit is not None
+        trace = current_trace()
+        if trace is not None:
+            trace.attrs["cache_hit"] = hit is not None
+        if hit is None:
+            return None, query_embedding
+        print(f"回答缓存命中（相似度 {hit['similarity']:.3f}）: {hit['question'][:50]}")
+        metadata = {
+            **hit["metadata"],
+            "cache_hit": True,
+            "cache_similarity": hit["similarity"],
+            "cached_question": hit["question"]
+        }
+        return (hit["answer"], metadata), query_embedding
+    
+    def _store_cached_answer(self, user_input: str, query_embedding, response: str, metadata: Dict[str, Any],
+                             snapshot: Optional[IndexSnapshot]):
+        """将RAG回答按生成它所用的向量库快照版本写入缓存，并在元数据中标记未命中缓存"""
+        if query_embedding is None:
+            return
+        metadata["cache_hit"] = False
+        cached_metadata = {key: metadata[key] for key in ("rag_enabled", "document_sources") if key in metadata}
+        self.answer_cache.store(user_input, query_embedding, snapshot.version, response, cached_metadata)
+    
+    def _rag_enabled(self, state) -> bool:
+        """本轮是否使用RAG问答：机器人已启用RAG，或会话已切换到命名空间"""
+        return self.rag_enabled or bool(state.active_namespaces)
+    
+    def _trace_name(self, state) -> str:
+        return "rag" if self._rag_enabled(state) else "chat"
+    
+    def _prepare_prompt(self, user_input: str, snapshot: Optional[IndexSnapshot], state, query_embedding=None):
+        """
+        构建本轮的提示词和元数据，并记录提示词大小
+        :param user_input: 用户输入的文本
+        :param snapshot: 本轮使用的向量库快照
+        :param state: 本轮的会话状态（或机器人自身），提供对话记忆和检索范围
+        :param query_embedding: 查找回答缓存时已计算的查询向量，检索时直接使用
+        :return: (提示词, 元数据)
+        """
+        if self._rag_enabled(state):
+            with span("retrieval") as attrs:
+                docs = self._retrieve(user_input, snapshot, state, query_embedding)
+                attrs["documents"] = len(docs)
+            with span("prompt_build") as attrs:
+                prompt, metadata = self._build_rag_messages(user_input, docs)
+                prompt_tokens = sum(count_tokens(message.content) for message in prompt)
+                attrs.update(prompt_tokens=prompt_tokens, context_passages=metadata["context_passages"])
+        else:
+            with span("prompt_build") as attrs:
+                prompt = self._build_plain_prompt(user_input, state.memory)
+                metadata = {"rag_enabled": False}
+                prompt_tokens = count_tokens(prompt)
+                attrs["prompt_tokens"] = prompt_tokens
+        metadata["prompt_tokens"] = prompt_tokens
+        if metadata["rag_enabled"]:
+            print(f"提示词约 {prompt_tokens} tokens，上下文 {metadata['context_tokens']} tokens，"
+                  f"使用 {metadata['context_passages']}/{metadata['retrieved_chunks']} 个片段")
+        else:
+            print(f"提示词约 {prompt_tokens} tokens")
+        return prompt, metadata
+    
+    def _build_plain_prompt(self, user_input: str, memory=None) -> str:
+        """用对话模板和对话记忆（默认为机器人自身的记忆）构建普通对话的提示词，与ConversationChain的格式一致"""
+        memory = memory if memory is not None else self.memory
+        history = memory.load_memory_variables({})[memory.memory_key]
+        return self.prompt.format(history=history, input=user_input)
+    
+    def _build_rag_messages(self, user_input: str, docs):
+        """
+        用QA模板和检索到的文档构建RAG提示消息：合并重叠文本块、去除近似重复段落，
+        并按检索排名在token预算内填入上下文
+        :return: (提示消息, 元数据)
+        """
+        context, used_docs, stats = self.context_builder.build(docs)
+        messages = self.qa_prompt.format_messages(context=context, question=user_input)
+        metadata = {
+            "rag_enabled": True,
+            "document_sources": [doc.metadata for doc in used_docs],
+            "context_used": context[:500] + "..." if len(context) > 500 else context,
+            **stats
+        }
+        return messages, metadata
+    
+    def _record_turn(self, user_input: str, response: str, metadata: Dict[str, Any], memory=None):
+        """将一轮对话写入记忆（默认为机器人自身的记忆）并发送到数据库"""
+        memory = memory if memory is not None else self.memory
+        # 通过记忆自身的接口写入，使摘要类记忆能够更新
+        with span("memory_update"):
+            memory.save_context({"input": user_input}, {"output": response})
+        
+        # 如果设置了数据库URL，则将响应发送到数据库
+        if self.db_queue is not None:
+            with span("db_send", queued=True):
+                self.db_queue.submit(self._build_db_payload(response, user_input, metadata))
+        elif hasattr(self, 'db_url') and self.db_url:
+            with span("db_send", queued=False):
                 try:
                     # 发送响应到数据库
                     self._send_to_database(
@@ -255,13 +779,19 @@ class LangChainChatBot:
                     )
                 except Exception as e:
                     print(f"发送响应到数据库时出错: {str(e)}")
-            
-            return response
-        except Exception as e:
-            import traceback
-            error_msg = f"发生错误: {str(e)}\n{traceback.format_exc()}"
-            print(error_msg)
-            return f"发生错误: {str(e)}"
+    
+    async def _arecord_turn(self, user_input: str, response: str, metadata: Dict[str, Any], memory=None):
+        """_record_turn 的异步版本，数据库记录通过共享的异步HTTP客户端发送"""
+        memory = memory if memory is not None else self.memory
+        with span("memory_update"):
+            memory.save_context({"input": user_input}, {"output": response})
+        
+        if self.db_queue is not None:
+            with span("db_send", queued=True):
+                self.db_queue.submit(self._build_db_payload(response, user_input, metadata))
+        elif self.db_url:
+            with span("db_send", queued=False):
+                await self._asend_to_database(response, user_input, metadata)
     
     def _send_to_database(self, response: str, user_input: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
         """
@@ -280,25 +810,17 @@ class LangChainChatBot:
             url = f"{self.db_url}/api/chat_responses"
             
             # 准备请求数据
-            payload = {
-                "user_input": user_input,
-                "ai_response": response,
-                "timestamp": datetime.datetime.now().isoformat(),
-            }
-            
-            # 添加元数据（如果有）
-            if metadata:
-                payload["metadata"] = metadata
+            payload = self._build_db_payload(response, user_input, metadata)
                 
             # 设置请求头
             headers = {"Content-Type": "application/json"}
             if self.db_token:
                 headers["Authorization"] = f"Bearer {self.db_token}"
             
-            # 发送POST请求
-            resp = requests.post(
+            # 发送POST请求，与LLM调用共用同一个HTTP客户端，复用到数据库后端的连接
+            resp = get_http_client().post(
                 url=url,
-                data=json.dumps(payload),
+                content=json.dumps(payload),
                 headers=headers,
                 timeout=10  # 设置超时时间（秒）
             )
@@ -315,15 +837,83 @@ class LangChainChatBot:
             print(f"发送响应时发生错误: {str(e)}")
             return False
     
-    def process_file(self, file_path: str) -> str:
+    async def _asend_to_database(self, response: str, user_input: str, metadata: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        _send_to_database 的异步版本，使用共享的异步HTTP客户端复用连接
+        
+        返回:
+            bool: 发送成功返回True，失败返回False
+        """
+        try:
+            headers = {"Content-Type": "application/json"}
+            if self.db_token:
+                headers["Authorization"] = f"Bearer {self.db_token}"
+            
+            resp = await get_async_client().post(
+                f"{self.db_url}/api/chat_responses",
+                content=json.dumps(self._build_db_payload(response, user_input, metadata)),
+                headers=headers,
+                timeout=10
+            )
+            if resp.status_code in (200, 201):
+                return True
+            print(f"发送到数据库后端失败，状态码: {resp.status_code}")
+            return False
+        except Exception as e:
+            print(f"发送响应时发生错误: {str(e)}")
+            return False
+    
+    def _build_db_payload(self, response: str, user_input: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """构建发送到数据库后端的对话记录"""
+        payload = {
+            "user_input": user_input,
+            "ai_response": response,
+            "timestamp": datetime.datetime.now().isoformat(),
+        }
+        
+        # 添加元数据（如果有）
+        if metadata:
+            payload["metadata"] = metadata
+        return payload
+    
+    def close(self):
+        """释放资源：停止快照监视线程和总结预计算线程，发送后台队列中剩余的对话记录，保存回答缓存"""
+        if self.snapshot_watcher is not None:
+            self.snapshot_watcher.stop()
+        if self.summary_precomputer is not None:
+            self.summary_precomputer.close()
+        if self.db_queue is not None:
+            self.db_queue.close()
+        if self.answer_cache is not None:
+            self.answer_cache.save()
+    
+    def process_file(self, file_path: str,
+                     map_reduce: Optional[bool] = None,
+                     chunk_tokens: int = 3000,
+                     max_concurrency: int = 4) -> str:
         """
         处理文件内容
         :param file_path: 文件路径
+        :param map_reduce: 是否分块并行处理；为None时文件超过 chunk_tokens 自动启用
+        :param chunk_tokens: 分块处理时每块的token上限
+        :param max_concurrency: 分块处理时同时进行的LLM调用数上限
         :return: AI的回复
         """
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                file_content = file.read()
+            file_content = self._load_text_document(file_path).page_content
+            
+            if map_reduce is None:
+                map_reduce = count_tokens(file_content) > chunk_tokens
+            if map_reduce:
+                # 长文档分块并行提取，再合并为关键词/摘要/大纲格式
+                response = map_reduce_document(self._bound_llm(), file_content, chunk_tokens, max_concurrency,
+                                               scheduler=self.scheduler)
+                self._record_turn(
+                    f"请处理以下文件：{os.path.basename(file_path)}",
+                    response,
+                    {"rag_enabled": False, "map_reduce": True}
+                )
+                return response
             
             # 构建提示词，将文件内容作为用户输入
             user_input = f"请处理以下文本内容：\n\n{file_content}"
@@ -334,185 +924,362 @@ class LangChainChatBot:
         except Exception as e:
             return f"处理文件时发生错误: {str(e)}"
         
-    def load_documents(self, file_paths, chunk_size=1000, chunk_overlap=200):
+    def load_documents(self, file_paths, chunk_size=500, chunk_overlap=100, append=False, namespace=None):
         """
     加载并处理文档
     :param file_paths: 文件路径列表或单个文件路径
-    :param chunk_size: 分块大小
-    :param chunk_overlap: 分块重叠大小
+    :param chunk_size: 分块大小（token数）
+    :param chunk_overlap: 分块重叠大小（token数）
+    :param append: 为True时将文本块增量添加到已有向量存储和倒排索引，而不是重建
+    :param namespace: 写入的命名空间，指定时文本块写入该命名空间的分片，而不是默认向量存储
     :return: 文本块数量
     """
         if not isinstance(file_paths, list):
             file_paths = [file_paths]
     
-        # 定义可能的编码列表，按优先级排序
-        encodings = ["utf-8", "gb2312", "gbk", "gb18030", "utf-16", "big5", "latin-1"]
-    
         documents = []
         for file_path in file_paths:
             try:
                 print(f"开始加载文档: {file_path}")
             
                 if file_path.endswith('.txt'):
-                    print(f"检测到txt文件，使用TextLoader...")
-                
-                # 尝试自动检测编码
-                    detected_encoding = None
-                    for encoding in encodings:
-                        try:
-                            with open(file_path, 'r', encoding=encoding) as f:
-                                # 尝试读取一小部分来验证编码是否正确
-                                f.read(1024)
-                                detected_encoding = encoding
-                                break
-                        except UnicodeDecodeError:
-                            continue
-                
-                    if detected_encoding:
-                        print(f"检测到文件编码: {detected_encoding}")
-                        loader = TextLoader(file_path, encoding=detected_encoding)
-                    else:
-                    # 如果所有编码都失败，尝试使用最宽容的latin-1编码
-                        print("无法检测到正确的编码，使用latin-1编码")
-                        loader = TextLoader(file_path, encoding="latin-1")
+                    print(f"检测到txt文件，一次性读取并检测编码...")
+                    loaded_docs = [self._load_text_document(file_path)]
                     
                 elif file_path.endswith('.pdf'):
                     print(f"检测到pdf文件，使用PyPDFLoader...")
-                    loader = PyPDFLoader(file_path)
+                    from langchain_community.document_loaders import PyPDFLoader
+                    loaded_docs = PyPDFLoader(file_path).load()
+                    # 扫描件没有文本层，改为逐页OCR识别
+                    if not any(doc.page_content.strip() for doc in loaded_docs):
+                        print(f"PDF中没有可提取的文本，按扫描件逐页OCR识别...")
+                        from ocr_ingest import iter_ocr_documents
+                        loaded_docs = list(iter_ocr_documents(file_path))
+                
+                elif os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS:
+                    print(f"检测到图像文件，逐页OCR识别...")
+                    from ocr_ingest import iter_ocr_documents
+                    loaded_docs = list(iter_ocr_documents(file_path))
                 
                 elif os.path.isdir(file_path):
-                    print(f"检测到目录，使用DirectoryLoader...")
-                    # 处理整个目录，尝试使用多种编码
-                    try:
-                        # 首先尝试UTF-8
-                        loader = DirectoryLoader(
-                            file_path,
-                            glob="**/*.txt",
-                            loader_cls=TextLoader,
-                            loader_kwargs={"encoding": "utf-8"}
-                        )
-                    # 测试加载
-                        test_docs = loader.load()
-                        print(f"成功使用UTF-8编码加载目录")
-                    except Exception as e:
-                        print(f"使用UTF-8加载失败，尝试GBK: {str(e)}")
+                    print(f"检测到目录，逐个读取txt文件...")
+                    # 每个文件只读取一次，各自检测编码，不再整目录按编码反复重试
+                    loaded_docs = []
+                    for txt_path in sorted(glob.glob(os.path.join(file_path, "**", "*.txt"), recursive=True)):
                         try:
-                            # 然后尝试GBK
-                            loader = DirectoryLoader(
-                                file_path,
-                                glob="**/*.txt",
-                                loader_cls=TextLoader,
-                                loader_kwargs={"encoding": "gbk"}
-                            )
-                        # 测试加载
-                            test_docs = loader.load()
-                            print(f"成功使用GBK编码加载目录")
+                            loaded_docs.append(self._load_text_document(txt_path))
                         except Exception as e:
-                            print(f"使用GBK加载失败，尝试GB18030: {str(e)}")
-                            # 最后尝试GB18030
-                            loader = DirectoryLoader(
-                                file_path,
-                                glob="**/*.txt",
-                                loader_cls=TextLoader,
-                                loader_kwargs={"encoding": "gb18030"}
-                            )
+                            print(f"读取文件失败 {txt_path}: {str(e)}")
                 else:
-                    print(f"不支持的文件类型: {file_path}, 支持的类型: .txt, .pdf, 或目录")
+                    print(f"不支持的文件类型: {file_path}, 支持的类型: .txt, .pdf, 图像, 或目录")
                     continue
-            
-                try:
-                    print(f"正在读取文档内容...")
-                    loaded_docs = loader.load()
-                    print(f"文档内容读取成功，检查文档语言...")
                 
-                # 打印前几个文档的内容片段，检查语言
-                    if loaded_docs:
-                        sample = loaded_docs[0].page_content[:100] + "..."
-                        print(f"文档示例：{sample}")
+                self._tag_documents(loaded_docs)
                 
-                    documents.extend(loaded_docs)
-                    print(f"成功加载文档: {file_path}, 文档数: {len(loaded_docs)}")
-                except Exception as e:
-                    import traceback
-                    print(f"读取文档内容失败: {str(e)}")
-                    print(f"详细错误信息:\n{traceback.format_exc()}")
+                # 打印前几个文档的内容片段，检查语言
+                if loaded_docs:
+                    sample = loaded_docs[0].page_content[:100] + "..."
+                    print(f"文档示例：{sample}")
                 
-                # 如果指定编码失败，尝试使用别的编码
-                    if file_path.endswith('.txt'):
-                        for encoding in [enc for enc in encodings if enc != detected_encoding]:
-                            try:
-                                print(f"尝试使用 {encoding} 编码重新加载...")
-                                loader = TextLoader(file_path, encoding=encoding)
-                                loaded_docs = loader.load()
-                                print(f"使用 {encoding} 编码加载成功！")
-
-                                if loaded_docs:
-                                    sample = loaded_docs[0].page_content[:100] + "..."
-                                    print(f"文档示例：{sample}")
-                            
-                                documents.extend(loaded_docs)
-                                print(f"成功加载文档: {file_path}, 文档数: {len(loaded_docs)}")
-                                break
-                            except Exception as e2:
-                                print(f"使用 {encoding} 编码加载失败: {str(e2)}")
-                                continue
+                documents.extend(loaded_docs)
+                print(f"成功加载文档: {file_path}, 文档数: {len(loaded_docs)}")
                     
             except Exception as e:
                 import traceback
                 print(f"加载文档失败 {file_path}: {str(e)}")
                 print(f"详细错误信息:\n{traceback.format_exc()}")
     
-    # 分割文档
-        if documents:
+    # 分割文档并建立索引
+        if not documents:
+            print("没有成功加载任何文档，无法继续处理")
+            return 0
+        return self.index_documents(documents, chunk_size, chunk_overlap, append, namespace)
+    
+    def index_documents(self, documents, chunk_size=500, chunk_overlap=100, append=False, namespace=None, save=True,
+                        summarize=True):
+        """
+        分割已读取的文档、去重并写入向量存储（或命名空间分片）
+        :param documents: 文档列表，如按页产出的OCR结果
+        :param chunk_size: 分块大小（token数）
+        :param chunk_overlap: 分块重叠大小（token数）
+        :param append: 为True时增量添加到已有向量存储和倒排索引，而不是重建
+        :param namespace: 写入的命名空间
+        :param save: 是否在写入后保存向量库快照；连续多批写入时可只在最后保存一次
+        :param summarize: 是否提交文档总结预计算（需在 model_configs 中启用 precompute_summaries）；
+                          同一文档分多批写入时应在最后用全部页面调用 schedule_summaries
+        :return: 新写入的文本块数量
+        """
+        if not documents:
+            return 0
+        self._tag_documents(documents)
+        if summarize:
+            self.schedule_summaries(documents, namespace)
+        # 多个上传请求或后台快照切换同时进行时串行执行，避免在同一个旧快照的副本上各自写入后互相覆盖
+        with self._ingest_lock:
             try:
                 print(f"开始分割文档，共 {len(documents)} 个文档，参数: chunk_size={chunk_size}, chunk_overlap={chunk_overlap}")
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=chunk_size,
-                    chunk_overlap=chunk_overlap,
-                    length_function=len
-                )
-                self.documents = text_splitter.split_documents(documents)
+                self.documents = self._split_documents(documents, chunk_size, chunk_overlap)
                 print(f"文档分割完成，共有 {len(self.documents)} 个文本块")
             
+                # 增量添加到默认向量存储时，在当前快照的副本上去重和写入，完成后整体发布
+                snapshot = self.index_snapshot
+                draft = None
+                if append and namespace is None and snapshot is not None:
+                    draft = self._draft_snapshot(snapshot)
+                # 去除完全重复和近似重复的文本块，增量添加时同时与已有文本块比较
+                self.documents, document_ids, merged = self._deduplicate_chunks(
+                    self.documents, draft.vector_store if draft is not None else None, keep=namespace is None
+                )
+                if merged:
+                    # 重复上传的来源和这次的上传时间增量记到已有文本块的位置上，不重建元数据索引
+                    self._merge_metadata(draft, merged)
+                if not self.documents:
+                    if merged:
+                        self._publish_snapshot(draft.vector_store, draft.lexical_index, draft.metadata_index)
+                        if save:
+                            self.save_vector_store()
+                    print("所有文本块均与已有内容重复，无需嵌入")
+                    return 0
+        
             # 打印几个文本块的示例
                 if self.documents:
                     print(f"文本块示例:")
                     for i in range(min(2, len(self.documents))):
                         print(f"文本块 {i+1}:")
                         print(self.documents[i].page_content[:100] + "...")
+        
+                if namespace is not None:
+                    total = self._get_namespace_store().add_documents(namespace, self.documents, save=save)
+                    print(f"已写入命名空间 {namespace}，分片共 {total} 个文本块")
+                    return len(self.documents)
             
                 # 创建向量存储
-                result = self._create_vector_store()
+                result = self._create_vector_store(append=append, ids=document_ids, save=save, draft=draft)
                 if not result:
+                    self._deduplicator = None
                     print("向量存储创建失败，文档加载过程中断")
                     return 0
+                if draft is None:
+                    # 重建了默认向量存储，不在这批文档中的来源的预计算总结随之失效
+                    self._retain_summaries(documents)
             except Exception as e:
                 import traceback
                 print(f"分割文档过程失败: {str(e)}")
                 print(f"详细错误信息:\n{traceback.format_exc()}")
                 return 0
+            return len(self.documents)
+    
+    def schedule_summaries(self, documents, namespace=None):
+        """
+        按来源合并文档全文，提交到后台预计算关键词/关键词解释/摘要/大纲格式的总结（低优先级LLM调用），
+        之后要求总结这些文档的问题直接返回结果；文档内容变化时旧总结失效并重新计算。
+        每个来源都会产生分块总结的LLM调用，只有 model_configs['precompute_summaries'] 为 True 时才提交
+        :param documents: 同一批上传的文档（如PDF的各页）
+        :param namespace: 文档写入的命名空间，只有检索这个命名空间的会话能取到这些总结
+        """
+        precomputer = self._get_summary_precomputer()
+        if precomputer is None:
+            return
+        try:
+            grouped = {}
+            for doc in documents:
+                grouped.setdefault(doc.metadata.get("source"), []).append(doc)
+            for source, docs in grouped.items():
+                if source is None:
+                    continue
+                docs.sort(key=lambda doc: doc.metadata.get("page") or 0)
+                text = "\n\n".join(doc.page_content for doc in docs)
+                upload_time = max(doc.metadata.get("upload_time") or 0 for doc in docs)
+                status = precomputer.submit(source, text, upload_time, namespace)
+                print(f"文档总结预计算: {source} -> {status}")
+        except Exception as e:
+            print(f"提交文档总结预计算失败: {str(e)}")
+    
+    def _retain_summaries(self, documents):
+        """默认向量存储重建后，只保留这批文档来源的预计算总结"""
+        precomputer = self._get_summary_precomputer()
+        if precomputer is not None:
+            precomputer.store.retain({doc.metadata.get("source") for doc in documents})
+    
+    def _get_summary_precomputer(self):
+        """获取文档总结预计算器，总结保存在 RAG/summaries.json（model_configs['precompute_summaries'] 为 True 时才启用）"""
+        if self.summary_precomputer is None and self.model_configs.get("precompute_summaries", False):
+            from summary_precompute import SummaryPrecomputer, SummaryStore
+            with self._lazy_lock:
+                if self.summary_precomputer is None:
+                    # 每次生成时读取当前的LLM和采样参数
+                    self.summary_precomputer = SummaryPrecomputer(
+                        lambda text: map_reduce_document(self._bound_llm(), text, scheduler=self.scheduler),
+                        SummaryStore("RAG")
+                    )
+        return self.summary_precomputer
+    
+    def _deduplicate_chunks(self, chunks, vector_store=None, keep=True):
+        """
+        入库前去除完全重复和近似重复的文本块，重复块的来源记录到保留副本的 metadata["sources"]
+        （model_configs['dedup'] 为 False 时不去重，为字典时作为 MinHashDeduplicator 的参数）
+        :param chunks: 分割后的文本块
+        :param vector_store: 增量添加时写入的向量存储副本，同时与其中已有的文本块比较，合并的来源写回这个副本
+        :param keep: 是否保留去重状态供之后的增量添加复用（写入默认向量存储时）
+        :return: (需要嵌入的文本块, 它们的docstore ID, {已有文本块ID: 合并进它的重复块列表})
+        """
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        dedup_configs = self.model_configs.get("dedup", {})
+        if dedup_configs is False:
+            return chunks, ids, {}
+        from dedup import MinHashDeduplicator, merge_sources
+        from chunk_store import replace_documents
+        
+        if vector_store is not None and self._deduplicator is not None:
+            deduplicator = self._deduplicator
         else:
-            print("没有成功加载任何文档，无法继续处理")
-            return 0
+            deduplicator = MinHashDeduplicator(**dedup_configs)
+            if vector_store is not None:
+                existing = [(doc_id, vector_store.docstore.search(doc_id))
+                            for doc_id in vector_store.index_to_docstore_id.values()]
+                existing = [(doc_id, doc) for doc_id, doc in existing if isinstance(doc, Document)]
+                deduplicator.seed([doc_id for doc_id, _ in existing], [doc.page_content for _, doc in existing])
+        
+        unique, unique_ids, duplicates, stats = deduplicator.deduplicate(chunks, ids)
+        batch = dict(zip(unique_ids, unique))
+        merged = {}
+        for canonical_id, docs in duplicates.items():
+            canonical = batch.get(canonical_id)
+            if canonical is not None:
+                merge_sources(canonical, docs)
+                continue
+            existing = vector_store.docstore.search(canonical_id) if vector_store is not None else None
+            if isinstance(existing, Document):
+                # 在新文档对象上合并来源再写回副本，当前快照中的文本块保持不变
+                canonical = Document(page_content=existing.page_content, metadata={
+                    **existing.metadata,
+                    "sources": list(existing.metadata.get("sources") or [existing.metadata.get("source")])
+                })
+                merge_sources(canonical, docs)
+                replace_documents(vector_store.docstore, {canonical_id: canonical})
+                merged[canonical_id] = docs
+        
+        stats["merged_into_existing"] = sum(len(docs) for docs in merged.values())
+        self.last_dedup_stats = stats
+        if keep:
+            self._deduplicator = deduplicator
+        print(f"去重完成: {stats['chunks_in']} 个文本块中完全重复 {stats['exact_duplicates']} 个、"
+              f"近似重复 {stats['near_duplicates']} 个（其中 {stats['merged_into_existing']} 个与已有内容重复），"
+              f"保留 {stats['chunks_out']} 个，减少 {stats['removed_ratio']:.1%}（约 {stats['chars_removed']} 字符）")
+        return unique, unique_ids, merged
+    
+    @staticmethod
+    def _merge_metadata(draft: IndexSnapshot, merged):
+        """把合并进已有文本块的重复块的来源和上传时间增量写入快照副本的元数据索引"""
+        positions = {doc_id: position for position, doc_id in draft.vector_store.index_to_docstore_id.items()}
+        draft.metadata_index.merge(
+            (positions[doc_id], doc.metadata) for doc_id, docs in merged.items() for doc in docs
+        )
     
-        return len(self.documents)
+    @staticmethod
+    def _tag_documents(documents, upload_time: Optional[float] = None):
+        """为文档补充上传时间和文档类型元数据，供检索过滤使用"""
+        upload_time = upload_time or time.time()
+        for doc in documents:
+            doc.metadata.setdefault("upload_time", upload_time)
+            source = str(doc.metadata.get("source", ""))
+            doc.metadata.setdefault("doc_type", os.path.splitext(source)[1].lstrip(".").lower() or "unknown")
+        return documents
     
-    def _create_vector_store(self, embedding_model_path=None):
+    def _split_documents(self, documents, chunk_size=500, chunk_overlap=100):
+        """
+        按中英文句子边界将文档一次扫描分割为文本块，块大小按token计算；
+        每个文本块记录其在原文中的 start_index/end_index，引用和合并相邻块时无需再搜索原文
+        :param documents: 文档列表
+        :param chunk_size: 分块大小（token数）
+        :param chunk_overlap: 分块重叠大小（token数）
+        :return: 文本块列表
+        """
+        return SentenceTokenSplitter(chunk_size, chunk_overlap).split_documents(documents)
+    
+    def _load_text_document(self, file_path: str) -> Document:
+        """
+        读取txt文件为文档：只读取一次字节，检测编码后在同一缓冲区上解码
+        :param file_path: 文件路径
+        :return: 文档对象
+        """
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        
+        detected_encoding = detect_encoding(raw)
+        print(f"检测到文件编码: {detected_encoding}")
+        try:
+            text = raw.decode(detected_encoding)
+        except (UnicodeDecodeError, LookupError):
+            # 检测结果在全文上解码失败时，在同一缓冲区上依次尝试其他编码
+            text = None
+            for encoding in [enc for enc in TEXT_ENCODINGS if enc != detected_encoding]:
+                try:
+                    text = raw.decode(encoding)
+                    print(f"使用 {encoding} 编码解码成功！")
+                    break
+                except UnicodeDecodeError:
+                    continue
+            if text is None:
+                # latin-1 不会失败，这里仅作保底
+                text = raw.decode("latin-1", errors="replace")
+        
+        return Document(page_content=text, metadata={"source": file_path})
+    
+    async def aload_documents(self, file_paths, chunk_size=500, chunk_overlap=100, append=False, namespace=None):
+        """
+        异步加载文档：读取、分割、嵌入和建立索引都在共享线程池中执行，不阻塞事件循环
+        参数同 load_documents
+        :return: 文本块数量
+        """
+        return await run_blocking(self.load_documents, file_paths, chunk_size, chunk_overlap, append, namespace)
+    
+    def _create_vector_store(self, embedding_model_path=None, append=False, ids=None, save=True, draft=None):
         """
         从文档创建向量存储
         
         参数:
             embedding_model_path: 嵌入模型的保存路径，如果提供，将保存嵌入模型到指定位置
+            append: 已有向量存储时，是否将文档增量添加进去
+            ids: 文档的docstore ID（与去重状态中登记的ID一致），为None时自动生成
+            save: 是否保存向量库快照
+            draft: 增量添加时写入的当前快照副本（见 _draft_snapshot），为None时在这里复制
         """
         if not self.documents:
             print("无法创建向量存储：缺少文档")
             return False
         
+        if append and self.index_snapshot is not None:
+            try:
+                print("向已有向量存储增量添加文档...")
+                # 写入副本，正在进行的查询继续使用当前快照，写完后整体切换
+                draft = draft or self._draft_snapshot(self.index_snapshot)
+                vector_store, lexical_index, metadata_index = draft.vector_store, draft.lexical_index, draft.metadata_index
+                ids = vector_store.add_documents(self.documents, ids=ids)
+                if lexical_index is None:
+                    lexical_index = self._build_lexical_index(vector_store)
+                else:
+                    lexical_index.add_documents(ids, [doc.page_content for doc in self.documents])
+                from metadata_index import MetadataIndex
+                if metadata_index is None:
+                    metadata_index = MetadataIndex.build(vector_store)
+                else:
+                    metadata_index.add(doc.metadata for doc in self.documents)
+                self._publish_snapshot(vector_store, lexical_index, metadata_index)
+                if save:
+                    self.save_vector_store()
+                return True
+            except Exception as e:
+                import traceback
+                print(f"增量添加文档失败: {str(e)}")
+                print(f"详细错误信息:\n{traceback.format_exc()}")
+                return False
+        
         try:
             print("开始创建向量存储...")
             print(f"使用 HuggingFaceEmbeddings 模型: paraphrase-multilingual-MiniLM-L12-v2")
             # 使用HuggingFaceEmbeddings简化嵌入过程
-            embeddings = HuggingFaceEmbeddings(model_name="paraphrase-multilingual-MiniLM-L12-v2")
+            embeddings = self._load_embeddings("paraphrase-multilingual-MiniLM-L12-v2")
             
             # 如果没有提供保存路径，使用实例的默认路径
             if embedding_model_path is None:
@@ -547,23 +1314,25 @@ class LangChainChatBot:
                 print(f"创建RAG向量存储目录: {rag_dir}")
             
             print("开始将文档转换为向量...")
-            self.vector_store = FAISS.from_documents(
+            from langchain_community.vectorstores import FAISS
+            vector_store = FAISS.from_documents(
                 self.documents, 
-                embeddings
-            )
-            print("向量转换完成，创建检索器...")
-            self.retriever = self.vector_store.as_retriever(
-                search_kwargs={"k": 4}  # 默认检索4个最相关的文档
+                embeddings,
+                ids=ids
             )
+            print("向量转换完成，创建倒排索引...")
+            lexical_index = self._build_lexical_index(vector_store)
+            from metadata_index import MetadataIndex
+            metadata_index = MetadataIndex.build(vector_store)
+            print("倒排索引创建完成，创建检索器...")
+            # 发布新快照并启用RAG问答
+            self._publish_snapshot(vector_store, lexical_index, metadata_index)
             print("向量存储创建成功")
             print("检索器创建成功")
             
             # 自动保存向量存储
-            self.save_vector_store()
-            
-            # 创建QA链
-            print("开始创建QA链...")
-            self._create_qa_chain()
+            if save:
+                self.save_vector_store()
             return True
         except Exception as e:
             import traceback
@@ -573,95 +1342,350 @@ class LangChainChatBot:
     
     def save_vector_store(self, path="RAG", save_embedding_model=True):
         """
-        保存向量数据库到本地
+        保存向量数据库到本地：每次保存写入一个新的版本快照，全部落盘后再原子切换 CURRENT 指针，
+        保存中途崩溃不会破坏已发布的向量库
         
         参数:
-            path: 保存路径
+            path: 向量库根目录
             save_embedding_model: 是否同时保存嵌入模型信息
         
         返回:
             操作结果信息
         """
-        if self.vector_store is None:
+        snapshot = self.index_snapshot
+        if snapshot is None:
             return "向量存储为空，无法保存"
         
         try:
-            # 确保目录存在
-            os.makedirs(path, exist_ok=True)
+            vector_store, lexical_index, metadata_index = snapshot.vector_store, snapshot.lexical_index, snapshot.metadata_index
+            compress = self.model_configs.get("compress_docstore", True)
             
-            # 保存向量存储
-            self.vector_store.save_local(path)
-            
-            # 如果设置了保存嵌入模型且有嵌入模型信息
-            if save_embedding_model and hasattr(self, 'embedding_model_info'):
-                import json
-                # 保存嵌入模型信息到向量存储目录
-                embedding_info_path = os.path.join(path, "embedding_info.json")
-                with open(embedding_info_path, "w") as f:
-                    json.dump(self.embedding_model_info, f)
-                return f"向量存储已保存到 {path}，嵌入模型信息已保存到 {embedding_info_path}"
+            def write(snapshot_path):
+                # 保存向量存储，文本块写入压缩块存储；倒排索引和元数据索引与向量存储保存在同一目录
+                from chunk_store import save_faiss
+                stats = save_faiss(vector_store, snapshot_path, compress=compress)
+                if stats is not None:
+                    print(f"文本块存储: {stats['chunks']} 个文本块，原始 {stats['raw_bytes'] / 1024 / 1024:.2f} MB，"
+                          f"压缩后 {stats['compressed_bytes'] / 1024 / 1024:.2f} MB（压缩比 {stats['compression_ratio']:.1f}）")
+                if lexical_index is not None:
+                    lexical_index.save(snapshot_path)
+                if metadata_index is not None:
+                    metadata_index.save(snapshot_path)
+                # 如果设置了保存嵌入模型且有嵌入模型信息
+                if save_embedding_model and hasattr(self, 'embedding_model_info'):
+                    with open(os.path.join(snapshot_path, "embedding_info.json"), "w") as f:
+                        json.dump(self.embedding_model_info, f)
             
-            return f"向量存储已保存到 {path}"
+            snapshots = SnapshotStore(path)
+            version = snapshots.save(write)
+            self.snapshot_version = version
+            # 自己发布的快照不需要再由后台监视线程重新加载
+            if self.snapshot_watcher is not None:
+                self.snapshot_watcher.version = version
+            return f"向量存储已保存到 {snapshots.path(version)}（版本 {version}）"
         except Exception as e:
             return f"保存向量存储失败: {str(e)}"
     
     def load_vector_store(self, path="RAG", custom_embedding_model=None):
         """
-        从本地加载向量数据库
+        从本地加载向量数据库的当前快照（也兼容直接保存在 path 下的旧格式向量库）
         
         参数:
-            path: 加载路径
+            path: 向量库根目录
             custom_embedding_model: 自定义的嵌入模型名称或路径，如果为None则尝试使用保存时的模型
         
         返回:
             操作结果信息
         """
         try:
-            # 检查是否有嵌入模型信息文件
-            embedding_info_path = os.path.join(path, "embedding_info.json")
-            embedding_model_name = None
-            
-            if os.path.exists(embedding_info_path) and not custom_embedding_model:
-                try:
-                    import json
-                    with open(embedding_info_path, "r") as f:
-                        embedding_info = json.load(f)
-                    embedding_model_name = embedding_info.get("model_name")
-                    print(f"从保存的信息中加载嵌入模型: {embedding_model_name}")
-                except Exception as e:
-                    print(f"读取嵌入模型信息失败: {str(e)}")
-            
-            # 使用指定的嵌入模型或默认模型
-            if custom_embedding_model:
-                print(f"使用自定义嵌入模型: {custom_embedding_model}")
-                embeddings = HuggingFaceEmbeddings(model_name=custom_embedding_model)
-            elif embedding_model_name:
-                print(f"使用保存时的嵌入模型: {embedding_model_name}")
-                embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
-            else:
-                print("未找到保存的嵌入模型信息，使用默认模型: paraphrase-multilingual-MiniLM-L12-v2")
-                embeddings = HuggingFaceEmbeddings(model_name="paraphrase-multilingual-MiniLM-L12-v2")
-            
-            # 加载向量存储
-            self.vector_store = FAISS.load_local(
-                path, 
-                embeddings,
-                allow_dangerous_deserialization=True  # 添加这个参数以允许反序列化
-            )
-            self.retriever = self.vector_store.as_retriever(
-                search_kwargs={"k": 4}
-            )
-            
-            # 创建QA链
-            self._create_qa_chain()
-            
-            return f"向量存储已从 {path} 加载"
+            snapshots = SnapshotStore(path)
+            snapshot_path = snapshots.resolve()
+            if snapshot_path is None:
+                return f"加载向量存储失败: {path} 中没有向量存储"
+            version = snapshots.current()
+            self._swap_vector_store(*self._read_vector_store(snapshot_path, custom_embedding_model), version=version)
+            self.snapshot_version = version
+            if self.snapshot_watcher is not None:
+                self.snapshot_watcher.version = self.snapshot_version
+            return f"向量存储已从 {snapshot_path} 加载"
         except Exception as e:
             import traceback
             error_msg = f"加载向量存储失败: {str(e)}\n{traceback.format_exc()}"
             print(error_msg)
             return f"加载向量存储失败: {str(e)}"
     
+    def _read_vector_store(self, path: str, custom_embedding_model=None):
+        """
+        从快照目录读取向量存储、倒排索引和元数据索引，不修改机器人当前使用的索引
+        :return: (向量存储, 倒排索引, 元数据索引)
+        """
+        # 检查是否有嵌入模型信息文件
+        embedding_info_path = os.path.join(path, "embedding_info.json")
+        embedding_model_name = None
+        
+        if os.path.exists(embedding_info_path) and not custom_embedding_model:
+            try:
+                with open(embedding_info_path, "r") as f:
+                    embedding_info = json.load(f)
+                embedding_model_name = embedding_info.get("model_name")
+                print(f"从保存的信息中加载嵌入模型: {embedding_model_name}")
+            except Exception as e:
+                print(f"读取嵌入模型信息失败: {str(e)}")
+        
+        # 使用指定的嵌入模型或默认模型
+        if custom_embedding_model:
+            print(f"使用自定义嵌入模型: {custom_embedding_model}")
+            embeddings = self._load_embeddings(custom_embedding_model)
+        elif embedding_model_name:
+            print(f"使用保存时的嵌入模型: {embedding_model_name}")
+            embeddings = self._load_embeddings(embedding_model_name)
+        else:
+            print("未找到保存的嵌入模型信息，使用默认模型: paraphrase-multilingual-MiniLM-L12-v2")
+            embeddings = self._load_embeddings("paraphrase-multilingual-MiniLM-L12-v2")
+        
+        # 加载向量存储，快照中有压缩块存储时文本块按需解压，不再整体反序列化
+        from chunk_store import load_faiss
+        vector_store = load_faiss(path, embeddings)
+        
+        # 加载倒排索引，旧版本保存的向量存储没有倒排索引时从docstore重建
+        lexical_index = LexicalIndex.load(path)
+        if lexical_index is None:
+            print("未找到倒排索引，从向量存储的文档重建...")
+            lexical_index = self._build_lexical_index(vector_store)
+        from metadata_index import MetadataIndex
+        metadata_index = MetadataIndex.load(path)
+        if metadata_index is None or len(metadata_index) != vector_store.index.ntotal:
+            print("元数据索引缺失或与向量存储不一致，重建...")
+            metadata_index = MetadataIndex.build(vector_store)
+        return vector_store, lexical_index, metadata_index
+    
+    def _swap_vector_store(self, vector_store, lexical_index, metadata_index, version: Optional[str] = None):
+        """
+        切换到从磁盘读取的向量库快照，等待正在进行的入库完成后再切换
+        :param version: 磁盘快照的版本号，作为索引版本使用，重启后加载同一快照时回答缓存仍然有效
+        """
+        with self._ingest_lock:
+            # 去重状态登记的是旧向量存储的文本块
+            self._deduplicator = None
+            self._publish_snapshot(vector_store, lexical_index, metadata_index, version)
+    
+    def _publish_snapshot(self, vector_store, lexical_index, metadata_index, version: Optional[str] = None):
+        """
+        读-复制-更新：新的向量存储和索引在调用前已完整构建，这里创建检索器后一次替换 index_snapshot 引用；
+        正在进行的查询继续使用它们已取得的旧快照，不会被阻塞，也不会读到一半的索引
+        :param version: 索引版本号，为None时为本次发布生成新的版本号
+        """
+        self._ensure_answer_cache()
+        self.index_snapshot = IndexSnapshot(
+            vector_store=vector_store,
+            lexical_index=lexical_index,
+            metadata_index=metadata_index,
+            retriever=self._build_retriever(vector_store, lexical_index, metadata_index),
+            # 每次发布都换新版本号（只合并了重复来源的发布也一样），回答缓存不会返回来源过时的回答
+            version=version or uuid.uuid4().hex[:16]
+        )
+        self._create_qa_prompt()
+    
+    @staticmethod
+    def _draft_snapshot(snapshot: IndexSnapshot) -> IndexSnapshot:
+        """
+        复制快照的向量存储和索引用于增量写入：倒排索引共享未修改的倒排列表，向量和元数据索引按内存复制，
+        不重新嵌入；检索器和版本号在发布时重新生成
+        """
+        from chunk_store import copy_faiss
+        return snapshot._replace(
+            vector_store=copy_faiss(snapshot.vector_store),
+            lexical_index=snapshot.lexical_index.copy() if snapshot.lexical_index is not None else None,
+            metadata_index=snapshot.metadata_index.copy() if snapshot.metadata_index is not None else None,
+            retriever=None
+        )
+    
+    def start_snapshot_watcher(self, path="RAG", interval: float = 5.0):
+        """
+        启动后台线程监视向量库快照，其他进程发布新快照后在后台加载并切换，查询不受影响
+        :param path: 向量库根目录
+        :param interval: 检查间隔（秒）
+        """
+        if self.snapshot_watcher is not None:
+            self.snapshot_watcher.stop()
+        
+        def on_change(version, snapshot_path):
+            print(f"检测到新的向量库快照 {version}，后台加载...")
+            self._swap_vector_store(*self._read_vector_store(snapshot_path), version=version)
+            self.snapshot_version = version
+            print(f"已切换到向量库快照 {version}")
+        
+        self.snapshot_watcher = SnapshotWatcher(
+            SnapshotStore(path), on_change, interval, version=self.snapshot_version
+        ).start()
+    
+    def _load_embeddings(self, model_name: str):
+        """
+        创建 HuggingFaceEmbeddings 嵌入模型，首次调用时才导入 sentence-transformers 和 torch；
+        并发会话的查询向量按 model_configs 中的 embedding_batch_window_ms（默认5毫秒）
+        和 embedding_max_batch_size（默认32）合并为批量计算，窗口为0时不做批处理
+        """
+        # 同一模型只加载一次，切换快照时复用
+        if model_name not in self._embedding_models:
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            from embedding_batcher import BatchingEmbeddings
+            self._embedding_models[model_name] = BatchingEmbeddings(
+                HuggingFaceEmbeddings(model_name=model_name),
+                window_ms=self.model_configs.get("embedding_batch_window_ms", 5.0),
+                max_batch_size=self.model_configs.get("embedding_max_batch_size", 32)
+            )
+        return self._embedding_models[model_name]
+    
+    def _build_lexical_index(self, vector_store=None) -> LexicalIndex:
+        """根据向量存储（默认为当前向量存储）中的全部文档构建倒排索引，文档ID与docstore保持一致"""
+        from retrieval import get_documents
+        vector_store = vector_store or self.vector_store
+        index = LexicalIndex()
+        ids = list(vector_store.index_to_docstore_id.values())
+        docs = get_documents(vector_store, ids)
+        index.add_documents(ids, [doc.page_content for doc in docs])
+        return index
+    
+    def _build_retriever(self, vector_store, lexical_index, metadata_index):
+        """
+        创建混合检索器，检索数量由 retrieval_k 决定，最终进入提示词的内容由上下文预算决定；
+        向量库内容每次变化后都随新快照重建检索器
+        """
+        from retrieval import HybridRetriever
+        return HybridRetriever(
+            vector_store=vector_store,
+            lexical_index=lexical_index,
+            metadata_index=metadata_index,
+            k=self.retrieval_k
+        )
+    
+    def _ensure_answer_cache(self):
+        """向量库就绪时创建回答缓存（model_configs['answer_cache'] 为 False 时不启用）"""
+        cache_configs = self.model_configs.get("answer_cache", {})
+        if self.answer_cache is None and cache_configs is not False:
+            from answer_cache import SemanticAnswerCache
+            self.answer_cache = SemanticAnswerCache(**{"path": "RAG", **cache_configs})
+    
+    def _get_namespace_store(self):
+        """获取命名空间分片存储，分片保存在 RAG/namespaces/<命名空间>/"""
+        if self.namespace_store is None:
+            from namespaces import NamespaceStore
+            with self._lazy_lock:
+                if self.namespace_store is None:
+                    self.namespace_store = NamespaceStore(
+                        root=os.path.join("RAG", "namespaces"),
+                        embeddings_factory=lambda: self._load_embeddings("paraphrase-multilingual-MiniLM-L12-v2"),
+                        memory_budget_mb=self.model_configs.get("namespace_memory_mb", 1024)
+                    )
+        return self.namespace_store
+    
+    def use_namespaces(self, namespaces=None, session=None):
+        """
+        切换检索范围
+        :param namespaces: 命名空间名称或列表，多个命名空间并行检索后按融合分数合并；
+                           为None或空时恢复使用默认向量存储
+        :param session: 要切换的会话状态，为None时切换机器人自身的检索范围
+        :return: 操作结果信息
+        """
+        state = session if session is not None else self
+        if isinstance(namespaces, str):
+            namespaces = [namespaces]
+        if not namespaces:
+            state.active_namespaces = None
+            state.namespace_retriever = None
+            if session is None:
+                if self.index_snapshot is not None:
+                    self._create_qa_prompt()
+                else:
+                    self.rag_enabled = False
+            return "已切换到默认向量存储"
+        
+        from namespaces import NamespaceRetriever, validate_namespace
+        try:
+            store = self._get_namespace_store()
+            names = [validate_namespace(name) for name in namespaces]
+            missing = [name for name in names if not store.exists(name)]
+            if missing:
+                return f"命名空间不存在: {', '.join(missing)}"
+            state.active_namespaces = names
+            # 回答缓存按默认向量库快照的版本区分，命名空间检索时不使用
+            state.namespace_retriever = NamespaceRetriever(store=store, namespaces=names, k=self.retrieval_k)
+            if session is None:
+                self._create_qa_prompt()
+            else:
+                # 会话在命名空间中检索时只为该会话启用RAG问答，不改变机器人自身的状态
+                self._ensure_qa_prompt()
+            return f"检索范围已切换到命名空间: {', '.join(names)}"
+        except ValueError as e:
+            return str(e)
+    
+    def set_retrieval_filters(self, filters: Optional[Dict[str, Any]] = None, session=None):
+        """
+        设置检索过滤条件，之后的检索只在满足条件的文本块中进行
+        :param filters: 过滤条件，为None或空时取消过滤，支持:
+                        source（文件路径或文件名）、doc_type（如 pdf、txt）、namespace（命名空间，可为列表）、
+                        uploaded_after / uploaded_before（时间戳或 2024-03-31 形式的日期）、latest（只检索最近上传的文档）
+        :param session: 要设置的会话状态，为None时设置机器人自身的过滤条件
+        :return: 操作结果信息
+        """
+        state = session if session is not None else self
+        if not filters:
+            state.retrieval_filters = None
+            return "已取消检索过滤条件"
+        from metadata_index import validate_filters
+        try:
+            state.retrieval_filters = validate_filters(dict(filters))
+        except ValueError as e:
+            return str(e)
+        return f"检索过滤条件已设置: {json.dumps(state.retrieval_filters, ensure_ascii=False, default=str)}"
+    
+    def _retrieve(self, user_input: str, snapshot: Optional[IndexSnapshot], state, query_embedding=None):
+        """
+        按当前过滤条件检索：namespace 条件切换到对应命名空间分片，其余条件交给检索器在检索内部过滤；
+        未设置过滤条件但问题提到最新上传的文档时，只在最近上传的来源中检索
+        :param snapshot: 本轮使用的默认向量库快照，切换到命名空间时不使用
+        :param state: 本轮的会话状态（或机器人自身），提供检索过滤条件和命名空间
+        :param query_embedding: 用同一快照的嵌入模型计算好的查询向量，默认向量库检索时不再重复编码
+        """
+        from metadata_index import LATEST_UPLOAD
+        base = state.namespace_retriever if state.active_namespaces else getattr(snapshot, "retriever", None)
+        if base is None:
+            return []
+        if query_embedding is not None and not state.active_namespaces:
+            base = base.copy(update={"query_vector": query_embedding})
+        filters = dict(state.retrieval_filters or {})
+        if (not filters and snapshot is not None and snapshot.metadata_index is not None
+                and LATEST_UPLOAD.search(user_input)):
+            filters = {"latest": True}
+        if not filters:
+            return base.get_relevant_documents(user_input)
+        namespaces = filters.pop("namespace", None)
+        if namespaces:
+            from namespaces import NamespaceRetriever
+            retriever = NamespaceRetriever(
+                store=self._get_namespace_store(),
+                namespaces=[namespaces] if isinstance(namespaces, str) else list(namespaces),
+                k=self.retrieval_k,
+                filters=filters or None
+            )
+        else:
+            retriever = base.copy(update={"filters": filters})
+        return retriever.get_relevant_documents(user_input)
+    
+    def keyword_search(self, query: str, k: int = 4):
+        """
+        仅使用倒排索引进行关键词检索，不计算向量，适合股票代码、账号、具体数额等精确查找
+        :param query: 查询文本
+        :param k: 返回结果数
+        :return: 文档列表
+        """
+        snapshot = self.index_snapshot
+        if snapshot is None or snapshot.lexical_index is None:
+            return []
+        from retrieval import get_documents
+        ids = [doc_id for doc_id, _ in snapshot.lexical_index.search(query, k)]
+        return get_documents(snapshot.vector_store, ids)
+    
     def save_embedding_model(self, path=None):
         """
         保存当前使用的嵌入模型信息到指定路径
@@ -702,14 +1726,18 @@ class LangChainChatBot:
         """清除对话历史"""
         self.memory.clear()
         
-    def _create_qa_chain(self):
-        """创建问答链"""
-        if self.retriever is None:
-            print("无法创建QA链：缺少检索器")
+    def _create_qa_prompt(self):
+        """启用RAG问答：创建QA提示模板，回答时用它和检索到的上下文直接构建提示词"""
+        if self.index_snapshot is None and not self.active_namespaces:
+            print("无法启用RAG问答：缺少检索器")
             return
-        try:
-            print("开始创建QA链...")
-        # 创建QA提示模板
+        self._ensure_qa_prompt()
+        self.rag_enabled = True
+    
+    def _ensure_qa_prompt(self):
+        """创建QA提示模板（所有会话共用）"""
+        if self.qa_prompt is None:
+            # 创建QA提示模板
             template = """使用以下检索到的上下文信息来回答最后的问题。如果你不知道答案，就说你不知道，不要试图编造答案。
             你是一个文本处理器，我会上传给你文本，你需要:
             1. 始终保持礼貌和专业的态度
@@ -733,22 +1761,8 @@ class LangChainChatBot:
         
             问题: {question}
             """
-            print("使用QA提示模板初始化...")
-            qa_prompt = ChatPromptTemplate.from_template(template)
-            print("创建RetrievalQA链...")
-            # 创建QA链
-            self.qa_chain = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type="stuff",
-                retriever=self.retriever,
-                chain_type_kwargs={"prompt": qa_prompt},
-                return_source_documents=True
-            )
-            print("QA链创建成功")
-        except Exception as e:
-            import traceback
-            print(f"创建QA链失败: {str(e)}")
-            print(f"详细错误信息:\n{traceback.format_exc()}")
+            from langchain.prompts import ChatPromptTemplate
+            self.qa_prompt = ChatPromptTemplate.from_template(template)
 
 # 添加一个直接使用OpenAI客户端接口的方法
 def direct_deepseek_call(api_key: str, user_input: str, 
@@ -765,9 +1779,8 @@ def direct_deepseek_call(api_key: str, user_input: str,
     :param system_prompt: 系统提示
     :return: 模型的响应
     """
-    from openai import OpenAI
-    
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    # 按API密钥缓存客户端，复用共享连接池
+    client = get_openai_client(api_key, base_url)
     
     response = client.chat.completions.create(
         model=model_name,
@@ -780,6 +1793,32 @@ def direct_deepseek_call(api_key: str, user_input: str,
     
     return response.choices[0].message.content
 
+def direct_deepseek_stream(api_key: str, user_input: str, 
+                           model_name: str = "deepseek-chat", 
+                           base_url: str = "https://api.deepseek.com",
+                           system_prompt: str = "You are a helpful assistant"):
+    """
+    直接使用OpenAI客户端接口流式调用DeepSeek API，逐个产出生成的文本片段
+    
+    参数同 direct_deepseek_call
+    :return: 文本片段生成器
+    """
+    # 按API密钥缓存客户端，复用共享连接池
+    client = get_openai_client(api_key, base_url)
+    
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input},
+        ],
+        stream=True
+    )
+    
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 def main():
     """使用示例"""
     # 从环境变量获取API密钥或直接输入
@@ -793,6 +1832,7 @@ def main():
     parser.add_argument("--async_db", help="使用异步数据库发送", action="store_true")
     parser.add_argument("--embedding_path", help="嵌入模型保存位置", default=r"F:\Files\比赛\花旗杯\AI chatbot\model")
     parser.add_argument("--custom_embedding", help="自定义嵌入模型名称", default=None)
+    parser.add_argument("--stream", help="流式输出回复", action="store_true")
     args = parser.parse_args()
     args.api_key = api_key
     
@@ -843,6 +1883,7 @@ def main():
         user_input = input("\n你: ")
         
         if user_input.lower() == 'quit':
+            bot.close()
             print("再见！")
             break
         elif user_input.lower() == 'clear':
@@ -851,8 +1892,14 @@ def main():
             continue
         elif user_input.lower() == 'direct':
             direct_input = input("直接调用 - 输入问题: ")
-            response = direct_deepseek_call(api_key, direct_input)
-            print(f"\nAI (直接调用): {response}")
+            if args.stream:
+                print("\nAI (直接调用): ", end="", flush=True)
+                for token in direct_deepseek_stream(api_key, direct_input):
+                    print(token, end="", flush=True)
+                print()
+            else:
+                response = direct_deepseek_call(api_key, direct_input)
+                print(f"\nAI (直接调用): {response}")
             continue
         elif user_input.lower() == 'load':
             file_path = input("请输入文件或目录路径: ")
@@ -891,6 +1938,17 @@ def main():
                 print(f"嵌入模型保存路径已更新为: {embedding_model_path}")
             continue
             
+        if args.stream:
+            print("\nAI: ", end="", flush=True)
+            for token in bot.stream_response(user_input):
+                print(token, end="", flush=True)
+            stats = getattr(bot, "last_stream_stats", None)
+            if stats and stats["time_to_first_token"] is not None:
+                print(f"\n[首字延迟: {stats['time_to_first_token']:.2f}s, 总耗时: {stats['total_latency']:.2f}s]")
+            else:
+                print()
+            continue
+            
         response = bot.generate_response(user_input)
         print(f"\nAI: {response}")
 
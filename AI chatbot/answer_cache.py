@@ -0,0 +1,172 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from lexical_index import identifier_terms
+
+# 问题中的数字（年份、季度、金额等）
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def query_terms(question: str) -> List[str]:
+    """问题中的数字和股票代码等标识符；它们不同的问题即使语义很接近（如2022年和2023年的营收）也不能共用回答"""
+    return sorted(set(_NUMBER.findall(question)) | set(identifier_terms(question)))
+
+
+class SemanticAnswerCache:
+    """
+    语义回答缓存：以问题的嵌入向量、问题中的数字和标识符以及向量库版本为键，
+    同一版本向量库下与数字和标识符完全相同的历史问题的余弦相似度超过阈值时直接返回历史回答
+
+    支持TTL过期和LRU淘汰，可持久化到本地JSON文件
+    """
+
+    FILE_NAME = "answer_cache.json"
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 threshold: float = 0.95,
+                 ttl: float = 24 * 3600,
+                 max_entries: int = 1000,
+                 save_every: int = 20):
+        """
+        :param path: 持久化目录，为None时只在内存中缓存
+        :param threshold: 命中所需的最小余弦相似度
+        :param ttl: 缓存有效期（秒）
+        :param max_entries: 最大缓存条数，超出时淘汰最久未使用的条目
+        :param save_every: 每新增多少条缓存自动保存一次
+        """
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._next_id = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire_locked(self):
+        deadline = time.time() - self.ttl
+        for entry_id in [i for i, e in self.entries.items() if e["created"] < deadline]:
+            del self.entries[entry_id]
+
+    def lookup(self, question: str, embedding, index_version: str) -> Optional[Dict[str, Any]]:
+        """
+        查找缓存
+        :param question: 问题文本
+        :param embedding: 问题的嵌入向量
+        :param index_version: 当前向量库版本
+        :return: 命中时返回包含 answer、metadata、question、similarity 的字典，否则返回None
+        """
+        query = self._normalize(embedding)
+        terms = query_terms(question)
+        with self._lock:
+            self._expire_locked()
+            candidates = [(i, e) for i, e in self.entries.items()
+                          if e["index_version"] == index_version and e["terms"] == terms]
+            if candidates:
+                matrix = np.stack([e["vector"] for _, e in candidates])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return {
+                        "answer": entry["answer"],
+                        "metadata": entry["metadata"],
+                        "question": entry["question"],
+                        "similarity": float(similarities[best]),
+                    }
+            self.misses += 1
+            return None
+
+    def store(self, question: str, embedding, index_version: str, answer: str, metadata: Optional[Dict[str, Any]] = None):
+        """写入一条缓存"""
+        with self._lock:
+            self.entries[self._next_id] = {
+                "question": question,
+                "terms": query_terms(question),
+                "vector": self._normalize(embedding),
+                "index_version": index_version,
+                "answer": answer,
+                "metadata": metadata or {},
+                "created": time.time(),
+            }
+            self._next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def invalidate(self, index_version: Optional[str] = None):
+        """清除指定向量库版本的缓存，不指定版本时清空全部缓存"""
+        with self._lock:
+            if index_version is None:
+                self.entries.clear()
+            else:
+                for entry_id in [i for i, e in self.entries.items() if e["index_version"] == index_version]:
+                    del self.entries[entry_id]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def save(self):
+        """按LRU顺序保存到本地文件"""
+        if not self.path:
+            return
+        with self._lock:
+            data: List[Dict[str, Any]] = [
+                {**entry, "vector": entry["vector"].tolist()} for entry in self.entries.values()
+            ]
+            self._unsaved = 0
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, self.FILE_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, self.FILE_NAME))
+
+    def load(self):
+        """从本地文件加载，跳过已过期的条目"""
+        file_path = os.path.join(self.path, self.FILE_NAME)
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"读取回答缓存失败: {str(e)}")
+            return
+        with self._lock:
+            for entry in data:
+                entry["vector"] = np.asarray(entry["vector"], dtype=np.float32)
+                # 旧版本保存的条目没有记录数字和标识符
+                entry.setdefault("terms", query_terms(entry["question"]))
+                self.entries[self._next_id] = entry
+                self._next_id += 1
+            self._expire_locked()
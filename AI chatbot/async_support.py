@@ -0,0 +1,46 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import httpx
+
+import http_transport
+
+# 嵌入计算、FAISS检索等CPU密集任务使用的共享线程池
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """获取共享线程池"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="rag-cpu")
+    return _executor
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """在共享线程池中执行阻塞函数，避免阻塞事件循环；函数在调用方的上下文副本中运行，对话追踪等上下文变量随之传递"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    获取共享的异步HTTP客户端，与异步LLM调用使用同一个连接池（见 http_transport.get_async_http_client）
+
+    客户端绑定在首次使用它的事件循环上，同一进程内的所有对话应运行在同一个事件循环中
+    """
+    return http_transport.get_async_http_client()
+
+
+async def aclose():
+    """关闭共享的异步HTTP客户端和线程池"""
+    global _executor
+    await http_transport.aclose()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
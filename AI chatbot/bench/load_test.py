@@ -0,0 +1,127 @@
+"""
+聊天机器人压测：并发驱动多个会话调用 generate_response，统计吞吐量和延迟分位数
+
+默认在进程内启动 stub_server 作为 LLM 和数据库后端，不会调用付费API:
+    python load_test.py --sessions 50 --turns 5 --concurrency 16 --latency 0.3 --error_429 0.05
+也可以用 --base_url 指向已运行的桩服务或其他兼容服务
+"""
+import argparse
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bench_utils import latency_summary, write_results
+from stub_server import StubConfig, start_stub_server
+
+QUESTIONS = [
+    "请介绍一下这家公司最近一期的营业收入情况。",
+    "净利润同比变化是多少？",
+    "What are the main risks mentioned in the report?",
+    "和上一年相比，毛利率有什么变化？",
+    "Summarize the cash flow position in two sentences.",
+]
+
+
+def run_load_test(args) -> dict:
+    from llm_scheduler import configure_scheduler
+    from session_server import SessionManager
+    from LLMRAG import LangChainChatBot
+
+    stub_stats = None
+    base_url, db_url = args.base_url, args.db_url
+    if not base_url:
+        config = StubConfig(args.latency, args.tokens_per_second, args.response_tokens,
+                            args.error_429, args.error_500, args.seed)
+        server, stub_stats = start_stub_server(config)
+        root = f"http://127.0.0.1:{server.server_address[1]}"
+        base_url, db_url = f"{root}/v1", db_url or root
+        print(f"已启动进程内桩服务: {root}")
+
+    # 调度器必须在创建机器人之前配置，机器人初始化时获取共享调度器
+    scheduler = configure_scheduler(
+        max_concurrency=args.llm_concurrency,
+        per_session_concurrency=2,
+        requests_per_second=args.rps,
+        burst=args.llm_concurrency,
+        backoff_base=0.2,
+        backoff_max=2.0,
+    )
+    bot = LangChainChatBot(
+        api_key=args.api_key,
+        model_name=args.model,
+        model_configs={"answer_cache": False},
+        base_url=base_url,
+        db_url=db_url,
+        use_async_db=bool(db_url),
+        embedding_model_path=tempfile.mkdtemp(prefix="load-test-model-"),
+    )
+    manager = SessionManager(bot, max_sessions=args.sessions, memory_type=args.memory_type)
+    session_ids = [f"load-{uuid.uuid4().hex[:8]}" for _ in range(args.sessions)]
+
+    def run_session(session_id: str):
+        latencies, errors = [], 0
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            reply = manager.chat(session_id, QUESTIONS[turn % len(QUESTIONS)])
+            latencies.append(time.perf_counter() - started)
+            if reply.startswith("发生错误"):
+                errors += 1
+        return latencies, errors
+
+    print(f"开始压测: {args.sessions} 个会话 x {args.turns} 轮，客户端并发 {args.concurrency}")
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in as_completed([executor.submit(run_session, s) for s in session_ids]):
+            session_latencies, session_errors = future.result()
+            latencies.extend(session_latencies)
+            errors += session_errors
+    elapsed = time.perf_counter() - started
+    bot.close()
+
+    turns = len(latencies)
+    results = {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "client_concurrency": args.concurrency,
+        "llm_concurrency": args.llm_concurrency,
+        "elapsed_seconds": elapsed,
+        "turns": turns,
+        "errors": errors,
+        "error_rate": errors / turns if turns else 0.0,
+        "throughput_turns_per_second": turns / elapsed if elapsed else 0.0,
+        "latency_seconds": latency_summary(latencies),
+        "llm_scheduler": scheduler.metrics(),
+    }
+    if stub_stats is not None:
+        results["stub_server"] = stub_stats.snapshot()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天机器人并发压测")
+    parser.add_argument("--sessions", type=int, default=20, help="会话数")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行对话的会话数")
+    parser.add_argument("--llm_concurrency", type=int, default=8, help="调度器的全局LLM并发上限")
+    parser.add_argument("--rps", type=float, default=50.0, help="调度器的每秒请求数上限")
+    parser.add_argument("--memory_type", default="buffer", choices=["hybrid", "summary", "buffer"])
+    parser.add_argument("--base_url", default=None, help="已运行的OpenAI兼容服务地址，不指定时启动进程内桩服务")
+    parser.add_argument("--db_url", default=None, help="数据库后端地址，默认使用桩服务")
+    parser.add_argument("--api_key", default="stub-key")
+    parser.add_argument("--model", default="stub-model")
+    parser.add_argument("--latency", type=float, default=0.2, help="桩服务首个token前的延迟（秒）")
+    parser.add_argument("--tokens_per_second", type=float, default=200.0)
+    parser.add_argument("--response_tokens", type=int, default=60)
+    parser.add_argument("--error_429", type=float, default=0.0)
+    parser.add_argument("--error_500", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="结果JSON文件路径")
+    args = parser.parse_args()
+
+    write_results(run_load_test(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+RAG 建库与检索基准测试
+
+生成规模递增的中英文混合合成语料，对每个规模分别统计：
+- 读取、分割、嵌入、建索引各阶段的耗时和吞吐量
+- 向量库保存耗时和磁盘占用，文本块存储的压缩比和单次读取的解压耗时
+- 冷启动加载耗时（在新进程中调用 load_vector_store）
+- 峰值常驻内存
+- 不同 k 下混合检索和纯向量检索的 p50/p99 延迟
+
+每个规模在独立子进程中运行，峰值内存互不影响。结果写为JSON，便于跨提交比较:
+    python rag_benchmark.py --sizes 50,200,800 --output results/rag.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_utils import latency_summary, peak_rss_mb, write_results
+
+RESULT_MARKER = "RESULT_JSON:"
+DEFAULT_EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+COMPANIES = ["华信科技", "东方能源", "远航物流", "瑞丰银行", "新程医药", "Apex Capital", "Northwind Foods", "Helios Solar"]
+ZH_TEMPLATES = [
+    "{company}{year}年第{quarter}季度实现营业收入{revenue}亿元，同比增长{growth}%，主要受益于核心业务的持续扩张。",
+    "报告期内，{company}净利润为{profit}亿元，毛利率{margin}%，经营活动现金流保持稳定。",
+    "{company}董事会审议通过了{year}年度利润分配方案，拟每10股派发现金红利{dividend}元。",
+    "风险提示：{company}面临原材料价格波动、汇率变化以及行业竞争加剧等风险。",
+    "{company}资产负债率为{margin}%，较上年末下降{growth}个百分点，偿债能力有所增强。",
+]
+EN_TEMPLATES = [
+    "{company} reported revenue of {revenue} billion in Q{quarter} {year}, up {growth}% year over year.",
+    "Net income at {company} reached {profit} billion with a gross margin of {margin}%.",
+    "The board of {company} approved a dividend of {dividend} per share for fiscal {year}.",
+    "Key risks for {company} include commodity price volatility, currency exposure and competition.",
+]
+QUERY_TEMPLATES = [
+    "{company}的营业收入是多少？",
+    "{company}的利润分配方案",
+    "What was the net income of {company}?",
+    "{company} 风险提示",
+    "{company} gross margin {year}",
+]
+
+
+def _fill(template: str, rng: random.Random) -> str:
+    return template.format(
+        company=rng.choice(COMPANIES),
+        year=rng.randint(2018, 2024),
+        quarter=rng.randint(1, 4),
+        revenue=round(rng.uniform(1, 500), 2),
+        growth=round(rng.uniform(-20, 40), 1),
+        profit=round(rng.uniform(0.1, 80), 2),
+        margin=round(rng.uniform(10, 70), 1),
+        dividend=round(rng.uniform(0.1, 5), 2),
+    )
+
+
+def generate_corpus(directory: str, num_documents: int, paragraphs: int = 12, seed: int = 42) -> int:
+    """
+    在目录下生成合成语料，每个文档由若干中英文段落组成
+    :return: 语料总字节数
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    total_bytes = 0
+    for i in range(num_documents):
+        lines = []
+        for _ in range(paragraphs):
+            templates = ZH_TEMPLATES if rng.random() < 0.7 else EN_TEMPLATES
+            lines.append("".join(_fill(rng.choice(templates), rng) for _ in range(rng.randint(2, 5))))
+        data = "\n\n".join(lines).encode("utf-8")
+        with open(os.path.join(directory, f"report_{i:05d}.txt"), "wb") as f:
+            f.write(data)
+        total_bytes += len(data)
+    return total_bytes
+
+
+def generate_queries(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    return [_fill(rng.choice(QUERY_TEMPLATES), rng) for _ in range(count)]
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def _new_bot(workdir: str):
+    from LLMRAG import LangChainChatBot
+    return LangChainChatBot(
+        api_key="bench-key",
+        model_name="bench-model",
+        model_configs={"answer_cache": False},
+        base_url="http://127.0.0.1:9/v1",
+        embedding_model_path=os.path.join(workdir, "model"),
+    )
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def run_size(num_documents: int, args) -> dict:
+    """在当前进程中对一个语料规模做完整测试"""
+    from langchain_community.vectorstores import FAISS
+    from metadata_index import MetadataIndex
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    try:
+        corpus_dir = os.path.join(workdir, "corpus")
+        store_dir = os.path.join(workdir, "store")
+        corpus_bytes = generate_corpus(corpus_dir, num_documents, seed=args.seed)
+        bot = _new_bot(workdir)
+        stages = {}
+
+        # 读取
+        paths = sorted(os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir))
+        documents, elapsed = _timed(lambda: [bot._load_text_document(p) for p in paths])
+        stages["load"] = {"seconds": elapsed, "mb_per_second": corpus_bytes / 1024 / 1024 / elapsed}
+
+        # 分割
+        chunks, elapsed = _timed(bot._split_documents, documents, args.chunk_size, args.chunk_overlap)
+        stages["split"] = {"seconds": elapsed, "chunks": len(chunks), "chunks_per_second": len(chunks) / elapsed}
+
+        # 嵌入（模型加载单独计时）
+        embeddings, model_load = _timed(bot._load_embeddings, args.embedding_model)
+        texts = [doc.page_content for doc in chunks]
+        vectors, elapsed = _timed(embeddings.embed_documents, texts)
+        stages["embed"] = {"seconds": elapsed, "model_load_seconds": model_load,
+                           "chunks_per_second": len(texts) / elapsed}
+
+        # 建索引：FAISS向量索引 + 倒排索引 + 检索器
+        def build_index():
+            bot.documents = chunks
+            vector_store = FAISS.from_embeddings(
+                list(zip(texts, vectors)), embeddings, metadatas=[doc.metadata for doc in chunks]
+            )
+            bot._publish_snapshot(vector_store, bot._build_lexical_index(vector_store), MetadataIndex.build(vector_store))
+        _, elapsed = _timed(build_index)
+        stages["index"] = {"seconds": elapsed, "chunks_per_second": len(texts) / elapsed}
+
+        # 保存
+        bot.embedding_model_info = {"model_name": args.embedding_model, "saved_path": bot.embedding_model_path}
+        _, save_seconds = _timed(bot.save_vector_store, store_dir)
+        docstore = _docstore_stats(bot.vector_store, args.seed)
+
+        # 检索延迟
+        queries = generate_queries(args.queries, seed=args.seed)
+        snapshot = bot.index_snapshot
+        for query in queries[:5]:
+            snapshot.retriever.get_relevant_documents(query)  # 预热
+        retrieval = {}
+        for k in args.ks:
+            bot.retrieval_k = k
+            retriever = bot._build_retriever(snapshot.vector_store, snapshot.lexical_index, snapshot.metadata_index)
+            hybrid, dense = [], []
+            for query in queries:
+                _, elapsed = _timed(retriever.get_relevant_documents, query)
+                hybrid.append(elapsed * 1000)
+                _, elapsed = _timed(bot.vector_store.similarity_search, query, k=k)
+                dense.append(elapsed * 1000)
+            retrieval[f"k={k}"] = {
+                "hybrid_ms": {key: latency_summary(hybrid)[key] for key in ("p50", "p99", "mean")},
+                "dense_ms": {key: latency_summary(dense)[key] for key in ("p50", "p99", "mean")},
+            }
+
+        return {
+            "documents": num_documents,
+            "corpus_mb": corpus_bytes / 1024 / 1024,
+            "chunks": len(chunks),
+            "stages": stages,
+            "build_seconds": sum(stage["seconds"] for stage in stages.values()),
+            "save_seconds": save_seconds,
+            "disk_mb": directory_size(store_dir) / 1024 / 1024,
+            "docstore": docstore,
+            "cold_load": _cold_load(store_dir),
+            "peak_rss_mb": peak_rss_mb(),
+            "retrieval": retrieval,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _docstore_stats(vector_store, seed: int, fetches: int = 1000) -> dict:
+    """文本块存储的压缩统计，以及随机按ID读取的延迟"""
+    docstore = vector_store.docstore
+    if not hasattr(docstore, "stats"):
+        return {"compressed": False}
+    ids = list(vector_store.index_to_docstore_id.values())
+    rng = random.Random(seed)
+    latencies = []
+    for doc_id in (rng.choice(ids) for _ in range(fetches)):
+        _, elapsed = _timed(docstore.search, doc_id)
+        latencies.append(elapsed * 1e6)
+    summary = latency_summary(latencies)
+    return {**docstore.stats(), "fetch_us": {key: summary[key] for key in ("p50", "p99", "mean")}}
+
+
+def _cold_load(store_dir: str) -> dict:
+    """在新进程中加载向量库，得到不受当前进程缓存影响的冷启动耗时"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--cold_load", store_dir],
+        capture_output=True, text=True, cwd=os.path.dirname(store_dir)
+    )
+    return _parse_result(output)
+
+
+def cold_load(store_dir: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix="rag-cold-")
+    try:
+        bot = _new_bot(workdir)
+        message, elapsed = _timed(bot.load_vector_store, store_dir)
+        if message.startswith("加载向量存储失败"):
+            return {"error": message}
+        return {"seconds": elapsed, "peak_rss_mb": peak_rss_mb()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _parse_result(output: subprocess.CompletedProcess) -> dict:
+    for line in reversed(output.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    return {"error": (output.stderr or output.stdout)[-2000:]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG建库与检索基准测试")
+    parser.add_argument("--sizes", default="50,200,800", help="语料规模（文档数），逗号分隔")
+    parser.add_argument("--ks", default="1,4,8,16", help="检索数量，逗号分隔")
+    parser.add_argument("--queries", type=int, default=100, help="每个k的检索次数")
+    parser.add_argument("--chunk_size", type=int, default=500, help="分块大小（token数）")
+    parser.add_argument("--chunk_overlap", type=int, default=100, help="分块重叠大小（token数）")
+    parser.add_argument("--embedding_model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="结果JSON文件路径")
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--cold_load", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.ks = [int(k) for k in str(args.ks).split(",")]
+
+    # 子进程模式：结果以标记行输出，供父进程解析
+    if args.cold_load:
+        print(RESULT_MARKER + json.dumps(cold_load(args.cold_load)))
+        return
+    if args.worker is not None:
+        print(RESULT_MARKER + json.dumps(run_size(args.worker, args), ensure_ascii=False))
+        return
+
+    results = {"config": {key: value for key, value in vars(args).items()
+                          if key not in ("output", "worker", "cold_load")},
+               "python": sys.version.split()[0], "sizes": []}
+    for size in [int(s) for s in args.sizes.split(",")]:
+        print(f"测试语料规模: {size} 个文档...")
+        command = [sys.executable, os.path.abspath(__file__), "--worker", str(size),
+                   "--ks", ",".join(map(str, args.ks)), "--queries", str(args.queries),
+                   "--chunk_size", str(args.chunk_size), "--chunk_overlap", str(args.chunk_overlap),
+                   "--embedding_model", args.embedding_model, "--seed", str(args.seed)]
+        results["sizes"].append(_parse_result(subprocess.run(command, capture_output=True, text=True)))
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
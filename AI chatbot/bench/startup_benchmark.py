@@ -0,0 +1,125 @@
+"""
+启动开销基准测试：普通对话（不启用RAG）从进程启动到发出第一个提示词的耗时和常驻内存
+
+每次测量在新的子进程中进行。eager 模式先导入原先位于 LLMRAG.py 顶部的重量级依赖，
+模拟延迟导入之前的启动方式；lazy 模式直接导入 LLMRAG，对比两者即可看到改进:
+    python startup_benchmark.py --repeats 5 --output results/startup.json
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_utils import current_rss_mb, write_results
+
+RESULT_MARKER = "RESULT_JSON:"
+# 延迟导入之前 LLMRAG.py 在模块顶部导入的重量级依赖
+EAGER_MODULES = [
+    "torch",
+    "transformers",
+    "langchain.chains",
+    "langchain.text_splitter",
+    "langchain_community.embeddings",
+    "langchain_community.document_loaders",
+    "langchain_community.vectorstores",
+    "numpy",
+]
+# 用于检查启动后实际加载了哪些重量级模块
+HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "faiss", "numpy",
+                 "langchain.chains", "langchain_community.vectorstores"]
+
+
+def measure(mode: str) -> dict:
+    """在当前进程中测量一次启动过程"""
+    from stub_server import StubConfig, start_stub_server
+
+    server, _ = start_stub_server(StubConfig(latency=0.0, tokens_per_second=0, response_tokens=8))
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    baseline_rss = current_rss_mb()
+    started = time.perf_counter()
+
+    if mode == "eager":
+        for name in EAGER_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+    import LLMRAG
+    imported = time.perf_counter()
+
+    bot = LLMRAG.LangChainChatBot(
+        api_key="bench-key",
+        model_name="bench-model",
+        base_url=base_url,
+        memory_type="buffer",
+        embedding_model_path=os.path.join(tempfile.mkdtemp(prefix="startup-bench-"), "model"),
+    )
+    initialized = time.perf_counter()
+
+    bot._prepare_prompt("你好，请介绍一下你自己。", bot.index_snapshot, bot)
+    first_prompt = time.perf_counter()
+    bot.generate_response("你好，请介绍一下你自己。")
+    first_response = time.perf_counter()
+
+    return {
+        "import_seconds": imported - started,
+        "init_seconds": initialized - imported,
+        "time_to_first_prompt": first_prompt - started,
+        "time_to_first_response": first_response - started,
+        "rss_mb": current_rss_mb() - baseline_rss,
+        "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def run_child(mode: str) -> dict:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode],
+                            capture_output=True, text=True)
+    for line in reversed(output.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    return {"error": (output.stderr or output.stdout)[-2000:]}
+
+
+def summarize(runs: list) -> dict:
+    ok = [run for run in runs if "error" not in run]
+    if not ok:
+        return {"errors": [run["error"] for run in runs]}
+    keys = ["import_seconds", "init_seconds", "time_to_first_prompt", "time_to_first_response", "rss_mb"]
+    return {
+        **{key: statistics.median(run[key] for run in ok) for key in keys},
+        "heavy_modules_loaded": ok[0]["heavy_modules_loaded"],
+        "runs": len(ok),
+        "errors": len(runs) - len(ok),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="普通对话的启动开销基准测试")
+    parser.add_argument("--repeats", type=int, default=3, help="每种模式的测量次数，取中位数")
+    parser.add_argument("--output", default=None, help="结果JSON文件路径")
+    parser.add_argument("--child", choices=["eager", "lazy"], default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(RESULT_MARKER + json.dumps(measure(args.child)))
+        return
+
+    results = {}
+    for mode in ("eager", "lazy"):
+        print(f"测量 {mode} 模式...")
+        results[mode] = summarize([run_child(mode) for _ in range(args.repeats)])
+    if "time_to_first_prompt" in results["eager"] and "time_to_first_prompt" in results["lazy"]:
+        results["improvement"] = {
+            "time_to_first_prompt_seconds": results["eager"]["time_to_first_prompt"] - results["lazy"]["time_to_first_prompt"],
+            "rss_mb": results["eager"]["rss_mb"] - results["lazy"]["rss_mb"],
+        }
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+离线压测用的 OpenAI 兼容桩服务
+
+- POST /v1/chat/completions（及 /chat/completions）：支持流式和非流式，
+  可配置首字延迟、每秒生成token数，以及按比例注入429/500错误
+- POST /api/chat_responses：代替数据库后端接收对话记录
+- GET  /stats：请求计数
+
+用法: python stub_server.py --port 9100 --latency 0.3 --tokens_per_second 50 --error_429 0.05
+然后将机器人的 base_url 设为 http://127.0.0.1:9100/v1，db_url 设为 http://127.0.0.1:9100
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+# 模拟回答使用的片段，每个片段视为一个token
+REPLY_TOKENS = ["根据", "提供", "的", "资料", "，", "该", "公司", "本期", "营业", "收入", "同比", "增长",
+                "，", "净利润", "保持", "稳定", "。", " The", " report", " shows", " steady", " growth", "."]
+
+
+class StubConfig:
+    def __init__(self,
+                 latency: float = 0.2,
+                 tokens_per_second: float = 50.0,
+                 response_tokens: int = 60,
+                 error_429: float = 0.0,
+                 error_500: float = 0.0,
+                 seed: int = None):
+        """
+        :param latency: 首个token前的延迟（秒）
+        :param tokens_per_second: 生成速度
+        :param response_tokens: 每个回答的token数
+        :param error_429: 返回429的比例
+        :param error_500: 返回500的比例
+        :param seed: 随机种子
+        """
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.random = random.Random(seed)
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "chat_requests": 0, "stream_requests": 0, "errors_429": 0, "errors_500": 0,
+            "completion_tokens": 0, "db_requests": 0, "db_records": 0, "connections": 0,
+        }
+
+    def add(self, key: str, value: int = 1):
+        with self.lock:
+            self.counters[key] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.counters)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 以支持 keep-alive，便于观察客户端连接复用
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = None
+    stats: StubStats = None
+
+    def setup(self):
+        super().setup()
+        self.stats.add("connections")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, status: int, data: Dict[str, Any], headers: Dict[str, str] = None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.stats.snapshot())
+        elif self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "stub-model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        data = self._read_json()
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat_completions(data)
+        elif self.path == "/api/chat_responses":
+            self.stats.add("db_requests")
+            self.stats.add("db_records")
+            self._send_json(201, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _chat_completions(self, data: Dict[str, Any]):
+        config = self.config
+        stream = bool(data.get("stream"))
+        self.stats.add("stream_requests" if stream else "chat_requests")
+
+        roll = config.random.random()
+        if roll < config.error_429:
+            self.stats.add("errors_429")
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error", "code": "429"}},
+                            headers={"Retry-After": "0.5"})
+            return
+        if roll < config.error_429 + config.error_500:
+            self.stats.add("errors_500")
+            self._send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+            return
+
+        model = data.get("model", "stub-model")
+        max_tokens = data.get("max_tokens") or config.response_tokens
+        count = min(config.response_tokens, max_tokens)
+        tokens = [REPLY_TOKENS[i % len(REPLY_TOKENS)] for i in range(count)]
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in data.get("messages", [])) // 2
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        interval = 1.0 / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+        self.stats.add("completion_tokens", count)
+
+        time.sleep(config.latency)
+        if not stream:
+            time.sleep(interval * count)
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": count,
+                          "total_tokens": prompt_tokens + count},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta: Dict[str, Any], finish_reason=None) -> bytes:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        self._write_chunk(event({"role": "assistant", "content": ""}))
+        for token in tokens:
+            time.sleep(interval)
+            self._write_chunk(event({"content": token}))
+        self._write_chunk(event({}, finish_reason="stop"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+def start_stub_server(config: StubConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """
+    在后台线程中启动桩服务
+    :param port: 端口，0表示自动分配
+    :return: (server, stats)，server.server_address 为实际监听地址
+    """
+    stats = StubStats()
+    handler = type("Handler", (StubHandler,), {"config": config or StubConfig(), "stats": stats})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的离线桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="首个token前的延迟（秒）")
+    parser.add_argument("--tokens_per_second", type=float, default=50.0)
+    parser.add_argument("--response_tokens", type=int, default=60)
+    parser.add_argument("--error_429", type=float, default=0.0, help="返回429的比例")
+    parser.add_argument("--error_500", type=float, default=0.0, help="返回500的比例")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.tokens_per_second, args.response_tokens,
+                        args.error_429, args.error_500, args.seed)
+    server, _ = start_stub_server(config, args.host, args.port)
+    print(f"桩服务已启动: http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import json
+import os
+import threading
+import time
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.docstore.document import Document
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib 预设字典的上限
+_ZLIB_DICT_SIZE = 32 * 1024
+
+
+class CompressedChunkStore(Docstore, AddableMixin):
+    """
+    压缩的文本块存储，可直接作为FAISS向量存储的docstore使用
+
+    每个文本块的正文和元数据单独压缩，按ID随机读取时只解压这一个文本块；
+    压缩使用在语料上训练的字典（安装了 zstandard 时用zstd训练字典，否则用zlib预设字典），
+    单个文本块很短也能利用语料中的重复内容。保存为 chunk_store.bin / chunk_store.json / chunk_store.dict，
+    加载时不需要反序列化全部文本
+    """
+
+    DATA_FILE = "chunk_store.bin"
+    INDEX_FILE = "chunk_store.json"
+    DICT_FILE = "chunk_store.dict"
+
+    def __init__(self, dictionary: bytes = b"", codec: Optional[str] = None, level: int = 3):
+        """
+        :param dictionary: 压缩字典，可用 train_dictionary 训练
+        :param codec: "zstd" 或 "zlib"，默认安装了 zstandard 时使用zstd
+        :param level: 压缩级别
+        """
+        self.codec = codec or ("zstd" if zstandard is not None else "zlib")
+        if self.codec == "zstd" and zstandard is None:
+            raise ImportError("使用zstd压缩需要安装 zstandard")
+        self.dictionary = dictionary
+        self.level = level
+        self._data = bytearray()
+        self._offsets = array("Q")
+        self._lengths = array("I")
+        # 压缩前的字节数，用于统计压缩比
+        self._raw_lengths = array("I")
+        self._ids: Dict[str, int] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.counters = {"fetches": 0, "decompress_seconds": 0.0}
+        if self.codec == "zstd":
+            self._zstd_dict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._compressor = zstandard.ZstdCompressor(level=level, dict_data=self._zstd_dict)
+
+    # ---- 字典训练 ----
+
+    @staticmethod
+    def _encode(doc: Document) -> bytes:
+        return json.dumps({"t": doc.page_content, "m": doc.metadata}, ensure_ascii=False, default=str).encode("utf-8")
+
+    @classmethod
+    def train_dictionary(cls, documents: List[Document], codec: Optional[str] = None,
+                         dict_size: int = 112 * 1024, max_samples: int = 5000) -> bytes:
+        """
+        在语料上训练压缩字典
+        :param documents: 文本块列表，均匀抽取其中最多 max_samples 个作为样本
+        :param codec: "zstd" 或 "zlib"
+        :param dict_size: zstd 字典大小（字节），zlib 字典固定不超过32KB
+        :return: 字典内容，样本太少无法训练时返回空字节串
+        """
+        codec = codec or ("zstd" if zstandard is not None else "zlib")
+        step = max(1, len(documents) // max_samples)
+        samples = [cls._encode(doc) for doc in documents[::step]]
+        if not samples:
+            return b""
+        if codec == "zstd":
+            try:
+                return zstandard.train_dictionary(dict_size, samples).as_bytes()
+            except zstandard.ZstdError:
+                # 样本不足时不使用字典
+                return b""
+        # zlib 预设字典：越靠后的内容匹配距离越近，把样本拼接后取末尾
+        return b"".join(samples)[-_ZLIB_DICT_SIZE:]
+
+    @classmethod
+    def from_documents(cls, documents: Dict[str, Document], codec: Optional[str] = None) -> "CompressedChunkStore":
+        """用文本块训练字典并创建存储"""
+        codec = codec or ("zstd" if zstandard is not None else "zlib")
+        store = cls(cls.train_dictionary(list(documents.values()), codec), codec)
+        store.add(documents)
+        return store
+
+    # ---- 压缩与解压 ----
+
+    def _compress(self, raw: bytes) -> bytes:
+        if self.codec == "zstd":
+            return self._compressor.compress(raw)
+        level = min(self.level, 9)
+        compressor = zlib.compressobj(level, zdict=self.dictionary) if self.dictionary else zlib.compressobj(level)
+        return compressor.compress(raw) + compressor.flush()
+
+    def _decompress(self, blob: bytes) -> bytes:
+        if self.codec == "zstd":
+            # zstd 解压器不能在线程间共享，每个线程各用一个
+            decompressor = getattr(self._local, "decompressor", None)
+            if decompressor is None:
+                decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict)
+                self._local.decompressor = decompressor
+            return decompressor.decompress(blob)
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        return decompressor.decompress(blob) + decompressor.flush()
+
+    # ---- Docstore 接口 ----
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._ids
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        """添加文本块，已存在的ID报错（与 InMemoryDocstore 一致）"""
+        overlapping = set(texts).intersection(self._ids)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self.update(texts)
+
+    def update(self, texts: Dict[str, Document]) -> None:
+        """添加或覆盖文本块，覆盖时旧的压缩数据在下次保存时清理"""
+        encoded = [(doc_id, self._encode(doc)) for doc_id, doc in texts.items()]
+        blobs = [(doc_id, raw, self._compress(raw)) for doc_id, raw in encoded]
+        with self._lock:
+            for doc_id, raw, blob in blobs:
+                self._ids[doc_id] = len(self._offsets)
+                self._offsets.append(len(self._data))
+                self._lengths.append(len(blob))
+                self._raw_lengths.append(len(raw))
+                self._data += blob
+
+    def copy(self) -> "CompressedChunkStore":
+        """复制存储，之后对副本的写入不影响本存储；直接复制压缩后的字节，不重新压缩"""
+        store = type(self)(self.dictionary, self.codec, self.level)
+        with self._lock:
+            store._data = bytearray(self._data)
+            store._offsets = array("Q", self._offsets)
+            store._lengths = array("I", self._lengths)
+            store._raw_lengths = array("I", self._raw_lengths)
+            store._ids = dict(self._ids)
+        return store
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            for doc_id in ids:
+                self._ids.pop(doc_id, None)
+
+    def _read(self, slot: int) -> bytes:
+        offset = self._offsets[slot]
+        return self._decompress(bytes(self._data[offset:offset + self._lengths[slot]]))
+
+    def search(self, search: str) -> Union[str, Document]:
+        slot = self._ids.get(search)
+        if slot is None:
+            return f"ID {search} not found."
+        started = time.perf_counter()
+        record = json.loads(self._read(slot))
+        self.counters["fetches"] += 1
+        self.counters["decompress_seconds"] += time.perf_counter() - started
+        return Document(page_content=record["t"], metadata=record["m"])
+
+    def items(self) -> Iterable:
+        """按写入顺序遍历 (ID, 文本块)"""
+        for doc_id in list(self._ids):
+            document = self.search(doc_id)
+            if isinstance(document, Document):
+                yield doc_id, document
+
+    # ---- 统计 ----
+
+    def stats(self) -> Dict[str, Any]:
+        """压缩前后的大小和单次读取的平均解压耗时"""
+        slots = list(self._ids.values())
+        live = sum(self._lengths[slot] for slot in slots)
+        raw = sum(self._raw_lengths[slot] for slot in slots)
+        fetches = self.counters["fetches"]
+        return {
+            "codec": self.codec,
+            "chunks": len(slots),
+            "dictionary_bytes": len(self.dictionary),
+            "raw_bytes": raw,
+            "compressed_bytes": live,
+            "buffer_bytes": len(self._data),
+            "compression_ratio": raw / live if live else 0.0,
+            "fetches": fetches,
+            "mean_fetch_us": self.counters["decompress_seconds"] * 1e6 / fetches if fetches else 0.0,
+        }
+
+    # ---- 持久化 ----
+
+    def save(self, path: str):
+        """保存到目录 path 下，只写入仍然存在的文本块"""
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            slots = list(self._ids.items())
+            data = self._data
+        offsets, lengths, raw_lengths = [], [], []
+        with open(os.path.join(path, self.DATA_FILE), "wb") as f:
+            position = 0
+            for _, slot in slots:
+                offset, length = self._offsets[slot], self._lengths[slot]
+                f.write(data[offset:offset + length])
+                offsets.append(position)
+                lengths.append(length)
+                raw_lengths.append(self._raw_lengths[slot])
+                position += length
+        with open(os.path.join(path, self.DICT_FILE), "wb") as f:
+            f.write(self.dictionary)
+        with open(os.path.join(path, self.INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "codec": self.codec,
+                "level": self.level,
+                "ids": [doc_id for doc_id, _ in slots],
+                "offsets": offsets,
+                "lengths": lengths,
+                "raw_lengths": raw_lengths,
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["CompressedChunkStore"]:
+        """从目录 path 加载，不存在时返回None；压缩数据整体读入内存，读取文本块时才解压"""
+        index_path = os.path.join(path, cls.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        with open(os.path.join(path, cls.DICT_FILE), "rb") as f:
+            dictionary = f.read()
+        store = cls(dictionary, index["codec"], index.get("level", 3))
+        with open(os.path.join(path, cls.DATA_FILE), "rb") as f:
+            store._data = bytearray(f.read())
+        store._offsets = array("Q", index["offsets"])
+        store._lengths = array("I", index["lengths"])
+        store._raw_lengths = array("I", index["raw_lengths"])
+        store._ids = {doc_id: slot for slot, doc_id in enumerate(index["ids"])}
+        return store
+
+
+def save_faiss(vector_store, path: str, compress: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    保存FAISS向量存储。compress 为True时文本块写入压缩块存储，index.pkl 中只保存ID映射；
+    向量存储仍在使用 InMemoryDocstore 时先转换为压缩存储（同时减少内存占用）
+    :return: 压缩块存储的统计信息，未压缩时返回None
+    """
+    if not compress:
+        vector_store.save_local(path)
+        return None
+    store = compress_docstore(vector_store)
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    # 用共享同一索引、但docstore为空的浅副本保存，不改动正在被查询的向量存储
+    FAISS(
+        embedding_function=vector_store.embedding_function,
+        index=vector_store.index,
+        docstore=InMemoryDocstore({}),
+        index_to_docstore_id=vector_store.index_to_docstore_id,
+    ).save_local(path)
+    store.save(path)
+    return store.stats()
+
+
+def compress_docstore(vector_store) -> CompressedChunkStore:
+    """把向量存储的docstore替换为压缩块存储（已经是压缩存储时直接返回）"""
+    docstore = vector_store.docstore
+    if isinstance(docstore, CompressedChunkStore):
+        return docstore
+    started = time.perf_counter()
+    store = CompressedChunkStore.from_documents(dict(docstore._dict))
+    # 替换引用是原子的，并发查询看到的要么是旧存储要么是内容相同的新存储
+    vector_store.docstore = store
+    stats = store.stats()
+    print(f"文本块存储已压缩（{stats['codec']}，字典 {stats['dictionary_bytes'] / 1024:.0f} KB）："
+          f"{stats['raw_bytes'] / 1024 / 1024:.2f} MB -> {stats['compressed_bytes'] / 1024 / 1024:.2f} MB，"
+          f"压缩比 {stats['compression_ratio']:.1f}，耗时 {time.perf_counter() - started:.2f} 秒")
+    return store
+
+
+def copy_faiss(vector_store):
+    """
+    复制FAISS向量存储，增量入库时在副本上写入，写完后整体切换，正在查询原向量存储的请求不受影响；
+    向量按内存复制，docstore 只复制文本块的引用（压缩存储复制压缩后的字节），不重新嵌入
+    """
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    docstore = vector_store.docstore
+    if isinstance(docstore, CompressedChunkStore):
+        docstore = docstore.copy()
+    else:
+        docstore = InMemoryDocstore(dict(docstore._dict))
+    return FAISS(
+        embedding_function=vector_store.embedding_function,
+        index=faiss.clone_index(vector_store.index),
+        docstore=docstore,
+        index_to_docstore_id=dict(vector_store.index_to_docstore_id),
+        relevance_score_fn=vector_store.override_relevance_score_fn,
+        normalize_L2=vector_store._normalize_L2,
+        distance_strategy=vector_store.distance_strategy,
+    )
+
+
+def replace_documents(docstore, documents: Dict[str, Document]):
+    """覆盖docstore中已有的文本块（InMemoryDocstore 的 add 不允许覆盖已有ID）"""
+    if isinstance(docstore, CompressedChunkStore):
+        docstore.update(documents)
+    else:
+        docstore._dict.update(documents)
+
+
+def load_faiss(path: str, embeddings):
+    """加载FAISS向量存储，目录中有压缩块存储时用它作为docstore"""
+    from langchain_community.vectorstores import FAISS
+    vector_store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    store = CompressedChunkStore.load(path)
+    if store is not None:
+        vector_store.docstore = store
+    return vector_store
+
+
+def docstore_text_bytes(docstore) -> int:
+    """docstore中文本占用的内存估算：压缩存储按压缩后大小，InMemoryDocstore 按文本字节数"""
+    if isinstance(docstore, CompressedChunkStore):
+        return len(docstore._data) + len(docstore.dictionary)
+    return sum(len(doc.page_content.encode("utf-8")) for doc in docstore._dict.values())
@@ -0,0 +1,173 @@
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain.docstore.document import Document
+
+_CJK_CHAR = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    估算文本的token数：安装了tiktoken时精确计数，
+    否则按中文字符每字1个token、其余字符每4个字符1个token估算
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _shingles(text: str, n: int = 5) -> set:
+    text = re.sub(r"\s+", "", text)
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _text_overlap(first: str, second: str, max_overlap: int) -> int:
+    """返回 first 的后缀与 second 的前缀重合的最大长度"""
+    for size in range(min(len(first), len(second), max_overlap), 0, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+
+class _Passage:
+    """上下文中的一段文本，可能由同一来源的多个相邻文本块合并而成"""
+
+    def __init__(self, doc: Document, rank: int):
+        self.text = doc.page_content
+        self.metadata = dict(doc.metadata)
+        self.source = doc.metadata.get("source")
+        # PDF和OCR文档的 start_index/end_index 是页内偏移，只有同一页的文本块才能按偏移合并
+        self.page = doc.metadata.get("page")
+        self.start = doc.metadata.get("start_index")
+        self.end = doc.metadata.get("end_index")
+        if self.end is None and self.start is not None:
+            self.end = self.start + len(self.text)
+        self.rank = rank
+        self.members = 1
+
+    def try_merge(self, other: "_Passage", max_text_overlap: int) -> bool:
+        """若 other 与本段来自同一来源的同一页且相邻或重叠，则合并进来"""
+        if self.source is None or self.source != other.source or self.page != other.page:
+            return False
+        if self.start is not None and other.start is not None:
+            # 按原文偏移合并
+            if other.start > self.end or self.start > other.end:
+                return False
+            first, second = (self, other) if self.start <= other.start else (other, self)
+            if second.end > first.end:
+                self.text = first.text + second.text[first.end - second.start:]
+            else:
+                self.text = first.text
+            self.start, self.end = first.start, max(first.end, second.end)
+            self.metadata["start_index"] = self.start
+            self.metadata["end_index"] = self.end
+        else:
+            # 没有偏移信息时按文本首尾重合判断
+            overlap = _text_overlap(self.text, other.text, max_text_overlap)
+            if overlap:
+                self.text = self.text + other.text[overlap:]
+            else:
+                overlap = _text_overlap(other.text, self.text, max_text_overlap)
+                if not overlap:
+                    return False
+                self.text = other.text + self.text[overlap:]
+        self.rank = min(self.rank, other.rank)
+        self.members += other.members
+        return True
+
+
+class ContextBuilder:
+    """
+    按token预算组装RAG上下文：合并同一来源的相邻/重叠文本块，去除近似重复段落，
+    再按检索排名依次填入，直到达到预算
+    """
+
+    def __init__(self,
+                 max_tokens: int = 2000,
+                 dedup_threshold: float = 0.85,
+                 max_text_overlap: int = 400,
+                 separator: str = "\n\n"):
+        """
+        :param max_tokens: 上下文token预算
+        :param dedup_threshold: 近似重复判定阈值（字符5-gram的Jaccard相似度）
+        :param max_text_overlap: 无偏移信息时检测文本首尾重合的最大长度
+        :param separator: 段落之间的分隔符
+        """
+        self.max_tokens = max_tokens
+        self.dedup_threshold = dedup_threshold
+        self.max_text_overlap = max_text_overlap
+        self.separator = separator
+
+    def _merge(self, docs: Sequence[Document]) -> Tuple[List[_Passage], int]:
+        passages: List[_Passage] = []
+        merged = 0
+        for rank, doc in enumerate(docs):
+            passage = _Passage(doc, rank)
+            # 合并后的段落可能与更早的段落相连，反复合并直到不再变化
+            changed = True
+            while changed:
+                changed = False
+                for existing in passages:
+                    if existing.try_merge(passage, self.max_text_overlap):
+                        passages.remove(existing)
+                        passage = existing
+                        merged += 1
+                        changed = True
+                        break
+            passages.append(passage)
+        passages.sort(key=lambda p: p.rank)
+        return passages, merged
+
+    def build(self, docs: Sequence[Document], max_tokens: Optional[int] = None) -> Tuple[str, List[Document], Dict[str, Any]]:
+        """
+        组装上下文
+        :param docs: 按相关性降序排列的检索结果
+        :param max_tokens: 本次使用的token预算，默认使用构造时的设置
+        :return: (上下文文本, 实际使用的段落, 统计信息)
+        """
+        budget = max_tokens or self.max_tokens
+        passages, merged = self._merge(docs)
+
+        selected: List[_Passage] = []
+        selected_shingles: List[set] = []
+        deduplicated = 0
+        used_tokens = 0
+        separator_tokens = count_tokens(self.separator)
+        for passage in passages:
+            shingles = _shingles(passage.text)
+            if any(len(shingles & other) / len(shingles | other) >= self.dedup_threshold for other in selected_shingles):
+                deduplicated += 1
+                continue
+            tokens = count_tokens(passage.text) + (separator_tokens if selected else 0)
+            if used_tokens + tokens > budget:
+                if selected:
+                    # 放不下则跳过，尝试排名靠后但更短的段落
+                    continue
+                # 排名第一的段落单独超出预算时截断
+                while passage.text and count_tokens(passage.text) > budget:
+                    passage.text = passage.text[:int(len(passage.text) * budget / count_tokens(passage.text)) - 1]
+                tokens = count_tokens(passage.text)
+            selected.append(passage)
+            selected_shingles.append(shingles)
+            used_tokens += tokens
+
+        context = self.separator.join(p.text for p in selected)
+        used_docs = [Document(page_content=p.text, metadata=p.metadata) for p in selected]
+        stats = {
+            "retrieved_chunks": len(docs),
+            "merged_chunks": merged,
+            "deduplicated_passages": deduplicated,
+            "context_passages": len(selected),
+            "context_tokens": used_tokens,
+            "token_budget": budget,
+        }
+        return context, used_docs, stats
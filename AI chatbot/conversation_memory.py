@@ -0,0 +1,134 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema import SystemMessage, get_buffer_string
+
+from context_builder import count_tokens
+from llm_scheduler import get_scheduler
+
+SUMMARY_PROMPT = """逐步总结下面的对话，在已有摘要的基础上补充新的内容，返回新的摘要。
+摘要需要保留用户关心的公司、数字、结论和尚未解决的问题，使用对话所用的语言。
+
+已有摘要：
+{summary}
+
+新的对话：
+{new_lines}
+
+新的摘要："""
+
+# 所有会话共享的后台摘要线程池
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+
+
+class HybridSummaryMemory(BaseChatMemory):
+    """
+    混合对话记忆：最近 max_turns 轮对话在token预算内原样保留，更早的对话在后台线程中
+    合并进摘要。读取和写入记忆都不会调用LLM，摘要的生成不在用户请求的关键路径上
+    """
+    llm: Any
+    max_turns: int = 6
+    max_token_limit: int = 1500
+    memory_key: str = "history"
+    return_messages: bool = True
+    summary: str = ""
+    # 已移出窗口、尚未并入摘要的消息
+    pending: List[Any] = []
+    # 正在由后台任务并入摘要的消息
+    folding: List[Any] = []
+    # lock 只保护上面的状态，持有时间很短；fold_lock 保证后台摘要任务按顺序执行
+    lock: Any = None
+    fold_lock: Any = None
+    # clear 时递增，清空前开始的摘要任务不再写回结果
+    generation: int = 0
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("lock", threading.Lock())
+        kwargs.setdefault("fold_lock", threading.Lock())
+        kwargs.setdefault("pending", [])
+        kwargs.setdefault("folding", [])
+        super().__init__(**kwargs)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            summary = self.summary
+            # 尚未并入摘要的消息仍然原样提供，摘要完成前不会从上下文中消失
+            messages = self.folding + self.pending
+        messages = messages + list(self.chat_memory.messages)
+        if summary:
+            messages.insert(0, SystemMessage(content=f"之前对话的摘要：{summary}"))
+        if self.return_messages:
+            return {self.memory_key: messages}
+        return {self.memory_key: get_buffer_string(messages)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        self._trim()
+
+    def _trim(self):
+        """将超出轮数或token预算的最早对话移出窗口，并提交后台摘要任务"""
+        messages = self.chat_memory.messages
+        evicted = []
+        while len(messages) > 2 and (
+            len(messages) > self.max_turns * 2
+            or sum(count_tokens(m.content) for m in messages) > self.max_token_limit
+        ):
+            # 每次移出一轮（用户消息和AI回复）
+            evicted.extend(messages[:2])
+            del messages[:2]
+        if evicted:
+            with self.lock:
+                self.pending.extend(evicted)
+            _summary_executor.submit(self._fold_pending)
+
+    def _fold_pending(self):
+        """
+        后台任务：将待摘要的消息按顺序并入摘要
+
+        LLM调用期间不持有 self.lock，写入记忆（_trim）和读取记忆都不会等待摘要完成
+        """
+        with self.fold_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                messages, self.pending = self.pending, []
+                self.folding = messages
+                summary, generation = self.summary, self.generation
+            try:
+                prompt = SUMMARY_PROMPT.format(summary=summary or "无", new_lines=get_buffer_string(messages))
+                # 摘要走低优先级的批量通道，不与交互式对话争抢
+                result = get_scheduler().run(lambda: self.llm.invoke(prompt), priority="bulk")
+                with self.lock:
+                    if generation == self.generation:
+                        self.summary = result.content.strip()
+                        self.folding = []
+            except Exception as e:
+                # 摘要失败时放回队列，下次移出对话时一并重试
+                print(f"后台生成对话摘要失败: {str(e)}")
+                with self.lock:
+                    if generation == self.generation:
+                        self.pending = messages + self.pending
+                        self.folding = []
+
+    def wait_for_summary(self, timeout: float = 30) -> bool:
+        """等待当前的后台摘要任务完成，返回是否已无待摘要消息"""
+        future = _summary_executor.submit(self._fold_pending)
+        future.result(timeout=timeout)
+        return not self.pending
+
+    def clear(self) -> None:
+        super().clear()
+        with self.lock:
+            self.summary = ""
+            self.pending = []
+            self.folding = []
+            self.generation += 1
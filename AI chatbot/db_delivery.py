@@ -0,0 +1,225 @@
+import atexit
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from http_transport import get_http_client
+
+# 默认的溢出文件放在本模块所在目录，与进程的启动目录无关
+DEFAULT_SPILL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_spill.jsonl")
+
+
+class DatabaseDeliveryQueue:
+    """
+    后台批量发送对话记录到数据库后端
+
+    - 有界队列，submit 永不阻塞对话流程，队列满时直接写入本地溢出文件
+    - 后台线程在客户端攒批，一批记录通过进程内共享的 keep-alive HTTP客户端在同一连接上逐条发送
+      （数据库后端只有单条接口 /api/chat_responses）
+    - 发送失败时按指数退避重试，只重试尚未成功的记录，仍失败则写入本地溢出文件，后端恢复后自动补发
+    - 每个请求带 Idempotency-Key，重复提交可由后端去重
+    """
+
+    def __init__(self,
+                 db_url: str,
+                 db_token: Optional[str] = None,
+                 max_queue_size: int = 1000,
+                 batch_size: int = 20,
+                 flush_interval: float = 1.0,
+                 max_retries: int = 3,
+                 backoff_base: float = 0.5,
+                 timeout: float = 10,
+                 spill_path: Optional[str] = None):
+        """
+        :param db_url: 数据库后端URL
+        :param db_token: 数据库后端认证令牌
+        :param max_queue_size: 内存队列最大长度
+        :param batch_size: 每批最多发送的记录数
+        :param flush_interval: 攒批最长等待时间（秒）
+        :param max_retries: 单批最大重试次数
+        :param backoff_base: 退避基础时间（秒）
+        :param timeout: 单次HTTP请求超时时间（秒）
+        :param spill_path: 后端不可用时的本地溢出文件，默认为本模块目录下的 db_spill.jsonl
+        """
+        self.url = f"{db_url}/api/chat_responses"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.spill_path = spill_path or DEFAULT_SPILL_PATH
+
+        # 与LLM调用共用进程内的HTTP客户端（每次发送时获取），认证信息和超时随每个请求发送
+        self.headers = {"Content-Type": "application/json"}
+        if db_token:
+            self.headers["Authorization"] = f"Bearer {db_token}"
+
+        self.stats = {"submitted": 0, "sent": 0, "spilled": 0, "replayed": 0, "retries": 0, "batches": 0}
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._spill_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="db-delivery", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """
+        提交一条记录，立即返回
+        :param record: 对话记录
+        :return: 进入内存队列返回True，队列已满被写入溢出文件返回False
+        """
+        self._count("submitted")
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self._spill([record])
+            return False
+
+    def pending(self) -> int:
+        """内存队列中等待发送的记录数"""
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = 10) -> bool:
+        """
+        等待队列中的记录发送完毕
+        :param timeout: 最长等待时间（秒）
+        :return: 是否在超时前清空
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self._queue.unfinished_tasks == 0
+
+    def close(self, timeout: float = 10):
+        """发送剩余记录并停止后台线程"""
+        if self._closed.is_set():
+            return
+        self.flush(timeout)
+        self._closed.set()
+        self._worker.join(timeout=1)
+
+    def _count(self, name: str, value: int = 1):
+        """submit 在对话线程中调用，其余计数在后台线程中更新"""
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        """取出一批记录：最多 batch_size 条，最多等待 flush_interval 秒"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                remaining = self._deliver(batch)
+                self._count("sent", len(batch) - len(remaining))
+                if remaining:
+                    self._spill(remaining)
+                else:
+                    self._replay_spill()
+            except Exception as e:
+                print(f"后台发送对话记录时发生错误: {str(e)}")
+                self._spill(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @staticmethod
+    def _idempotency_key(records: List[Dict[str, Any]]) -> str:
+        """由记录内容计算幂等键，重试和从溢出文件补发时保持不变"""
+        digest = hashlib.sha1()
+        for record in records:
+            digest.update(json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _post(self, pending: List[Dict[str, Any]]) -> bool:
+        """
+        在同一连接上逐条发送 pending 中的记录，发送成功的记录从 pending 中移除；
+        服务器错误抛出异常以触发重试，重试时只发送剩余的记录
+        :return: 后端拒绝记录（非重试类错误）时返回False
+        """
+        client = get_http_client()
+        while pending:
+            record = pending[0]
+            headers = {**self.headers, "Idempotency-Key": self._idempotency_key([record])}
+            resp = client.post(self.url, content=json.dumps(record), headers=headers, timeout=self.timeout)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                resp.raise_for_status()
+            if resp.status_code not in (200, 201):
+                return False
+            del pending[0]
+        return True
+
+    def _deliver(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        带指数退避重试地发送一批记录
+        :return: 最终未能发送的记录，全部成功时为空列表
+        """
+        pending = list(batch)
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._count("batches")
+                if not self._post(pending):
+                    print(f"数据库后端拒绝了 {len(pending)} 条记录")
+                return pending
+            except (httpx.HTTPError, OSError) as e:
+                if attempt == self.max_retries or self._closed.is_set():
+                    print(f"发送到数据库后端失败，已重试 {attempt} 次: {str(e)}")
+                    return pending
+                self._count("retries")
+                delay = self.backoff_base * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+        return pending
+
+    def _spill(self, records: List[Dict[str, Any]]):
+        """将记录追加写入本地溢出文件"""
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._count("spilled", len(records))
+        print(f"数据库后端不可用，{len(records)} 条记录已写入本地文件: {self.spill_path}")
+
+    def _replay_spill(self):
+        """后端恢复后补发溢出文件中的记录"""
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            replay_path = self.spill_path + ".replay"
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        os.remove(replay_path)
+
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            remaining = self._deliver(batch)
+            self._count("replayed", len(batch) - len(remaining))
+            if remaining:
+                # 后端再次不可用，剩余记录写回溢出文件等待下次补发
+                self._spill(remaining + records[start + self.batch_size:])
+                break
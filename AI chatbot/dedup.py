@@ -0,0 +1,166 @@
+import hashlib
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+_WHITESPACE = re.compile(r"\s+")
+# 数字（含小数点和千分位），只有数字完全相同的文本块才可能是近似重复
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+# 字符n-gram滚动哈希的乘数
+_SHINGLE_BASE = np.uint64(1099511628211)
+
+
+def normalize(text: str) -> str:
+    """去掉空白并转为小写，排版不同但内容相同的文本块视为完全重复"""
+    return _WHITESPACE.sub("", text).lower()
+
+
+class MinHashDeduplicator:
+    """
+    文本块去重：规范化文本的哈希相同视为完全重复；否则按字符n-gram计算MinHash签名，
+    通过局部敏感哈希分桶找到候选，签名估算的Jaccard相似度不低于阈值、且其中的数字完全相同时视为近似重复。
+    按模板生成的报表段落（如各年度的营收说明）往往只有数字不同，它们包含不同的信息，不能合并
+
+    重复的文本块不再嵌入和入库，只在保留的规范副本的 metadata["sources"] 中记录它出现过的来源。
+    规范副本按docstore ID登记，向量存储不被替换时可以在多次增量入库之间复用
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 5, seed: int = 1):
+        """
+        :param threshold: 近似重复的Jaccard相似度阈值
+        :param num_perm: MinHash签名长度
+        :param bands: 局部敏感哈希的分段数，num_perm 需能被其整除
+        :param shingle_size: 字符n-gram长度
+        :param seed: 哈希函数的随机种子，同一种子的签名可以互相比较
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm 必须能被 bands 整除")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # 乘-移位哈希族：(a * x + b) mod 2^64，a 取奇数
+        self._a = rng.randint(1, 2 ** 62, size=num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.randint(0, 2 ** 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+        # 规范化文本哈希 -> 规范副本ID
+        self._exact: Dict[str, str] = {}
+        # (分段序号, 分段签名) -> 规范副本序号列表
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._canonical: List[str] = []
+        self._signatures: List[np.ndarray] = []
+        # 规范副本中按顺序出现的数字
+        self._numbers: List[str] = []
+
+    def __len__(self):
+        return len(self._canonical)
+
+    def signature(self, text: str) -> np.ndarray:
+        """计算规范化文本的MinHash签名"""
+        codes = np.frombuffer(normalize(text).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        n = min(self.shingle_size, len(codes))
+        if n == 0:
+            return np.zeros(self.num_perm, dtype=np.uint64)
+        # 向量化计算所有n-gram的滚动哈希，uint64 溢出即按 2^64 取模
+        count = len(codes) - n + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for offset in range(n):
+            shingles = shingles * _SHINGLE_BASE + codes[offset:offset + count]
+        shingles = np.unique(shingles)
+        return (self._a[:, None] * shingles[None, :] + self._b[:, None]).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    @staticmethod
+    def numbers(text: str) -> str:
+        """规范化文本中按顺序出现的全部数字"""
+        return "|".join(_NUMBER.findall(normalize(text)))
+
+    def _register(self, doc_id: str, digest: str, signature: np.ndarray, numbers: str):
+        self._exact[digest] = doc_id
+        position = len(self._canonical)
+        self._canonical.append(doc_id)
+        self._signatures.append(signature)
+        self._numbers.append(numbers)
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(position)
+
+    def _near_duplicate(self, signature: np.ndarray, numbers: str) -> Optional[str]:
+        best, best_similarity = None, self.threshold
+        seen = set()
+        for key in self._band_keys(signature):
+            for position in self._buckets.get(key, ()):
+                if position in seen:
+                    continue
+                seen.add(position)
+                if self._numbers[position] != numbers:
+                    continue
+                similarity = float(np.mean(self._signatures[position] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = self._canonical[position], similarity
+        return best
+
+    def seed(self, ids: Sequence[str], texts: Sequence[str]):
+        """登记已经入库的文本块，之后新文本块与它们重复时合并进这些已有文档"""
+        for doc_id, text in zip(ids, texts):
+            digest = _digest(text)
+            if digest not in self._exact:
+                self._register(doc_id, digest, self.signature(text), self.numbers(text))
+
+    def deduplicate(self, documents: Sequence[Document], ids: Sequence[str]):
+        """
+        去除完全重复和近似重复的文本块，不重复的文本块按给定ID登记为规范副本
+        :param documents: 待入库的文本块
+        :param ids: 文本块入库时使用的docstore ID
+        :return: (需要嵌入的文本块, 它们的ID, {规范副本ID: 与之重复的文本块列表}, 统计信息)
+        """
+        unique, unique_ids = [], []
+        duplicates: Dict[str, List[Document]] = {}
+        stats = {"chunks_in": len(documents), "exact_duplicates": 0, "near_duplicates": 0, "chars_removed": 0}
+        for doc, doc_id in zip(documents, ids):
+            digest = _digest(doc.page_content)
+            canonical = self._exact.get(digest)
+            signature = numbers = None
+            if canonical is not None:
+                stats["exact_duplicates"] += 1
+            else:
+                signature = self.signature(doc.page_content)
+                numbers = self.numbers(doc.page_content)
+                canonical = self._near_duplicate(signature, numbers)
+                if canonical is not None:
+                    stats["near_duplicates"] += 1
+            if canonical is None:
+                self._register(doc_id, digest, signature, numbers)
+                unique.append(doc)
+                unique_ids.append(doc_id)
+            else:
+                duplicates.setdefault(canonical, []).append(doc)
+                stats["chars_removed"] += len(doc.page_content)
+        stats["chunks_out"] = len(unique)
+        removed = stats["chunks_in"] - len(unique)
+        stats["removed_ratio"] = removed / stats["chunks_in"] if stats["chunks_in"] else 0.0
+        return unique, unique_ids, duplicates, stats
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(normalize(text).encode("utf-8")).hexdigest()
+
+
+def merge_sources(canonical: Document, duplicates: Iterable[Document]):
+    """
+    在规范副本的 metadata["sources"] 中记录重复文本块的来源，上传时间取最晚的一次，
+    从docstore重建元数据索引时与增量合并的结果一致
+    """
+    sources = canonical.metadata.setdefault("sources", [canonical.metadata.get("source")])
+    for doc in duplicates:
+        source = doc.metadata.get("source")
+        if source not in sources:
+            sources.append(source)
+        upload_time = doc.metadata.get("upload_time")
+        if upload_time is not None and upload_time > (canonical.metadata.get("upload_time") or 0):
+            canonical.metadata["upload_time"] = upload_time
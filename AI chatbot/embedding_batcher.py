@@ -0,0 +1,140 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+from langchain.embeddings.base import Embeddings
+
+
+class _QueryRequest:
+    __slots__ = ("text", "enqueued", "event", "result", "error")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    查询向量微批处理：并发会话各自的 embed_query 请求在一个很短的时间窗口内汇集，
+    由后台线程合并为一次 embed_documents 批量前向计算，再把结果分别返回给调用方；
+    批次已包含所有正在等待的调用方时立即计算，单个调用方不会为等待窗口付出延迟
+
+    文档向量（embed_documents）本身已是批量计算，直接交给底层模型
+    """
+
+    def __init__(self, embeddings: Embeddings, window_ms: float = 5.0, max_batch_size: int = 32):
+        """
+        :param embeddings: 底层嵌入模型，如 HuggingFaceEmbeddings
+        :param window_ms: 从批次中第一个请求到达起最多等待的毫秒数，为0时不做批处理
+        :param max_batch_size: 单个批次的最大请求数
+        """
+        self.embeddings = embeddings
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue: "queue.Queue[_QueryRequest]" = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # 正在 embed_query 中等待结果的调用方数量
+        self._callers = 0
+        # 最近请求的排队等待时间和批次大小，用于统计分位数
+        self._waits = deque(maxlen=2000)
+        self._batch_sizes = deque(maxlen=2000)
+        self.counters = {"requests": 0, "batches": 0, "deduplicated": 0, "errors": 0, "forward_seconds": 0.0}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.window <= 0:
+            return self.embeddings.embed_query(text)
+        request = _QueryRequest(text)
+        self._ensure_worker()
+        with self._lock:
+            self._callers += 1
+        try:
+            self._queue.put(request)
+            request.event.wait()
+        finally:
+            with self._lock:
+                self._callers -= 1
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_query, text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_documents, texts)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0].enqueued + self.window
+            while len(batch) < min(self.max_batch_size, self._callers):
+                remaining = deadline - time.monotonic()
+                try:
+                    # 窗口已过时仍取走已经排队的请求，但不再等待
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch: List[_QueryRequest]):
+        started = time.monotonic()
+        # 同一批次中相同的问题只计算一次
+        texts = list(dict.fromkeys(request.text for request in batch))
+        try:
+            vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+            for request in batch:
+                request.result = vectors[request.text]
+        except Exception as e:
+            print(f"批量计算查询向量失败: {str(e)}")
+            for request in batch:
+                request.error = e
+        finished = time.monotonic()
+        with self._lock:
+            self.counters["requests"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["deduplicated"] += len(batch) - len(texts)
+            self.counters["forward_seconds"] += finished - started
+            if batch[0].error is not None:
+                self.counters["errors"] += 1
+            self._batch_sizes.append(len(batch))
+            self._waits.extend(started - request.enqueued for request in batch)
+        for request in batch:
+            request.event.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        """返回批次大小、排队等待时间和前向计算耗时统计"""
+        with self._lock:
+            waits = sorted(self._waits)
+            sizes = list(self._batch_sizes)
+            counters = dict(self.counters)
+
+        def wait_ms(q: float) -> float:
+            return waits[min(len(waits) - 1, int(len(waits) * q))] * 1000 if waits else 0.0
+
+        batches = counters["batches"]
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self._queue.qsize(),
+            **counters,
+            "mean_batch_size": counters["requests"] / batches if batches else 0.0,
+            "recent_max_batch_size": max(sizes) if sizes else 0,
+            "mean_forward_ms": counters["forward_seconds"] * 1000 / batches if batches else 0.0,
+            "queue_wait_ms": {"p50": wait_ms(0.5), "p95": wait_ms(0.95), "max": wait_ms(1.0)},
+        }
@@ -0,0 +1,128 @@
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+# 进程内的所有出站HTTP请求（LLM调用和发送到数据库后端的对话记录）共用一个同步和一个异步连接池
+# LLM请求的连接超时较短，读取超时覆盖长回答的生成时间；发送对话记录时按请求传入更短的超时
+LLM_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+# 空闲连接保留60秒，连续对话之间不需要重新握手
+LLM_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+# (api_key, base_url) -> OpenAI 客户端
+_openai_clients: Dict[Tuple[str, str], Any] = {}
+
+
+class ConnectionStats:
+    """统计一个HTTP客户端发出的请求数和新建的TCP连接、TLS握手次数，请求数减去新建连接数即复用连接的请求数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+
+    def _count(self, event_name: str):
+        with self._lock:
+            if event_name == "request":
+                self.requests += 1
+            elif event_name == "connection.connect_tcp.complete":
+                self.connections += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+    # httpx 在发送前调用请求钩子，通过 trace 扩展接收连接池的建连事件
+    def on_request(self, request: httpx.Request):
+        self._count("request")
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name: str, info: Dict[str, Any]):
+        self._count(event_name)
+
+    async def aon_request(self, request: httpx.Request):
+        self._count("request")
+        request.extensions["trace"] = self._atrace
+
+    async def _atrace(self, event_name: str, info: Dict[str, Any]):
+        self._count(event_name)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            reused = max(0, self.requests - self.connections)
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_requests": reused,
+                "reuse_ratio": reused / self.requests if self.requests else 0.0,
+            }
+
+
+_stats = {"sync": ConnectionStats(), "async": ConnectionStats()}
+
+
+def get_http_client() -> httpx.Client:
+    """获取进程内共享的同步HTTP客户端，所有机器人的LLM调用和对话记录发送复用同一个保活连接池"""
+    global _http_client
+    with _lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = httpx.Client(
+                timeout=LLM_TIMEOUT,
+                limits=LLM_LIMITS,
+                event_hooks={"request": [_stats["sync"].on_request]}
+            )
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    获取进程内共享的异步HTTP客户端，异步的LLM调用和对话记录发送复用同一个连接池
+
+    连接池绑定在首次使用它的事件循环上，同一进程内的所有异步对话应运行在同一个事件循环中
+    """
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None or _async_http_client.is_closed:
+            _async_http_client = httpx.AsyncClient(
+                timeout=LLM_TIMEOUT,
+                limits=LLM_LIMITS,
+                event_hooks={"request": [_stats["async"].aon_request]}
+            )
+        return _async_http_client
+
+
+def get_openai_client(api_key: str, base_url: str):
+    """按API密钥和地址缓存 OpenAI 客户端，底层使用共享的HTTP客户端"""
+    key = (api_key, base_url)
+    client = _openai_clients.get(key)
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client())
+        _openai_clients[key] = client
+    return client
+
+
+def transport_stats() -> Dict[str, Any]:
+    """同步和异步共享客户端的请求数、新建连接数和连接复用率"""
+    return {name: counter.snapshot() for name, counter in _stats.items()}
+
+
+def close():
+    """关闭共享的同步HTTP客户端（异步客户端需在事件循环中用 aclose 关闭）"""
+    global _http_client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+        _openai_clients.clear()
+
+
+async def aclose():
+    """关闭共享的异步HTTP客户端"""
+    global _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
@@ -0,0 +1,240 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 数字中的千分位逗号，如 1,234,567
+_THOUSANDS_SEP = re.compile(r"(?<=\d),(?=\d{3})")
+# 英文/数字词元，允许内部带 . 或 -，如 600519.sh、2023-12-31、v1.2
+_ASCII_TOKEN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+# 中日韩统一表意文字
+_CJK_RUN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+# 股票代码、账号、金额等需要精确匹配的词元
+_IDENTIFIER = re.compile(r"^(?=.*\d)[a-z0-9.\-]{3,}$")
+# 含数字但不是标识符的词元：年份、日期、小数、短数字（几乎每个财务问题都带年份，不能按标识符精确匹配）
+_NOT_IDENTIFIER = re.compile(
+    r"^(?:(?:19|20)\d{2}(?:[.\-]\d{1,2}){0,2}"
+    r"|\d+\.\d+"
+    r"|[1-9]\d{0,3})$"
+)
+# 全大写的英文股票代码，如 AAPL、BABA
+_TICKER = re.compile(r"(?<![A-Za-z])[A-Z]{2,6}(?![A-Za-z])")
+# 财务问题中常见的大写缩写和交易所后缀，不是股票代码
+COMMON_ACRONYMS = frozenset({
+    "SH", "SZ", "SS", "HK", "BJ", "NYSE", "NASDAQ",
+    "CEO", "CFO", "COO", "CTO", "GDP", "CPI", "PPI", "PMI", "ROE", "ROA", "ROI", "ROIC", "EPS", "PE", "PB",
+    "PS", "IPO", "ETF", "ESG", "USD", "RMB", "CNY", "HKD", "EUR", "JPY", "GBP", "YOY", "QOQ", "MOM", "YTD",
+    "EBIT", "EBITDA", "NAV", "AUM", "FY", "US", "USA", "UK", "EU", "AI", "API", "PDF", "FAQ", "OK", "CAGR",
+    "LPR", "MLF", "IT", "HR", "PR", "QA", "VS", "NO", "TTM", "DCF", "WACC", "CAPEX", "OPEX", "FCF",
+})
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    将文本切分为检索词元：英文和数字按词切分，中文按字符二元组切分，无需分词器
+    :param text: 原始文本
+    :return: 词元列表（保留重复，用于词频统计）
+    """
+    text = _THOUSANDS_SEP.sub("", text.lower())
+    tokens = []
+    for match in _ASCII_TOKEN.finditer(text):
+        token = match.group()
+        tokens.append(token)
+        # 复合词元同时索引其组成部分，使 600519 能匹配 600519.sh
+        if "." in token or "-" in token:
+            tokens.extend(part for part in re.split(r"[.\-]", token) if part)
+    for match in _CJK_RUN.finditer(text):
+        run = match.group()
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def identifier_terms(query: str) -> List[str]:
+    """
+    提取查询中需要精确匹配的标识符：含数字的代码、账号、数额，以及大写股票代码；
+    年份、日期、小数、四位以内的数字和 CEO、GDP 等常见缩写不算标识符
+    """
+    terms = [token for token in tokenize(query) if _IDENTIFIER.match(token) and not _NOT_IDENTIFIER.match(token)]
+    terms.extend(ticker.lower() for ticker in _TICKER.findall(query) if ticker not in COMMON_ACRONYMS)
+    return list(dict.fromkeys(terms))
+
+
+def reciprocal_rank_fusion(result_lists: Iterable[Sequence[str]], k: int = 60,
+                           weights: Optional[Sequence[float]] = None) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合：合并多路检索的排序结果
+    :param result_lists: 多个按相关性降序排列的文档ID列表
+    :param k: 平滑常数
+    :param weights: 各路结果的权重，默认均为1
+    :return: 按融合分数降序排列的 (文档ID, 分数) 列表
+    """
+    scores: Dict[str, float] = {}
+    for index, results in enumerate(result_lists):
+        weight = weights[index] if weights is not None else 1.0
+        for rank, doc_id in enumerate(results):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """
+    基于字符n-gram的倒排索引，支持BM25打分和精确关键词查找
+
+    写入时对倒排列表写时复制：被修改的倒排列表整体替换为新字典，不在并发检索正在遍历的字典上原地修改
+    """
+
+    FILE_NAME = "lexical_index.json"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # 词元 -> {文档ID: 词频}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # 文档ID -> 文档长度（词元数）
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @property
+    def avg_doc_len(self) -> float:
+        return self.total_len / len(self.doc_len) if self.doc_len else 0.0
+
+    def copy(self) -> "LexicalIndex":
+        """浅拷贝，与原索引共享倒排列表；由于写时复制，修改副本不影响原索引"""
+        index = LexicalIndex(k1=self.k1, b=self.b)
+        index.postings = dict(self.postings)
+        index.doc_len = dict(self.doc_len)
+        index.total_len = self.total_len
+        return index
+
+    def add_documents(self, ids: Sequence[str], texts: Sequence[str]):
+        """
+        增量添加文档，已存在的ID会先被移除再重新索引
+        :param ids: 文档ID列表（与向量存储的docstore ID一致）
+        :param texts: 文档文本列表
+        """
+        existing = [doc_id for doc_id in ids if doc_id in self.doc_len]
+        if existing:
+            self.delete(existing)
+        updates: Dict[str, Dict[str, int]] = {}
+        lengths: Dict[str, int] = {}
+        for doc_id, text in zip(ids, texts):
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                updates.setdefault(term, {})[doc_id] = tf
+            lengths[doc_id] = sum(counts.values())
+        # 先登记文档长度，再发布倒排列表，检索看到新文档时总能查到其长度
+        self.doc_len.update(lengths)
+        self.total_len += sum(lengths.values())
+        for term, entries in updates.items():
+            posting = self.postings.get(term)
+            self.postings[term] = {**posting, **entries} if posting else entries
+
+    def delete(self, ids: Iterable[str]):
+        """从索引中移除文档"""
+        ids = set(ids) & self.doc_len.keys()
+        if not ids:
+            return
+        for term in list(self.postings):
+            posting = self.postings[term]
+            if ids.isdisjoint(posting):
+                continue
+            remaining = {doc_id: tf for doc_id, tf in posting.items() if doc_id not in ids}
+            if remaining:
+                self.postings[term] = remaining
+            else:
+                del self.postings[term]
+        for doc_id in ids:
+            self.total_len -= self.doc_len.pop(doc_id)
+
+    def _idf(self, term: str) -> float:
+        df = len(self.postings.get(term, ()))
+        n = len(self.doc_len)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _score(self, terms: Sequence[str], candidates: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        avg_len = self.avg_doc_len or 1.0
+        candidates = set(candidates) if candidates is not None else None
+        scores: Dict[str, float] = {}
+        for term, qtf in Counter(terms).items():
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self._idf(term)
+            for doc_id, tf in posting.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                length = self.doc_len.get(doc_id)
+                if length is None:
+                    # 并发删除中的文档
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * length / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + qtf * idf * tf * (self.k1 + 1) / norm
+        return scores
+
+    def search(self, query: str, k: int = 4, candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        BM25检索
+        :param query: 查询文本
+        :param k: 返回结果数
+        :param candidates: 可选的候选文档ID集合，只在其中打分
+        :return: 按分数降序排列的 (文档ID, 分数) 列表
+        """
+        scores = self._score(tokenize(query), candidates)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def keyword_lookup(self, terms: Sequence[str], k: int = 4,
+                       candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        精确关键词查找：返回包含全部关键词的文档，按BM25排序，不涉及向量计算
+        :param terms: 关键词列表（应已经过 tokenize 规范化）
+        :param k: 返回结果数
+        :param candidates: 可选的候选文档ID集合，只在其中查找
+        :return: 按分数降序排列的 (文档ID, 分数) 列表
+        """
+        if not terms:
+            return []
+        # 从最稀有的词开始求交集，尽早缩小候选集
+        postings = sorted((self.postings.get(term, {}) for term in set(terms)), key=len)
+        found = set(postings[0]) if candidates is None else set(candidates) & postings[0].keys()
+        for posting in postings[1:]:
+            if not found:
+                break
+            found &= posting.keys()
+        if not found:
+            return []
+        scores = self._score(terms, found)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, path: str):
+        """将索引保存到目录 path 下"""
+        os.makedirs(path, exist_ok=True)
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "doc_len": self.doc_len,
+            "postings": self.postings,
+        }
+        with open(os.path.join(path, self.FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """从目录 path 加载索引，不存在时返回None"""
+        file_path = os.path.join(path, cls.FILE_NAME)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        index.doc_len = data["doc_len"]
+        index.postings = data["postings"]
+        index.total_len = sum(index.doc_len.values())
+        return index
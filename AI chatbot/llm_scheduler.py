@@ -0,0 +1,341 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# 优先级通道，数值越小越优先：交互式对话优先于批量摘要等后台任务
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 个请求，允许 capacity 个请求的突发"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预订一个令牌，返回需要等待的秒数（令牌可以透支，由等待时间补偿）"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_retryable(error: Exception) -> bool:
+    """429、5xx、超时和连接错误可以重试"""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    """
+    LLM请求调度器：全局和单会话并发上限、令牌桶限速、按优先级通道排队，
+    遇到429/5xx时按带抖动的指数退避重试，并统计排队深度等指标
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 8,
+                 per_session_concurrency: int = 2,
+                 requests_per_second: float = 5.0,
+                 burst: int = 10,
+                 max_retries: int = 4,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 30.0):
+        """
+        :param max_concurrency: 全局同时进行的LLM请求数上限
+        :param per_session_concurrency: 单个会话同时进行的LLM请求数上限
+        :param requests_per_second: 平均每秒发出的请求数
+        :param burst: 允许的突发请求数
+        :param max_retries: 可重试错误的最大重试次数
+        :param backoff_base: 退避基础时间（秒）
+        :param backoff_max: 单次退避的最长时间（秒）
+        """
+        self.max_concurrency = max_concurrency
+        self.per_session_concurrency = per_session_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(requests_per_second, burst)
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []  # [(优先级, 序号, 会话ID)]
+        self._in_flight = 0
+        self._session_in_flight: Dict[str, int] = {}
+        # 异步等待者：票据 -> (事件循环, 唤醒用的future)，槽位释放时在各自的事件循环上唤醒
+        self._async_waiters: Dict[Tuple, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        # 计数器在 _cond 的锁内更新，多个线程同时完成请求时不会丢失计数
+        self.counters = {
+            "submitted": 0, "completed": 0, "failed": 0, "retries": 0,
+            "rate_limited": 0, "server_errors": 0, "throttle_wait_seconds": 0.0,
+        }
+
+    # ---------- 准入控制 ----------
+
+    def _eligible(self, session_id: Optional[str]) -> bool:
+        if self._in_flight >= self.max_concurrency:
+            return False
+        return session_id is None or self._session_in_flight.get(session_id, 0) < self.per_session_concurrency
+
+    def _try_acquire_locked(self, ticket) -> bool:
+        """ticket 是所有可立即执行的等待者中优先级最高、排队最早的一个时占用槽位"""
+        if not self._eligible(ticket[2]):
+            return False
+        best = min((t for t in self._waiting if self._eligible(t[2])), default=None)
+        if best != ticket:
+            return False
+        self._waiting.remove(ticket)
+        self._in_flight += 1
+        if ticket[2] is not None:
+            self._session_in_flight[ticket[2]] = self._session_in_flight.get(ticket[2], 0) + 1
+        # 可能还有空闲槽位，唤醒其余等待者重新检查
+        self._notify_locked()
+        return True
+
+    def _notify_locked(self):
+        """唤醒所有同步和异步等待者重新检查能否占用槽位，调用时需持有 _cond"""
+        self._cond.notify_all()
+        for loop, future in self._async_waiters.values():
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # 事件循环已关闭，等待它的协程不会再运行
+                pass
+        self._async_waiters.clear()
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+    def _count(self, name: str, value: float = 1):
+        with self._cond:
+            self.counters[name] += value
+
+    def _new_ticket(self, priority: str, session_id: Optional[str]):
+        ticket = (PRIORITIES.get(priority, 0), next(self._seq), session_id)
+        with self._cond:
+            self._waiting.append(ticket)
+            self.counters["submitted"] += 1
+        return ticket
+
+    def _acquire(self, priority: str, session_id: Optional[str]):
+        ticket = self._new_ticket(priority, session_id)
+        with self._cond:
+            while not self._try_acquire_locked(ticket):
+                self._cond.wait()
+
+    async def _aacquire(self, priority: str, session_id: Optional[str]):
+        ticket = self._new_ticket(priority, session_id)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                with self._cond:
+                    if self._try_acquire_locked(ticket):
+                        return
+                    # 在锁内登记唤醒future，释放锁后到等待前发生的释放也不会错过
+                    wakeup = loop.create_future()
+                    self._async_waiters[ticket] = (loop, wakeup)
+                await wakeup
+        except asyncio.CancelledError:
+            with self._cond:
+                self._async_waiters.pop(ticket, None)
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                self._notify_locked()
+            raise
+
+    def _release(self, session_id: Optional[str]):
+        with self._cond:
+            self._in_flight -= 1
+            if session_id is not None:
+                count = self._session_in_flight.get(session_id, 1) - 1
+                if count:
+                    self._session_in_flight[session_id] = count
+                else:
+                    self._session_in_flight.pop(session_id, None)
+            self._notify_locked()
+
+    def _throttle_delay(self) -> float:
+        delay = self.bucket.reserve()
+        self._count("throttle_wait_seconds", delay)
+        return delay
+
+    def _backoff_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """返回重试前的等待时间，不应重试时返回None"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        status = _status_code(error)
+        if status == 429:
+            self._count("rate_limited")
+        elif status is not None and status >= 500:
+            self._count("server_errors")
+        self._count("retries")
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # 完全抖动的指数退避
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # ---------- 同步接口 ----------
+
+    def run(self, fn: Callable[[], Any], priority: str = "interactive", session_id: Optional[str] = None) -> Any:
+        """
+        调度执行一次LLM调用
+        :param fn: 无参函数，执行实际的LLM调用
+        :param priority: "interactive" 或 "bulk"
+        :param session_id: 会话ID，用于单会话并发限制
+        :return: fn 的返回值
+        """
+        self._acquire(priority, session_id)
+        try:
+            for attempt in itertools.count():
+                time.sleep(self._throttle_delay())
+                try:
+                    result = fn()
+                    self._count("completed")
+                    return result
+                except Exception as e:
+                    delay = self._backoff_delay(e, attempt)
+                    if delay is None:
+                        self._count("failed")
+                        raise
+                    print(f"LLM请求失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {str(e)}")
+                    time.sleep(delay)
+        finally:
+            self._release(session_id)
+
+    def stream(self, fn: Callable[[], Iterator[Any]], priority: str = "interactive",
+               session_id: Optional[str] = None) -> Iterator[Any]:
+        """
+        调度执行一次流式LLM调用，整个流式过程占用一个槽位；
+        只有在产出第一个片段之前发生的错误会重试
+        """
+        self._acquire(priority, session_id)
+        try:
+            for attempt in itertools.count():
+                time.sleep(self._throttle_delay())
+                started = False
+                try:
+                    for item in fn():
+                        started = True
+                        yield item
+                    self._count("completed")
+                    return
+                except Exception as e:
+                    delay = None if started else self._backoff_delay(e, attempt)
+                    if delay is None:
+                        self._count("failed")
+                        raise
+                    print(f"LLM流式请求失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {str(e)}")
+                    time.sleep(delay)
+        finally:
+            self._release(session_id)
+
+    # ---------- 异步接口 ----------
+
+    async def arun(self, fn: Callable[[], Any], priority: str = "interactive", session_id: Optional[str] = None) -> Any:
+        """run 的异步版本，fn 为返回协程的无参函数"""
+        await self._aacquire(priority, session_id)
+        try:
+            for attempt in itertools.count():
+                await asyncio.sleep(self._throttle_delay())
+                try:
+                    result = await fn()
+                    self._count("completed")
+                    return result
+                except Exception as e:
+                    delay = self._backoff_delay(e, attempt)
+                    if delay is None:
+                        self._count("failed")
+                        raise
+                    print(f"LLM请求失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {str(e)}")
+                    await asyncio.sleep(delay)
+        finally:
+            self._release(session_id)
+
+    async def astream(self, fn: Callable[[], Any], priority: str = "interactive", session_id: Optional[str] = None):
+        """stream 的异步版本，fn 为返回异步迭代器的无参函数"""
+        await self._aacquire(priority, session_id)
+        try:
+            for attempt in itertools.count():
+                await asyncio.sleep(self._throttle_delay())
+                started = False
+                try:
+                    async for item in fn():
+                        started = True
+                        yield item
+                    self._count("completed")
+                    return
+                except Exception as e:
+                    delay = None if started else self._backoff_delay(e, attempt)
+                    if delay is None:
+                        self._count("failed")
+                        raise
+                    print(f"LLM流式请求失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {str(e)}")
+                    await asyncio.sleep(delay)
+        finally:
+            self._release(session_id)
+
+    # ---------- 指标 ----------
+
+    def metrics(self) -> Dict[str, Any]:
+        """返回当前排队深度、执行中请求数和累计计数"""
+        with self._cond:
+            queue_depth = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for priority, _, _ in self._waiting:
+                queue_depth[names.get(priority, str(priority))] += 1
+            return {
+                "queue_depth": queue_depth,
+                "in_flight": self._in_flight,
+                "active_sessions": len(self._session_in_flight),
+                **self.counters,
+            }
+
+
+_default_scheduler: Optional[LLMScheduler] = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """获取进程内共享的调度器，所有机器人实例的LLM调用都经过它"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = LLMScheduler()
+        return _default_scheduler
+
+
+def configure_scheduler(**kwargs) -> LLMScheduler:
+    """用新的参数替换进程内共享的调度器，参数同 LLMScheduler"""
+    global _default_scheduler
+    with _default_lock:
+        _default_scheduler = LLMScheduler(**kwargs)
+        return _default_scheduler
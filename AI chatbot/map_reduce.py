@@ -0,0 +1,153 @@
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+from context_builder import count_tokens
+from llm_scheduler import get_scheduler
+
+MAP_PROMPT = """下面是一篇长文档的第 {index}/{total} 部分。请只根据这一部分内容：
+1. 提取关键词，并对每个关键词做简短解释
+2. 用清晰明了的语言总结这一部分的要点，保留公司名称、关键数字和结论
+3. 列出这一部分的结构大纲
+使用文档所用的语言回答。
+
+文档内容：
+{text}"""
+
+REDUCE_PROMPT = """下面是同一篇文档按顺序分成 {total} 部分后，对各部分分别提取的关键词、要点和大纲。
+请将它们合并为对整篇文档的总结，去除重复内容，并严格按照以下格式回答：
+**关键词**：“ ”；
+**关键词解释**：“ ”；
+**文章摘要**：“ ”；
+**文章大纲**：“ ”；
+
+各部分的分析结果：
+{partials}"""
+
+COLLAPSE_PROMPT = """下面是同一篇文档中连续若干部分的分析结果，请将它们合并为一份分析，
+保留全部关键词及解释、要点和大纲结构，去除重复内容：
+
+{partials}"""
+
+
+def split_text(text: str, chunk_tokens: int = 3000) -> List[str]:
+    """
+    按段落将长文本切分为不超过 chunk_tokens 的片段，超长段落按字符硬切分
+    :param text: 原始文本
+    :param chunk_tokens: 每个片段的token上限
+    :return: 片段列表
+    """
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = count_tokens(paragraph)
+        if tokens > chunk_tokens:
+            # 按比例估算字符数切分超长段落
+            step = max(1, int(len(paragraph) * chunk_tokens / tokens))
+            pieces = [paragraph[i:i + step] for i in range(0, len(paragraph), step)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _join_partials(partials: Sequence[str], offset: int = 0) -> str:
+    return "\n\n".join(f"【第 {offset + i + 1} 部分】\n{p}" for i, p in enumerate(partials))
+
+
+def _batches(partials: List[str], reduce_tokens: int) -> List[List[str]]:
+    """将部分结果分组，每组总token数不超过 reduce_tokens"""
+    groups, current, current_tokens = [], [], 0
+    for partial in partials:
+        tokens = count_tokens(partial)
+        if current and current_tokens + tokens > reduce_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(partial)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def map_reduce_document(llm, text: str,
+                        chunk_tokens: int = 3000,
+                        max_concurrency: int = 4,
+                        reduce_tokens: int = 6000,
+                        scheduler=None) -> str:
+    """
+    对长文档做并行 map-reduce 处理：各片段并发提取关键词、要点和大纲，
+    再合并为 **关键词**/**关键词解释**/**文章摘要**/**文章大纲** 格式的总结
+    :param llm: LangChain 聊天模型
+    :param text: 文档全文
+    :param chunk_tokens: 每个片段的token上限
+    :param max_concurrency: 同时进行的LLM调用数上限
+    :param reduce_tokens: 合并阶段单次输入的token上限，超出时先分组合并
+    :param scheduler: LLM调度器，默认使用进程内共享的调度器；调用走低优先级的批量通道
+    :return: 总结文本
+    """
+    scheduler = scheduler or get_scheduler()
+    chunks = split_text(text, chunk_tokens)
+    total = len(chunks)
+    print(f"文档共分为 {total} 个片段，并发数 {max_concurrency}，开始 map 阶段...")
+
+    def invoke(prompt: str) -> str:
+        return scheduler.run(lambda: llm.invoke(prompt), priority="bulk").content.strip()
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        partials = list(executor.map(
+            invoke,
+            [MAP_PROMPT.format(index=i + 1, total=total, text=chunk) for i, chunk in enumerate(chunks)]
+        ))
+        # 部分结果过多时分组合并，直到能一次放入合并提示词
+        while len(partials) > 1 and sum(count_tokens(p) for p in partials) > reduce_tokens:
+            groups = _batches(partials, reduce_tokens)
+            if len(groups) == len(partials):
+                break
+            print(f"部分结果过长，先分 {len(groups)} 组合并...")
+            partials = list(executor.map(
+                invoke, [COLLAPSE_PROMPT.format(partials=_join_partials(g)) for g in groups]
+            ))
+
+    print("开始 reduce 阶段...")
+    return invoke(REDUCE_PROMPT.format(total=total, partials=_join_partials(partials)))
+
+
+async def amap_reduce_document(llm, text: str,
+                               chunk_tokens: int = 3000,
+                               max_concurrency: int = 4,
+                               reduce_tokens: int = 6000,
+                               scheduler=None) -> str:
+    """map_reduce_document 的异步版本，参数相同"""
+    scheduler = scheduler or get_scheduler()
+    chunks = split_text(text, chunk_tokens)
+    total = len(chunks)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def invoke(prompt: str) -> str:
+        async with semaphore:
+            result = await scheduler.arun(lambda: llm.ainvoke(prompt), priority="bulk")
+            return result.content.strip()
+
+    partials = await asyncio.gather(*[
+        invoke(MAP_PROMPT.format(index=i + 1, total=total, text=chunk)) for i, chunk in enumerate(chunks)
+    ])
+    while len(partials) > 1 and sum(count_tokens(p) for p in partials) > reduce_tokens:
+        groups = _batches(list(partials), reduce_tokens)
+        if len(groups) == len(partials):
+            break
+        partials = await asyncio.gather(*[
+            invoke(COLLAPSE_PROMPT.format(partials=_join_partials(g))) for g in groups
+        ])
+    return await invoke(REDUCE_PROMPT.format(total=total, partials=_join_partials(partials)))
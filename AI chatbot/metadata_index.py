@@ -0,0 +1,237 @@
+import json
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# 查询中提到最新上传的报告时，只在最近上传的文档中检索
+LATEST_UPLOAD = re.compile(r"最新上传|最近上传|刚上传|latest upload|most recently uploaded", re.IGNORECASE)
+
+FILTER_KEYS = ("source", "doc_type", "namespace", "uploaded_after", "uploaded_before", "latest")
+
+
+def _bitmap(positions: Iterable[int]) -> int:
+    """位置列表 -> 位图"""
+    positions = np.fromiter(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return 0
+    mask = np.zeros(int(positions.max()) + 1, dtype=bool)
+    mask[positions] = True
+    return _mask_to_bitmap(mask)
+
+
+def _mask_to_bitmap(mask: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+
+def _positions(bitmap: int, size: int) -> np.ndarray:
+    """位图 -> 升序的位置数组"""
+    if bitmap == 0 or size == 0:
+        return np.empty(0, dtype=np.int64)
+    raw = np.frombuffer(bitmap.to_bytes((size + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little")[:size]).astype(np.int64)
+
+
+def _timestamp(value) -> float:
+    """时间戳、datetime 或 ISO 格式日期字符串（如 2024-03-31）-> 时间戳"""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+def validate_filters(filters: Dict[str, Any]) -> Dict[str, Any]:
+    """检查过滤条件，不支持的字段或无法解析的时间抛出 ValueError"""
+    unknown = [key for key in filters if key not in FILTER_KEYS]
+    if unknown:
+        raise ValueError(f"不支持的过滤条件: {', '.join(unknown)}，支持: {', '.join(FILTER_KEYS)}")
+    for key in ("uploaded_after", "uploaded_before"):
+        if filters.get(key) is not None:
+            try:
+                _timestamp(filters[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"无法解析的时间: {key}={filters[key]!r}")
+    return filters
+
+
+class MetadataIndex:
+    """
+    元数据二级索引：按FAISS中的向量位置，为每个来源、文档类型和命名空间维护一个位图
+    （Python大整数，第i位对应第i个向量），并按位置记录上传时间
+
+    过滤条件先在位图上求交得到候选位置，再把候选集交给向量检索和BM25检索，
+    而不是先取top-k再过滤，因此过滤后的查询仍然返回k个结果
+    """
+
+    FILE_NAME = "metadata_index.json"
+    FIELDS = ("source", "doc_type", "namespace")
+
+    def __init__(self):
+        # 字段 -> {取值: 位图}
+        self.bitmaps: Dict[str, Dict[str, int]] = {field: {} for field in self.FIELDS}
+        # 位置 -> 上传时间
+        self.upload_times: List[float] = []
+        # 来源 -> 最近一次上传时间
+        self.source_times: Dict[str, float] = {}
+        self._times = None
+
+    def __len__(self):
+        return len(self.upload_times)
+
+    def add(self, metadatas: Iterable[Dict[str, Any]]):
+        """
+        按向量在FAISS中的顺序追加文本块的元数据
+        :param metadatas: 文本块元数据列表，顺序与写入向量存储的顺序一致
+        """
+        start = len(self.upload_times)
+        groups: Dict[str, Dict[str, List[int]]] = {field: {} for field in self.FIELDS}
+        for position, metadata in enumerate(metadatas, start):
+            for field in self.FIELDS:
+                value = metadata.get(field)
+                if value is not None:
+                    groups[field].setdefault(str(value), []).append(position)
+            upload_time = float(metadata.get("upload_time") or 0.0)
+            self.upload_times.append(upload_time)
+            # 去重后保留的文本块在 sources 中记录了它出现过的所有来源
+            for source in metadata.get("sources") or [metadata.get("source")]:
+                if source is None:
+                    continue
+                if str(source) != str(metadata.get("source")):
+                    groups["source"].setdefault(str(source), []).append(position)
+                self.source_times[str(source)] = max(upload_time, self.source_times.get(str(source), 0.0))
+        # 每个取值只做一次大整数或运算
+        for field, values in groups.items():
+            bitmaps = self.bitmaps[field]
+            for value, positions in values.items():
+                bitmaps[value] = bitmaps.get(value, 0) | _bitmap(positions)
+        self._times = None
+
+    def merge(self, duplicates: Iterable[Tuple[int, Dict[str, Any]]]):
+        """
+        新上传的文本块与已有位置上的文本块重复（去重后不再入库）时，把它的来源记到该位置，
+        并按它的上传时间更新该位置的上传时间和来源的最近上传时间，
+        重复上传的文档同样能被 latest 和 uploaded_after / uploaded_before 条件选中
+        :param duplicates: (已有文本块的位置, 重复文本块的元数据) 列表
+        """
+        groups: Dict[str, List[int]] = {}
+        for position, metadata in duplicates:
+            upload_time = float(metadata.get("upload_time") or 0.0)
+            self.upload_times[position] = max(upload_time, self.upload_times[position])
+            source = metadata.get("source")
+            if source is None:
+                continue
+            groups.setdefault(str(source), []).append(position)
+            self.source_times[str(source)] = max(upload_time, self.source_times.get(str(source), 0.0))
+        bitmaps = self.bitmaps["source"]
+        for source, positions in groups.items():
+            bitmaps[source] = bitmaps.get(source, 0) | _bitmap(positions)
+        self._times = None
+
+    def copy(self) -> "MetadataIndex":
+        """复制索引，在副本上追加不影响正在使用本索引的查询"""
+        index = type(self)()
+        index.bitmaps = {field: dict(values) for field, values in self.bitmaps.items()}
+        index.upload_times = list(self.upload_times)
+        index.source_times = dict(self.source_times)
+        return index
+
+    @classmethod
+    def build(cls, vector_store) -> "MetadataIndex":
+        """按位置顺序读取向量存储中全部文本块的元数据构建索引"""
+        index = cls()
+        id_map = vector_store.index_to_docstore_id
+        metadatas = []
+        for position in range(len(id_map)):
+            doc = vector_store.docstore.search(id_map[position])
+            metadatas.append(getattr(doc, "metadata", None) or {})
+        index.add(metadatas)
+        return index
+
+    def _lookup(self, field: str, value) -> int:
+        bitmaps = self.bitmaps[field]
+        if field == "source":
+            # 来源既可以是完整路径也可以只是文件名
+            value = str(value)
+            bitmap = 0
+            for source, source_bitmap in bitmaps.items():
+                if source == value or os.path.basename(source) == value:
+                    bitmap |= source_bitmap
+            return bitmap
+        return bitmaps.get(str(value), 0)
+
+    def has_source(self, source: str) -> bool:
+        """来源（完整路径）是否有文本块在索引中，包括去重时合并进其他文本块的来源"""
+        return self.bitmaps["source"].get(str(source), 0) != 0
+
+    def latest_source(self) -> Optional[str]:
+        """最近上传的来源"""
+        if not self.source_times:
+            return None
+        return max(self.source_times, key=self.source_times.get)
+
+    def bitmap(self, filters: Dict[str, Any]) -> int:
+        """
+        计算满足全部过滤条件的位置位图
+        :param filters: source / doc_type / namespace 可以是单个值或列表（列表内为或关系），
+                        uploaded_after / uploaded_before 为时间戳或日期字符串，latest 为True时只保留最近上传的来源
+        """
+        validate_filters(filters)
+        size = len(self)
+        result = (1 << size) - 1
+        for field in self.FIELDS:
+            value = filters.get(field)
+            if value is None:
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            matched = 0
+            for item in values:
+                matched |= self._lookup(field, item)
+            result &= matched
+        if filters.get("latest"):
+            latest = self.latest_source()
+            result &= self._lookup("source", latest) if latest is not None else 0
+        after, before = filters.get("uploaded_after"), filters.get("uploaded_before")
+        if after is not None or before is not None:
+            if self._times is None:
+                self._times = np.asarray(self.upload_times, dtype=np.float64)
+            mask = np.ones(size, dtype=bool)
+            if after is not None:
+                mask &= self._times >= _timestamp(after)
+            if before is not None:
+                mask &= self._times <= _timestamp(before)
+            result &= _mask_to_bitmap(mask)
+        return result
+
+    def select(self, filters: Dict[str, Any]) -> np.ndarray:
+        """满足过滤条件的向量位置（升序）"""
+        return _positions(self.bitmap(filters), len(self))
+
+    def save(self, path: str):
+        """将索引保存到目录 path 下"""
+        os.makedirs(path, exist_ok=True)
+        data = {
+            "bitmaps": {field: {value: format(bitmap, "x") for value, bitmap in values.items()}
+                        for field, values in self.bitmaps.items()},
+            "upload_times": self.upload_times,
+            "source_times": self.source_times,
+        }
+        with open(os.path.join(path, self.FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MetadataIndex"]:
+        """从目录 path 加载索引，不存在时返回None"""
+        file_path = os.path.join(path, cls.FILE_NAME)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls()
+        for field, values in data["bitmaps"].items():
+            index.bitmaps[field] = {value: int(bitmap, 16) for value, bitmap in values.items()}
+        index.upload_times = data["upload_times"]
+        index.source_times = data["source_times"]
+        return index
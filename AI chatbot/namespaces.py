@@ -0,0 +1,297 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from lexical_index import LexicalIndex
+from metadata_index import MetadataIndex
+from snapshots import SnapshotStore
+
+# 命名空间名称只允许字母、数字、下划线和连字符，防止路径穿越
+_NAMESPACE_NAME = re.compile(r"^[\w\-]{1,64}$")
+
+
+def validate_namespace(name: str) -> str:
+    if not isinstance(name, str) or not _NAMESPACE_NAME.match(name):
+        raise ValueError(f"无效的命名空间名称: {name!r}")
+    return name
+
+
+class _Shard:
+    """一个命名空间的分片：FAISS向量库、倒排索引和元数据索引，写入时整体替换为新的分片对象"""
+
+    def __init__(self, name: str, path: str, vector_store, lexical_index: LexicalIndex,
+                 metadata_index: MetadataIndex):
+        self.name = name
+        self.path = path
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        self.metadata_index = metadata_index
+        self.size_bytes = 0
+        self.last_used = time.monotonic()
+        # 有尚未保存的写入，不能被淘汰
+        self.dirty = False
+        self.refresh_size()
+
+    def refresh_size(self):
+        """估算分片占用的内存：向量 + 文档文本"""
+        from chunk_store import docstore_text_bytes
+        index = self.vector_store.index
+        vectors = index.ntotal * index.d * 4
+        self.size_bytes = vectors + docstore_text_bytes(self.vector_store.docstore) * 2
+
+
+class NamespaceStore:
+    """
+    命名空间分片存储：每个客户或投资组合一个独立的向量库，以快照形式保存在 <root>/<命名空间>/
+
+    分片在第一次被查询或写入时才从磁盘加载，已加载分片的估算内存超出预算时按最近最少使用淘汰；
+    跨多个命名空间的查询只计算一次查询向量，各分片并行做混合检索后按融合分数合并
+    """
+
+    def __init__(self,
+                 root: str = os.path.join("RAG", "namespaces"),
+                 embeddings_factory: Callable[[], Any] = None,
+                 memory_budget_mb: float = 1024,
+                 max_workers: int = 4):
+        """
+        :param root: 分片根目录
+        :param embeddings_factory: 创建嵌入模型的无参函数，所有分片共用一个嵌入模型
+        :param memory_budget_mb: 已加载分片的内存预算（MB）
+        :param max_workers: 并行检索的线程数
+        """
+        self.root = root
+        self.embeddings_factory = embeddings_factory
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._embeddings = None
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 每个命名空间一把锁，避免同一分片被并发加载或写入
+        self._shard_locks: Dict[str, threading.Lock] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="namespace-search")
+        # 计数器都在 _lock 内更新
+        self.counters = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0, "searches": 0}
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = self.embeddings_factory()
+        return self._embeddings
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, validate_namespace(name))
+
+    def _shard_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._shard_locks.setdefault(name, threading.Lock())
+
+    def list_namespaces(self) -> List[str]:
+        """磁盘上已有的命名空间"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if SnapshotStore(os.path.join(self.root, name)).resolve() is not None)
+
+    def exists(self, name: str) -> bool:
+        return name in self._shards or SnapshotStore(self._path(name)).resolve() is not None
+
+    def get(self, name: str) -> Optional[_Shard]:
+        """获取已加载的分片，未加载时从磁盘加载；命名空间不存在时返回None"""
+        with self._lock:
+            shard = self._shards.get(name)
+            if shard is not None:
+                self._shards.move_to_end(name)
+                shard.last_used = time.monotonic()
+                self.counters["hits"] += 1
+                return shard
+            self.counters["misses"] += 1
+        with self._shard_lock(name):
+            return self._load_locked(name)
+
+    def _load_locked(self, name: str) -> Optional[_Shard]:
+        """在持有分片锁时获取分片，未加载时从磁盘加载"""
+        # 等锁期间可能已被其他线程加载
+        shard = self._shards.get(name)
+        if shard is not None:
+            return shard
+        snapshot_path = SnapshotStore(self._path(name)).resolve()
+        if snapshot_path is None:
+            return None
+        from chunk_store import load_faiss
+        started = time.perf_counter()
+        vector_store = load_faiss(snapshot_path, self.embeddings)
+        lexical_index = LexicalIndex.load(snapshot_path)
+        if lexical_index is None:
+            lexical_index = self._build_lexical_index(vector_store)
+        metadata_index = MetadataIndex.load(snapshot_path)
+        if metadata_index is None or len(metadata_index) != vector_store.index.ntotal:
+            metadata_index = MetadataIndex.build(vector_store)
+        shard = _Shard(name, self._path(name), vector_store, lexical_index, metadata_index)
+        print(f"命名空间 {name} 已加载，耗时 {time.perf_counter() - started:.2f} 秒，"
+              f"约 {shard.size_bytes / 1024 / 1024:.1f} MB")
+        self._register(shard, loaded=True)
+        return shard
+
+    def _register(self, shard: _Shard, loaded: bool = False):
+        with self._lock:
+            self._shards[shard.name] = shard
+            self._shards.move_to_end(shard.name)
+            if loaded:
+                self.counters["loads"] += 1
+            self._evict_locked(keep=shard.name)
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        """按LRU淘汰分片直到内存占用回到预算内，刚使用的分片不淘汰"""
+        total = sum(shard.size_bytes for shard in self._shards.values())
+        for name in list(self._shards):
+            if total <= self.memory_budget:
+                break
+            if name == keep or self._shards[name].dirty:
+                continue
+            total -= self._shards.pop(name).size_bytes
+            self.counters["evictions"] += 1
+            print(f"内存超出预算，卸载命名空间: {name}")
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            return self._shards.pop(name, None) is not None
+
+    @staticmethod
+    def _build_lexical_index(vector_store) -> LexicalIndex:
+        from retrieval import get_documents
+        index = LexicalIndex()
+        ids = list(vector_store.index_to_docstore_id.values())
+        index.add_documents(ids, [doc.page_content for doc in get_documents(vector_store, ids)])
+        return index
+
+    def add_documents(self, name: str, documents: Sequence[Document], save: bool = True) -> int:
+        """
+        向命名空间写入文本块，命名空间不存在时创建；写入在当前分片的副本上进行，完成后整体替换分片，
+        正在检索该命名空间的查询继续使用旧分片
+        :param save: 是否保存分片快照；连续多批写入时可以传False，最后调用 save 保存一次
+        :return: 分片中的文本块总数
+        """
+        validate_namespace(name)
+        documents = [Document(page_content=doc.page_content, metadata={**doc.metadata, "namespace": name})
+                     for doc in documents]
+        # 加载、写入和替换都在分片锁内进行，同一命名空间的并发写入不会互相覆盖
+        with self._shard_lock(name):
+            current = self._load_locked(name)
+            if current is None:
+                from langchain_community.vectorstores import FAISS
+                vector_store = FAISS.from_documents(documents, self.embeddings)
+                lexical_index = self._build_lexical_index(vector_store)
+                metadata_index = MetadataIndex.build(vector_store)
+            else:
+                from chunk_store import copy_faiss
+                vector_store = copy_faiss(current.vector_store)
+                ids = vector_store.add_documents(documents)
+                lexical_index = current.lexical_index.copy()
+                lexical_index.add_documents(ids, [doc.page_content for doc in documents])
+                metadata_index = current.metadata_index.copy()
+                metadata_index.add(doc.metadata for doc in documents)
+            shard = _Shard(name, self._path(name), vector_store, lexical_index, metadata_index)
+            shard.dirty = True
+            if save:
+                self._save_locked(shard)
+            self._register(shard)
+        return shard.vector_store.index.ntotal
+
+    def save(self, name: str) -> bool:
+        """
+        保存命名空间分片中尚未保存的写入
+        :return: 是否写入了新快照
+        """
+        with self._shard_lock(name):
+            shard = self._shards.get(name)
+            if shard is None or not shard.dirty:
+                return False
+            self._save_locked(shard)
+            return True
+
+    def _save_locked(self, shard: _Shard):
+        """以快照形式保存分片，写入中途崩溃不会破坏已有的分片"""
+        from chunk_store import save_faiss
+
+        def write(snapshot_path):
+            save_faiss(shard.vector_store, snapshot_path)
+            shard.lexical_index.save(snapshot_path)
+            shard.metadata_index.save(snapshot_path)
+        SnapshotStore(shard.path).save(write)
+        shard.dirty = False
+        # 保存时文本块已转为压缩存储，重新估算内存
+        shard.refresh_size()
+
+    def search(self, query: str, namespaces: Sequence[str], k: int = 4,
+               filters: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float]]:
+        """
+        在多个命名空间中检索：各分片与默认向量存储一样使用 HybridRetriever，
+        BM25、向量检索和标识符精确命中三路结果按倒数排名融合
+        :param query: 查询文本
+        :param namespaces: 命名空间列表，不存在的命名空间会被忽略
+        :param k: 返回结果数
+        :param filters: 元数据过滤条件，各分片先用元数据索引选出候选文本块，再只在其中检索
+        :return: 按融合分数降序排列的 (文档, 分数) 列表，文档元数据中带有 namespace
+        """
+        from retrieval import HybridRetriever
+        with self._lock:
+            self.counters["searches"] += 1
+        vector = self.embeddings.embed_query(query)
+
+        def search_shard(name: str) -> List[Tuple[Document, float]]:
+            shard = self.get(name)
+            if shard is None:
+                return []
+            retriever = HybridRetriever(
+                vector_store=shard.vector_store,
+                lexical_index=shard.lexical_index,
+                metadata_index=shard.metadata_index,
+                filters=filters,
+                k=k,
+                query_vector=vector
+            )
+            results = []
+            for doc_id, score in retriever.scored_ids(query):
+                doc = shard.vector_store.docstore.search(doc_id)
+                if isinstance(doc, Document):
+                    results.append((doc, score))
+            return results
+
+        names = list(dict.fromkeys(namespaces))
+        if len(names) == 1:
+            results = search_shard(names[0])
+        else:
+            results = [item for items in self._executor.map(search_shard, names) for item in items]
+        # 各分片的融合分数都按排名计算，可以直接比较
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results[:k]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": {name: round(shard.size_bytes / 1024 / 1024, 2) for name, shard in self._shards.items()},
+                "loaded_mb": round(sum(s.size_bytes for s in self._shards.values()) / 1024 / 1024, 2),
+                "memory_budget_mb": self.memory_budget / 1024 / 1024,
+                **self.counters,
+            }
+
+
+class NamespaceRetriever(BaseRetriever):
+    """在一个或多个命名空间中检索的检索器"""
+    store: Any
+    namespaces: List[str]
+    k: int = 4
+    filters: Optional[Dict[str, Any]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [doc for doc, _ in self.store.search(query, self.namespaces, self.k, self.filters)]
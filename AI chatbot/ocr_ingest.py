@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from langchain.docstore.document import Document
+
+from ocr_pages import create_ocr, iter_file_pages
+
+_ocr = None
+_ocr_lock = threading.Lock()
+
+
+def get_ocr():
+    """获取进程内共享的OCR引擎，模型只加载一次"""
+    global _ocr
+    with _ocr_lock:
+        if _ocr is None:
+            _ocr = create_ocr()
+        return _ocr
+
+
+def iter_ocr_documents(file_path: str, ocr=None) -> Iterator[Document]:
+    """
+    逐页识别PDF或图像，每识别完一页就产出一个文档，不写中间txt文件
+    :param file_path: PDF或图像文件路径
+    :param ocr: OCR引擎，默认使用共享引擎
+    :return: 文档生成器，元数据包含 source、page（从0开始，与PyPDFLoader一致）、doc_type 和 upload_time
+    """
+    upload_time = time.time()
+    doc_type = os.path.splitext(file_path)[1].lstrip(".").lower()
+    for page, text in iter_file_pages(file_path, ocr or get_ocr()):
+        if not text.strip():
+            continue
+        yield Document(page_content=text, metadata={
+            "source": file_path,
+            "page": page,
+            "doc_type": doc_type,
+            "upload_time": upload_time,
+            "ocr": True,
+        })
+
+
+def ingest_ocr_file(bot, file_path: str,
+                    namespace: Optional[str] = None,
+                    pages_per_batch: int = 4,
+                    chunk_size: int = 500,
+                    chunk_overlap: int = 100,
+                    ocr=None) -> Dict[str, Any]:
+    """
+    把扫描件直接识别并写入向量库：每积累 pages_per_batch 页就分割、嵌入并增量写入，
+    前面的页面在后面的页面还在识别时就已经可以检索，全部写入后保存一次快照
+    :param bot: LangChainChatBot 实例
+    :param file_path: PDF或图像文件路径
+    :param namespace: 写入的命名空间，为None时写入默认向量存储
+    :param pages_per_batch: 每批写入的页数
+    :param chunk_size: 分块大小（token数）
+    :param chunk_overlap: 分块重叠大小（token数）
+    :param ocr: OCR引擎，默认使用共享引擎
+    :return: 统计信息（页数、文本块数、OCR和建索引耗时）
+    """
+    stats = {"source": file_path, "pages": 0, "chunks": 0, "ocr_seconds": 0.0, "index_seconds": 0.0}
+    batch = []
+    # 文档总结在全部页面识别完后按全文预计算一次
+    recognized = []
+
+    def flush():
+        started = time.perf_counter()
+        stats["chunks"] += bot.index_documents(batch, chunk_size, chunk_overlap, append=True,
+                                               namespace=namespace, save=False, summarize=False)
+        stats["index_seconds"] += time.perf_counter() - started
+        batch.clear()
+
+    pages = iter_ocr_documents(file_path, ocr)
+    started = time.perf_counter()
+    for document in pages:
+        stats["ocr_seconds"] += time.perf_counter() - started
+        batch.append(document)
+        recognized.append(document)
+        stats["pages"] += 1
+        if len(batch) >= pages_per_batch:
+            flush()
+        started = time.perf_counter()
+    stats["ocr_seconds"] += time.perf_counter() - started
+    if batch:
+        flush()
+    if recognized:
+        bot.schedule_summaries(recognized, namespace)
+    # 各批只写入内存，全部写入后保存一次快照
+    if stats["chunks"]:
+        if namespace is None:
+            print(bot.save_vector_store())
+        else:
+            bot._get_namespace_store().save(namespace)
+    print(f"OCR入库完成: {file_path}，{stats['pages']} 页，{stats['chunks']} 个文本块，"
+          f"识别 {stats['ocr_seconds']:.1f} 秒，建索引 {stats['index_seconds']:.1f} 秒")
+    return stats
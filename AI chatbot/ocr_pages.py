@@ -0,0 +1,67 @@
+import os
+from typing import Iterator, Tuple
+
+# 每个PDF最多识别的页数
+PAGE_NUM = 10
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+
+def create_ocr():
+    """创建OCR引擎（依赖 paddleocr，首次使用时才导入）"""
+    os.environ.setdefault('KMP_DUPLICATE_LIB_OK', 'TRUE')
+    from paddleocr import PaddleOCR
+    return PaddleOCR(use_angle_cls=True, lang="ch", page_num=PAGE_NUM)
+
+
+def _render_page(page):
+    """用fitz把PDF页面渲染为OpenCV图像，过大的页面降低分辨率"""
+    import cv2
+    import fitz
+    import numpy as np
+    from PIL import Image
+    pm = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
+    if pm.width > 2000 or pm.height > 2000:
+        pm = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
+    img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
+    return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+
+
+def _result_text(res) -> str:
+    """只保留识别结果中的文本内容"""
+    return "\n".join(line[1][0] for line in res)
+
+
+def iter_pdf_pages(pdf_path: str, ocr, max_pages: int = PAGE_NUM) -> Iterator[Tuple[int, str]]:
+    """
+    逐页渲染并识别PDF，识别完一页就产出一页，不等待整个文件
+    :return: (页码（从0开始）, 页面文本) 的生成器，跳过没有识别结果的页面
+    """
+    import fitz
+    with fitz.open(pdf_path) as pdf:
+        for page in range(min(max_pages, pdf.page_count)):
+            result = ocr.ocr(_render_page(pdf[page]), cls=True)
+            res = result[0] if result else None
+            if res is None:
+                continue
+            yield page, _result_text(res)
+
+
+def iter_image_pages(image_path: str, ocr) -> Iterator[Tuple[int, str]]:
+    """
+    识别图像（多帧图像如GIF每帧一页）
+    :return: (页码（从0开始）, 页面文本) 的生成器，跳过空页
+    """
+    for page, res in enumerate(ocr.ocr(image_path, cls=True)):
+        if res is None:
+            continue
+        yield page, _result_text(res)
+
+
+def iter_file_pages(file_path: str, ocr) -> Iterator[Tuple[int, str]]:
+    """按文件类型逐页识别，不支持的类型抛出 ValueError"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.pdf':
+        return iter_pdf_pages(file_path, ocr)
+    if extension in IMAGE_EXTENSIONS:
+        return iter_image_pages(file_path, ocr)
+    raise ValueError(f"不支持OCR的文件类型: {extension}")
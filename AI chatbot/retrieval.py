@@ -0,0 +1,150 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from lexical_index import identifier_terms, reciprocal_rank_fusion
+
+# 候选集不超过该数量时直接计算候选向量的距离，不扫描整个索引
+EXACT_SUBSET_SIZE = 4096
+
+
+def embed_query(vector_store, query: str) -> List[float]:
+    """使用向量存储自带的嵌入模型对查询编码"""
+    embeddings = getattr(vector_store, "embeddings", None)
+    if embeddings is not None:
+        return embeddings.embed_query(query)
+    return vector_store.embedding_function(query)
+
+
+def dense_search(vector_store, query: str, k: int = 4, positions: Optional[np.ndarray] = None,
+                 vector: Optional[Sequence[float]] = None) -> List[Tuple[str, float]]:
+    """
+    FAISS向量检索，返回docstore ID而不是文档对象，便于与其他检索结果融合
+    :param vector_store: LangChain FAISS 向量存储
+    :param query: 查询文本
+    :param k: 返回结果数
+    :param positions: 可选的候选向量位置（元数据过滤结果），只在其中检索
+    :param vector: 已计算好的查询向量，为None时对 query 编码
+    :return: 按距离升序排列的 (文档ID, 距离) 列表
+    """
+    if positions is not None and len(positions) == 0:
+        return []
+    if vector is None:
+        vector = embed_query(vector_store, query)
+    return vector_search(vector_store, vector, k, positions)
+
+
+def vector_search(vector_store, vector: Sequence[float], k: int = 4,
+                  positions: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+    """
+    用已计算好的查询向量检索；指定候选位置时过滤在FAISS检索内部完成，而不是对top-k结果再过滤：
+    候选集较小时直接计算候选向量的距离，否则用 IDSelectorBatch 让FAISS只对候选向量打分
+    :return: 按距离升序排列的 (文档ID, 距离) 列表
+    """
+    index = vector_store.index
+    query = np.array([vector], dtype=np.float32)
+    if positions is None:
+        distances, indices = index.search(query, k)
+    elif len(positions) == 0:
+        return []
+    else:
+        import faiss
+        positions = np.ascontiguousarray(positions, dtype=np.int64)
+        if len(positions) <= EXACT_SUBSET_SIZE and index.metric_type == faiss.METRIC_L2:
+            scores = ((index.reconstruct_batch(positions) - query) ** 2).sum(axis=1)
+            order = np.argsort(scores)[:k]
+            indices, distances = positions[order][None], scores[order][None]
+        else:
+            selector = faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions))
+            distances, indices = index.search(query, k, params=faiss.SearchParameters(sel=selector))
+    return [
+        (vector_store.index_to_docstore_id[int(i)], float(d))
+        for d, i in zip(distances[0], indices[0])
+        if i != -1
+    ]
+
+
+def get_documents(vector_store, ids: Sequence[str]) -> List[Document]:
+    """按docstore ID批量取回文档，忽略已不存在的ID"""
+    docs = []
+    for doc_id in ids:
+        doc = vector_store.docstore.search(doc_id)
+        if isinstance(doc, Document):
+            docs.append(doc)
+    return docs
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    混合检索器：BM25和向量检索同时进行，用倒数排名融合合并结果；查询中含股票代码、账号等标识符时，
+    精确包含这些标识符的文本块作为额外一路按 identifier_weight 加权参与融合，而不是替代向量检索。
+    设置了元数据过滤条件时，各路检索都只在元数据索引选出的候选文本块中进行
+    """
+    vector_store: Any
+    lexical_index: Any
+    metadata_index: Any = None
+    filters: Optional[Dict[str, Any]] = None
+    k: int = 4
+    fetch_k: int = 20
+    # 标识符精确命中一路的融合权重，为0时不使用
+    identifier_weight: float = 2.0
+    # 本次查询已计算好的查询向量（如查找回答缓存时计算的），为None时检索时再编码
+    query_vector: Optional[List[float]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def candidates(self) -> Tuple[Optional[np.ndarray], Optional[set]]:
+        """元数据过滤后的候选向量位置和文档ID集合，未设置过滤条件时返回 (None, None)"""
+        if not self.filters or self.metadata_index is None:
+            return None, None
+        positions = self.metadata_index.select(self.filters)
+        id_map = self.vector_store.index_to_docstore_id
+        return positions, {id_map[int(position)] for position in positions}
+
+    def keyword_ids(self, query: str, candidates: Optional[set] = None) -> List[str]:
+        """精确包含查询中全部标识符的文本块（仅使用倒排索引），按完整查询的BM25分数排序；查询不含标识符时返回空列表"""
+        terms = identifier_terms(query)
+        if not terms:
+            return []
+        found = [doc_id for doc_id, _ in self.lexical_index.keyword_lookup(terms, self.fetch_k, candidates=candidates)]
+        if len(found) <= 1:
+            return found
+        return [doc_id for doc_id, _ in self.lexical_index.search(query, len(found), candidates=found)]
+
+    def hybrid_ids(self, query: str, positions: Optional[np.ndarray] = None,
+                   candidates: Optional[set] = None) -> List[str]:
+        """BM25、向量检索和标识符精确命中三路结果融合"""
+        return [doc_id for doc_id, _ in self.hybrid_scores(query, positions, candidates)]
+
+    def hybrid_scores(self, query: str, positions: Optional[np.ndarray] = None,
+                      candidates: Optional[set] = None) -> List[Tuple[str, float]]:
+        """三路结果融合，返回按融合分数降序排列的前k个 (文档ID, 分数)"""
+        dense = [doc_id for doc_id, _ in dense_search(self.vector_store, query, self.fetch_k, positions, self.query_vector)]
+        lexical = [doc_id for doc_id, _ in self.lexical_index.search(query, self.fetch_k, candidates=candidates)]
+        result_lists, weights = [dense, lexical], [1.0, 1.0]
+        if self.identifier_weight > 0:
+            exact = self.keyword_ids(query, candidates)
+            if exact:
+                result_lists.append(exact)
+                weights.append(self.identifier_weight)
+        return reciprocal_rank_fusion(result_lists, weights=weights)[:self.k]
+
+    def scored_ids(self, query: str) -> List[Tuple[str, float]]:
+        """
+        按过滤条件检索，返回按融合分数降序排列的前k个 (文档ID, 分数)；倒排索引为空时只用向量检索，
+        分数同样按排名计算，多个检索器（如各命名空间分片）的结果可以直接按分数合并
+        """
+        positions, candidates = self.candidates()
+        if positions is not None and len(positions) == 0:
+            return []
+        if self.lexical_index is None or len(self.lexical_index) == 0:
+            dense = [doc_id for doc_id, _ in dense_search(self.vector_store, query, self.k, positions, self.query_vector)]
+            return reciprocal_rank_fusion([dense])
+        return self.hybrid_scores(query, positions, candidates)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return get_documents(self.vector_store, [doc_id for doc_id, _ in self.scored_ids(query)])
@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from LLMRAG import LangChainChatBot
+from http_transport import transport_stats
+from snapshots import SnapshotStore
+from tracing import configure_tracer
+
+# Node服务保存上传文件的目录，/documents 接口只读取这个目录下的文件
+DEFAULT_UPLOAD_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "server", "uploads")
+
+
+class ChatSession:
+    """
+    单个对话会话的状态：对话记忆、检索过滤条件和命名空间
+
+    LLM客户端、提示词模板、向量存储等由共享的机器人持有，调用机器人时把会话作为 session 参数传入，
+    机器人只读写会话自己的记忆和检索范围；共享机器人重新加载向量存储后所有会话立即生效
+    """
+
+    def __init__(self, session_id: str, shared_bot: LangChainChatBot, memory_type: str = "buffer"):
+        self.session_id = session_id
+        self.memory = shared_bot._create_memory(memory_type)
+        self.retrieval_filters = None
+        self.active_namespaces = None
+        self.namespace_retriever = None
+        self.last_stream_stats = None
+        self.last_active = time.monotonic()
+        # 同一会话的请求串行处理，保证记忆顺序一致
+        self.lock = threading.Lock()
+
+    def clear_history(self):
+        self.memory.clear()
+
+
+class SessionManager:
+    """多会话管理：所有会话共享一个机器人的模型和向量存储，按LRU和空闲超时淘汰会话"""
+
+    def __init__(self,
+                 bot: LangChainChatBot,
+                 max_sessions: int = 1000,
+                 session_ttl: float = 1800,
+                 memory_type: str = "buffer"):
+        """
+        :param bot: 共享的机器人实例
+        :param max_sessions: 最大会话数，超出时淘汰最久未使用的会话
+        :param session_ttl: 会话空闲超时时间（秒）
+        :param memory_type: 新会话的记忆类型
+        """
+        self.bot = bot
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.memory_type = memory_type
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def get_session(self, session_id: str) -> ChatSession:
+        """获取会话，不存在时创建"""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id, self.bot, self.memory_type)
+                self.sessions[session_id] = session
+            else:
+                self.sessions.move_to_end(session_id)
+            session.last_active = time.monotonic()
+            self._evict_locked()
+            return session
+
+    def close_session(self, session_id: str) -> bool:
+        """关闭会话并释放其记忆"""
+        with self._lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def evict_expired(self) -> int:
+        """淘汰空闲超时的会话，返回淘汰数量"""
+        with self._lock:
+            return self._evict_locked()
+
+    def _evict_locked(self) -> int:
+        count = 0
+        deadline = time.monotonic() - self.session_ttl
+        # OrderedDict 按最近使用排序，从最久未使用的一端开始检查
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and session.last_active >= deadline:
+                break
+            del self.sessions[session_id]
+            count += 1
+        self.evicted += count
+        return count
+
+    def chat(self, session_id: str, user_input: str, namespaces: Optional[List[str]] = None,
+             filters: Optional[Dict[str, Any]] = None) -> str:
+        """
+        在指定会话中生成回复
+        :param namespaces: 本会话检索的命名空间，与会话当前的检索范围不同时切换
+        :param filters: 本会话的检索过滤条件（来源、上传时间、文档类型、命名空间），与当前条件不同时更新
+        """
+        session = self.get_session(session_id)
+        if isinstance(namespaces, str):
+            namespaces = [namespaces]
+        with session.lock:
+            # 共享机器人重建LLM客户端后，会话记忆生成摘要时也改用新的客户端
+            self.bot._rebind_memory_llm(session.memory)
+            # 空列表和None都表示默认向量存储，与会话当前的检索范围一致时不切换
+            if namespaces is not None and (namespaces or None) != session.active_namespaces:
+                print(self.bot.use_namespaces(namespaces, session=session))
+            if filters is not None and (filters or None) != session.retrieval_filters:
+                print(self.bot.set_retrieval_filters(filters, session=session))
+            return self.bot.generate_response(user_input, session=session)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "active_sessions": len(self.sessions),
+                "evicted_sessions": self.evicted,
+                "max_sessions": self.max_sessions,
+                "session_ttl": self.session_ttl,
+                "rag_enabled": self.bot.rag_enabled,
+                "snapshot_version": self.bot.snapshot_version,
+                "llm_scheduler": self.bot.scheduler.metrics(),
+                "http_transport": transport_stats(),
+            }
+        if self.bot.namespace_store is not None:
+            stats["namespaces"] = self.bot.namespace_store.stats()
+        if self.bot.summary_precomputer is not None:
+            stats["summaries"] = self.bot.summary_precomputer.metrics()
+        docstore = getattr(self.bot.vector_store, "docstore", None)
+        if hasattr(docstore, "stats"):
+            stats["docstore"] = docstore.stats()
+        embeddings = getattr(self.bot.vector_store, "embedding_function", None)
+        if hasattr(embeddings, "metrics"):
+            stats["embedding_batcher"] = embeddings.metrics()
+        return stats
+
+    def start_janitor(self, interval: float = 60):
+        """启动后台线程定期淘汰空闲会话"""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.evict_expired()
+        threading.Thread(target=run, name="session-janitor", daemon=True).start()
+
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    """
+    本地HTTP接口，供Node服务直接调用，无需为每个请求启动Python进程
+
+    POST   /chat              {"session_id": "...", "message": "...", "namespaces": [...], "filters": {...}}
+                                                                                      -> {"response": "..."}
+    POST   /documents         {"paths": [...], "append": true, "namespace": "..."}     -> {"chunks": n}
+    POST   /documents/ocr     {"path": "...", "namespace": "..."}  扫描件逐页识别后直接入库 -> {"pages": n, "chunks": n, ...}
+    DELETE /sessions/<id>
+    GET    /stats
+    GET    /metrics           Prometheus 格式的阶段耗时直方图和计数器
+    GET    /health
+
+    文档路径可以是上传目录下的相对路径或绝对路径，解析符号链接后不在上传目录内的路径返回403
+    """
+    manager: SessionManager = None
+    upload_root: str = DEFAULT_UPLOAD_ROOT
+
+    def _send_json(self, status: int, data: Dict[str, Any]):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Optional[Dict[str, Any]]:
+        """读取JSON请求体，无法解析或不是JSON对象时返回None"""
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    def _resolve_upload(self, path) -> Optional[str]:
+        """把请求中的文件路径解析为上传目录下的真实路径，不在上传目录内时返回None"""
+        if not isinstance(path, str) or not path:
+            return None
+        root = os.path.realpath(self.upload_root)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            return None
+        return resolved
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, self.manager.stats())
+        elif self.path == "/metrics":
+            body = self.manager.bot.tracer.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {"error": "未找到接口"})
+
+    def do_POST(self):
+        data = self._read_json()
+        if data is None:
+            self._send_json(400, {"error": "请求体必须是JSON对象"})
+            return
+        try:
+            self._handle_post(data)
+        except Exception as e:
+            print(f"处理请求 {self.path} 时出错: {str(e)}")
+            self._send_json(500, {"error": str(e)})
+
+    def _handle_post(self, data: Dict[str, Any]):
+        if self.path == "/chat":
+            session_id = data.get("session_id")
+            message = data.get("message")
+            if not session_id or not message:
+                self._send_json(400, {"error": "缺少 session_id 或 message"})
+                return
+            response = self.manager.chat(str(session_id), message, data.get("namespaces"), data.get("filters"))
+            self._send_json(200, {"session_id": session_id, "response": response})
+        elif self.path == "/documents":
+            paths = data.get("paths")
+            if not paths or not isinstance(paths, list):
+                self._send_json(400, {"error": "缺少 paths"})
+                return
+            resolved = [self._resolve_upload(path) for path in paths]
+            rejected = [path for path, real in zip(paths, resolved) if real is None]
+            if rejected:
+                self._send_json(403, {"error": "路径不在上传目录内", "paths": rejected})
+                return
+            # 机器人内部串行入库，写完后整体切换向量库快照，并发的对话请求不受影响
+            chunks = self.manager.bot.load_documents(resolved, append=data.get("append", True),
+                                                     namespace=data.get("namespace"))
+            self._send_json(200, {"chunks": chunks})
+        elif self.path == "/documents/ocr":
+            if not data.get("path"):
+                self._send_json(400, {"error": "缺少 path"})
+                return
+            path = self._resolve_upload(data["path"])
+            if path is None:
+                self._send_json(403, {"error": "路径不在上传目录内", "paths": [data["path"]]})
+                return
+            from ocr_ingest import ingest_ocr_file
+            try:
+                stats = ingest_ocr_file(self.manager.bot, path, namespace=data.get("namespace"))
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": "未找到接口"})
+
+    def do_DELETE(self):
+        if self.path.startswith("/sessions/"):
+            closed = self.manager.close_session(self.path[len("/sessions/"):])
+            self._send_json(200 if closed else 404, {"closed": closed})
+        else:
+            self._send_json(404, {"error": "未找到接口"})
+
+    def log_message(self, format, *args):
+        print(f"[{self.log_date_time_string()}] {format % args}")
+
+
+def serve(manager: SessionManager, host: str = "127.0.0.1", port: int = 8900,
+          upload_root: str = DEFAULT_UPLOAD_ROOT):
+    """
+    启动HTTP服务（阻塞）
+    :param upload_root: 上传目录，/documents 接口只读取这个目录下的文件
+    """
+    handler = type("Handler", (ChatRequestHandler,), {"manager": manager, "upload_root": upload_root})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"多会话聊天服务已启动: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        manager.bot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多会话聊天服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--api_key", help="DeepSeek API密钥", default=os.environ.get("DEEPSEEK_API_KEY"))
+    parser.add_argument("--model", help="使用的模型名称", default="deepseek-chat")
+    parser.add_argument("--db_url", help="数据库后端URL", default=None)
+    parser.add_argument("--db_token", help="数据库后端认证令牌", default=None)
+    parser.add_argument("--vector_store", help="启动时加载的向量存储目录", default="RAG")
+    parser.add_argument("--upload_root", help="上传目录，/documents 接口只读取这个目录下的文件",
+                        default=os.environ.get("CHATBOT_UPLOAD_ROOT", DEFAULT_UPLOAD_ROOT))
+    parser.add_argument("--max_sessions", type=int, default=1000)
+    parser.add_argument("--session_ttl", type=float, default=1800, help="会话空闲超时时间（秒）")
+    parser.add_argument("--trace_path", help="每轮对话追踪记录的JSON-lines日志路径",
+                        default=os.environ.get("CHATBOT_TRACE_PATH"))
+    parser.add_argument("--watch_interval", type=float, default=5,
+                        help="检查向量库新快照的间隔（秒），为0时不监视")
+    args = parser.parse_args()
+
+    # 追踪器需在创建机器人之前配置，机器人初始化时获取共享追踪器
+    configure_tracer(jsonl_path=args.trace_path)
+
+    bot = LangChainChatBot(
+        api_key=args.api_key,
+        model_name=args.model,
+        db_url=args.db_url,
+        db_token=args.db_token,
+        use_async_db=bool(args.db_url)
+    )
+    if SnapshotStore(args.vector_store).resolve() is not None:
+        print(bot.load_vector_store(args.vector_store))
+    # 其他进程重建并发布新快照后，后台加载并切换，服务不中断
+    if args.watch_interval > 0:
+        bot.start_snapshot_watcher(args.vector_store, args.watch_interval)
+
+    manager = SessionManager(bot, max_sessions=args.max_sessions, session_ttl=args.session_ttl)
+    manager.start_janitor()
+    serve(manager, args.host, args.port, args.upload_root)
+
+
+if __name__ == "__main__":
+    main()
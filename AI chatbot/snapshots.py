@@ -0,0 +1,173 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Callable, List, NamedTuple, Optional
+
+CURRENT_FILE = "CURRENT"
+SNAPSHOT_DIR = "snapshots"
+_TMP_PREFIX = ".tmp-"
+
+
+def _fsync_dir(path: str):
+    """刷新目录项，保证重命名在断电后仍然可见（Windows 不支持对目录 fsync，直接跳过）"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class IndexSnapshot(NamedTuple):
+    """
+    内存中某一版本的向量库：向量存储、倒排索引、元数据索引和基于它们创建的检索器
+
+    各部分总是一起替换（读-复制-更新）：查询开始时取一次快照引用，之后的检索、缓存查找和缓存写入
+    都使用这一版本，不会一部分来自旧向量库、一部分来自新向量库
+    """
+    vector_store: Any
+    lexical_index: Any
+    metadata_index: Any
+    retriever: Any
+    # 每次发布生成的版本号（从磁盘加载时为磁盘快照的版本），回答缓存只在同一版本内命中
+    version: str
+
+
+class SnapshotStore:
+    """
+    向量库快照目录：
+
+        <root>/snapshots/<版本>/   每次保存写入一个新的完整快照
+        <root>/CURRENT            当前版本号
+
+    快照先写入临时目录，全部落盘后重命名为正式目录，再用 os.replace 原子替换 CURRENT，
+    保存过程中崩溃只会留下未发布的临时目录，读取方看到的永远是完整的快照。
+    旧版本直接保存在 <root> 下的向量库（没有 CURRENT）仍可读取
+    """
+
+    def __init__(self, root: str = "RAG", keep: int = 3):
+        """
+        :param root: 向量库根目录
+        :param keep: 保留的历史快照数（不含当前版本）
+        """
+        self.root = root
+        self.keep = keep
+        self.snapshot_root = os.path.join(root, SNAPSHOT_DIR)
+
+    def current(self) -> Optional[str]:
+        """当前发布的版本号，没有快照时返回None"""
+        try:
+            with open(os.path.join(self.root, CURRENT_FILE), "r", encoding="utf-8") as f:
+                version = f.read().strip()
+        except OSError:
+            return None
+        return version if version and os.path.isdir(os.path.join(self.snapshot_root, version)) else None
+
+    def path(self, version: str) -> str:
+        return os.path.join(self.snapshot_root, version)
+
+    def resolve(self) -> Optional[str]:
+        """当前快照的目录；没有快照但根目录下有旧格式的向量库时返回根目录"""
+        version = self.current()
+        if version is not None:
+            return self.path(version)
+        if os.path.exists(os.path.join(self.root, "index.faiss")):
+            return self.root
+        return None
+
+    def list_versions(self) -> List[str]:
+        if not os.path.isdir(self.snapshot_root):
+            return []
+        return sorted(name for name in os.listdir(self.snapshot_root) if not name.startswith(_TMP_PREFIX))
+
+    def save(self, writer: Callable[[str], None]) -> str:
+        """
+        写入并发布一个新快照
+        :param writer: 接收临时目录路径、把向量库文件写入其中的函数
+        :return: 新快照的版本号
+        """
+        # 版本号按时间排序（精确到微秒），随机后缀避免多个进程同时保存时冲突
+        now = time.time()
+        version = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1e6) % 1000000:06d}-{uuid.uuid4().hex[:4]}"
+        tmp_path = os.path.join(self.snapshot_root, _TMP_PREFIX + version)
+        os.makedirs(tmp_path)
+        try:
+            writer(tmp_path)
+            for name in os.listdir(tmp_path):
+                with open(os.path.join(tmp_path, name), "rb+") as f:
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, self.path(version))
+            _fsync_dir(self.snapshot_root)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self._publish(version)
+        self.prune()
+        return version
+
+    def _publish(self, version: str):
+        """原子替换 CURRENT 指针"""
+        tmp_file = os.path.join(self.root, f"{CURRENT_FILE}.{os.getpid()}.{uuid.uuid4().hex[:6]}")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, os.path.join(self.root, CURRENT_FILE))
+        _fsync_dir(self.root)
+
+    def prune(self):
+        """删除超出保留数量的旧快照和遗留的临时目录，当前版本始终保留"""
+        current = self.current()
+        old = [version for version in self.list_versions() if version != current]
+        for version in old[:max(0, len(old) - self.keep)]:
+            shutil.rmtree(self.path(version), ignore_errors=True)
+        if os.path.isdir(self.snapshot_root):
+            deadline = time.time() - 3600
+            for name in os.listdir(self.snapshot_root):
+                path = os.path.join(self.snapshot_root, name)
+                if name.startswith(_TMP_PREFIX) and os.path.getmtime(path) < deadline:
+                    shutil.rmtree(path, ignore_errors=True)
+
+
+class SnapshotWatcher:
+    """后台线程定期检查 CURRENT，发布了新快照时调用 on_change(版本号, 快照目录)"""
+
+    def __init__(self, store: SnapshotStore, on_change: Callable[[str, str], None],
+                 interval: float = 5.0, version: Optional[str] = None):
+        """
+        :param store: 快照目录
+        :param on_change: 发现新版本时的回调，在后台线程中执行；抛出异常时下次检查会重试
+        :param interval: 检查间隔（秒）
+        :param version: 当前已加载的版本
+        """
+        self.store = store
+        self.on_change = on_change
+        self.interval = interval
+        self.version = version
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "SnapshotWatcher":
+        self._thread = threading.Thread(target=self._run, name="snapshot-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            version = self.store.current()
+            if version is None or version == self.version:
+                continue
+            try:
+                self.on_change(version, self.store.path(version))
+                self.version = version
+            except Exception as e:
+                print(f"切换到向量库快照 {version} 失败: {str(e)}")
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from context_builder import count_tokens
+
+# 要求总结文章的问题：以总结类动词开头（前面可以有“请”“帮我”等），或以“总结一下”“做个摘要”等结尾；
+# 问题中间出现的“摘要”“总结”（如“报告摘要里的营收是多少”）不算
+SUMMARY_INTENT = re.compile(
+    r"^\s*(?:请你?|麻烦你?|能否|能不能|可以|帮忙)?\s*(?:帮我|给我|为我)?\s*(?:总结|概括|归纳|摘要)"
+    r"|(?:总结|概括|归纳)(?:一下|下)?[吧呢]?\s*[。.!！?？]*\s*$"
+    r"|(?:做|写|给)(?:个|一个|一份|一下)?(?:总结|概括|摘要)[吧呢]?\s*[。.!！?？]*\s*$"
+    r"|^\s*(?:please\s+|can\s+you\s+|could\s+you\s+)?(?:summari[sz]e|sum\s+up|give\s+me\s+a\s+summary)",
+    re.IGNORECASE
+)
+# 问题中指代上传文档的词，没有点名具体文件时按最近上传的文档回答
+DOCUMENT_REFERENCE = re.compile(r"文章|文档|报告|文件|上传|这篇|article|document|report|file|upload", re.IGNORECASE)
+# 超过该长度的问题可能附带了要总结的文本本身，不使用预计算结果
+MAX_QUERY_TOKENS = 64
+# 写入默认向量存储（不属于任何命名空间）的文档
+DEFAULT_NAMESPACE = ""
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+class SummaryStore:
+    """
+    预计算的文档总结，按文档内容哈希保存：同一内容换个文件名上传时直接复用，
+    文档内容变化后哈希不同，旧总结不再对该文档生效。来源按命名空间分开登记，
+    查找时只在当前检索范围的命名空间中匹配，不同客户的文档互不可见
+    """
+
+    FILE_NAME = "summaries.json"
+
+    def __init__(self, path: str = "RAG"):
+        """
+        :param path: 保存目录
+        """
+        self.file_path = os.path.join(path, self.FILE_NAME)
+        self._lock = threading.Lock()
+        # 内容哈希 -> {"summary": 总结, "created": 生成时间, "seconds": 耗时}
+        self.summaries: Dict[str, Dict[str, Any]] = {}
+        # 命名空间 -> 来源 -> {"hash": 当前内容哈希, "upload_time": 上传时间}
+        self.sources: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.summaries = data.get("summaries", {})
+            self.sources = data.get("sources", {})
+            if any("hash" in entry for entry in self.sources.values()):
+                # 旧版本按来源平铺保存，都是默认向量存储的文档
+                self.sources = {DEFAULT_NAMESPACE: self.sources}
+        except (OSError, ValueError) as e:
+            print(f"读取预计算总结失败: {str(e)}")
+
+    def _save_locked(self):
+        # 不再被任何来源引用的总结随保存一起清理
+        referenced = {entry["hash"] for sources in self.sources.values() for entry in sources.values()}
+        self.summaries = {digest: entry for digest, entry in self.summaries.items() if digest in referenced}
+        os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+        tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"summaries": self.summaries, "sources": self.sources}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.file_path)
+
+    def update_source(self, source: str, digest: str, upload_time: float, namespace: Optional[str] = None) -> bool:
+        """
+        记录来源的当前内容
+        :param namespace: 文档写入的命名空间，为None时为默认向量存储
+        :return: 该内容是否还没有总结
+        """
+        with self._lock:
+            self.sources.setdefault(namespace or DEFAULT_NAMESPACE, {})[source] = {
+                "hash": digest, "upload_time": upload_time
+            }
+            self._save_locked()
+            return digest not in self.summaries
+
+    def retain(self, sources: Iterable[str], namespace: Optional[str] = None):
+        """
+        向量存储重建后只保留仍在其中的来源，其余来源的总结随之清理
+        :param sources: 重建后向量存储中的来源
+        :param namespace: 重建的命名空间，为None时为默认向量存储
+        """
+        keep = set(sources)
+        with self._lock:
+            entries = self.sources.get(namespace or DEFAULT_NAMESPACE, {})
+            stale = [source for source in entries if source not in keep]
+            for source in stale:
+                del entries[source]
+            if stale:
+                self._save_locked()
+
+    def put(self, digest: str, summary: str, seconds: float):
+        with self._lock:
+            self.summaries[digest] = {"summary": summary, "created": time.time(), "seconds": seconds}
+            self._save_locked()
+
+    def get(self, source: str, namespace: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """来源当前内容的总结，尚未生成时返回None"""
+        entry = self.sources.get(namespace or DEFAULT_NAMESPACE, {}).get(source)
+        return self.summaries.get(entry["hash"]) if entry else None
+
+    def find(self, user_input: str, namespaces: Optional[Sequence[str]] = None,
+             present: Optional[Callable[[str, str], bool]] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        判断问题是否在要求总结某篇已上传的文档，并找到对应的预计算总结
+        :param namespaces: 当前检索的命名空间，为None时只查找默认向量存储的文档
+        :param present: (命名空间, 来源) -> 该来源是否仍在当前索引中，不在的来源不参与匹配
+        :return: (来源, 总结记录)，不是总结请求或总结尚未生成时返回None
+        """
+        if not SUMMARY_INTENT.search(user_input) or count_tokens(user_input) > MAX_QUERY_TOKENS:
+            return None
+        query = user_input.lower()
+        with self._lock:
+            # (命名空间, 来源) -> 记录
+            sources = {(namespace, source): entry
+                       for namespace in (namespaces or [DEFAULT_NAMESPACE])
+                       for source, entry in self.sources.get(namespace, {}).items()}
+        if present is not None:
+            # 向量库切换或文档被替换后已不在索引中的来源，不再返回它的总结
+            sources = {key: entry for key, entry in sources.items() if present(*key)}
+        # 问题中点名了文件（文件名或去掉扩展名的文件名）时总结该文件，有多个匹配时取最长的
+        named = []
+        for key in sources:
+            name = os.path.basename(key[1]).lower()
+            for candidate in (name, os.path.splitext(name)[0]):
+                if len(candidate) >= 2 and candidate in query:
+                    named.append((len(candidate), key))
+                    break
+        if named:
+            key = max(named)[1]
+        elif DOCUMENT_REFERENCE.search(user_input) and sources:
+            # 没有点名时按最近上传的文档回答；它的总结还没生成时不退回到更早的文档
+            key = max(sources, key=lambda k: sources[k].get("upload_time") or 0)
+        else:
+            return None
+        entry = self.summaries.get(sources[key]["hash"])
+        return (key[1], entry) if entry is not None else None
+
+
+class SummaryPrecomputer:
+    """在后台为新入库的文档生成结构化总结，同一内容只生成一次"""
+
+    def __init__(self, summarize: Callable[[str], str], store: SummaryStore, max_workers: int = 1):
+        """
+        :param summarize: 生成总结的函数，输入文档全文，输出 **关键词**/**关键词解释**/**文章摘要**/**文章大纲** 格式的总结
+        :param store: 总结存储
+        :param max_workers: 同时生成总结的文档数
+        """
+        self.summarize = summarize
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary-precompute")
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.counters = {"submitted": 0, "reused": 0, "completed": 0, "failed": 0}
+
+    def submit(self, source: str, text: str, upload_time: Optional[float] = None,
+               namespace: Optional[str] = None) -> str:
+        """
+        提交文档，内容已有总结时直接复用，否则在后台生成
+        :param namespace: 文档写入的命名空间，为None时为默认向量存储
+        :return: "reused"、"scheduled" 或 "pending"（同一内容正在生成）
+        """
+        digest = content_hash(text)
+        self.counters["submitted"] += 1
+        if not self.store.update_source(source, digest, upload_time or time.time(), namespace):
+            self.counters["reused"] += 1
+            return "reused"
+        with self._lock:
+            if digest in self._pending:
+                return "pending"
+            self._pending.add(digest)
+        self._executor.submit(self._run, source, digest, text)
+        return "scheduled"
+
+    def _run(self, source: str, digest: str, text: str):
+        started = time.perf_counter()
+        try:
+            summary = self.summarize(text)
+            self.store.put(digest, summary, time.perf_counter() - started)
+            self.counters["completed"] += 1
+            print(f"文档总结已预计算: {source}，耗时 {time.perf_counter() - started:.1f} 秒")
+        except Exception as e:
+            self.counters["failed"] += 1
+            print(f"预计算文档总结失败 {source}: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+    def close(self):
+        """停止后台线程，尚未开始的总结任务取消，下次上传同一文档时重新提交"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**self.counters, "pending": len(self._pending), "stored": len(self.store.summaries)}
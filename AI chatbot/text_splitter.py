@@ -0,0 +1,115 @@
+import re
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from langchain.docstore.document import Document
+
+from context_builder import count_tokens
+
+# 句子边界：中文句末标点（。！？；…，可带右引号或右括号）、后接空白的英文句末标点，以及换行
+_SENTENCE_END = re.compile(
+    r"[\u3002\uff01\uff1f\uff1b\u2026]+[\u201d\u2019\u300d\u300f\uff09)]*"
+    r"|[.!?;]+[\"')\]]*(?=\s)"
+    r"|\n+"
+)
+# 超长句子的次级切分点：中英文逗号、顿号、冒号和空白
+_CLAUSE_END = re.compile(r"[\uff0c\u3001\uff1a,:]\s*|\s+")
+
+
+class SentenceTokenSplitter:
+    """
+    按句子边界、以token数为单位切分文本
+
+    对原文只做一次顺序扫描：按中英文句末标点和换行切出句子，依次放入滑动窗口，
+    窗口超出 chunk_tokens 时输出一个文本块，并保留末尾不超过 overlap_tokens 的句子作为重叠。
+    超长句子依次按逗号等次级切分点和字符数切开。每个文本块都是原文的一个切片，
+    元数据中的 start_index/end_index 即其在原文中的位置
+    """
+
+    def __init__(self,
+                 chunk_tokens: int = 500,
+                 overlap_tokens: int = 100,
+                 length_function: Callable[[str], int] = count_tokens):
+        """
+        :param chunk_tokens: 每个文本块的token上限
+        :param overlap_tokens: 相邻文本块之间重叠的token上限
+        :param length_function: token计数函数
+        """
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens 必须小于 chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.length_function = length_function
+
+    def _units(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """逐个产出 (起始偏移, 结束偏移, token数) 的句子单元，超长句子会被切开"""
+        start = 0
+        for match in _SENTENCE_END.finditer(text):
+            yield from self._sized(text, start, match.end())
+            start = match.end()
+        if start < len(text):
+            yield from self._sized(text, start, len(text))
+
+    def _sized(self, text: str, start: int, end: int, pattern=_CLAUSE_END) -> Iterator[Tuple[int, int, int]]:
+        piece = text[start:end]
+        if not piece.strip():
+            return
+        tokens = self.length_function(piece)
+        if tokens <= self.chunk_tokens:
+            yield start, end, tokens
+        elif pattern is not None:
+            # 先按次级切分点切开，仍然超长的部分再按字符数切分
+            clause_start = start
+            for match in pattern.finditer(piece):
+                clause_end = start + match.end()
+                yield from self._sized(text, clause_start, clause_end, None)
+                clause_start = clause_end
+            if clause_start < end:
+                yield from self._sized(text, clause_start, end, None)
+        else:
+            step = max(1, len(piece) * self.chunk_tokens // tokens)
+            for offset in range(start, end, step):
+                yield from self._sized(text, offset, min(offset + step, end), None)
+
+    @staticmethod
+    def _trim(text: str, start: int, end: int) -> Tuple[int, int]:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return start, end
+
+    def split_spans(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        切分文本
+        :param text: 原文
+        :return: 文本块 (起始偏移, 结束偏移) 的生成器，text[start:end] 即文本块内容
+        """
+        window = deque()
+        window_tokens = 0
+        for unit in self._units(text):
+            if window and window_tokens + unit[2] > self.chunk_tokens:
+                yield self._trim(text, window[0][0], window[-1][1])
+                # 保留末尾的句子作为重叠，同时为新句子腾出空间
+                while window and (window_tokens > self.overlap_tokens
+                                  or window_tokens + unit[2] > self.chunk_tokens):
+                    window_tokens -= window.popleft()[2]
+            window.append(unit)
+            window_tokens += unit[2]
+        if window:
+            yield self._trim(text, window[0][0], window[-1][1])
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        """切分文档，文本块继承原文档的元数据，并记录 start_index/end_index"""
+        chunks = []
+        for doc in documents:
+            text = doc.page_content
+            for start, end in self.split_spans(text):
+                chunks.append(Document(
+                    page_content=text[start:end],
+                    metadata={**doc.metadata, "start_index": start, "end_index": end}
+                ))
+        return chunks
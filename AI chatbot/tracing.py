@@ -0,0 +1,278 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+# 阶段耗时直方图的桶边界（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 当前对话轮次的追踪记录，检索、记忆更新等阶段通过它登记耗时
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("chat_turn_trace", default=None)
+
+
+class TurnTrace:
+    """一轮对话的追踪记录：各阶段耗时、token用量和缓存命中情况"""
+
+    def __init__(self, bot: str, session_id: Optional[str] = None, mode: str = "sync"):
+        self.turn_id = uuid.uuid4().hex[:16]
+        self.bot = bot
+        self.session_id = session_id
+        self.mode = mode
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans: List[Dict[str, Any]] = []
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.attrs: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, duration: float, **attrs):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "offset_ms": round((time.perf_counter() - self.start - duration) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                **attrs,
+            })
+
+    def add_tokens(self, prompt: int = 0, completion: int = 0):
+        with self._lock:
+            self.tokens["prompt"] += prompt
+            self.tokens["completion"] += completion
+
+    def callback(self) -> "TracingCallbackHandler":
+        """返回登记到本轮追踪的LangChain回调，传给LLM调用的 callbacks 参数"""
+        return TracingCallbackHandler(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "turn_id": self.turn_id,
+            "timestamp": self.started_at,
+            "bot": self.bot,
+            "session_id": self.session_id,
+            "mode": self.mode,
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "tokens": dict(self.tokens),
+            "spans": list(self.spans),
+            **self.attrs,
+        }
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain回调：记录每次LLM调用的总耗时、首个token延迟、生成耗时和token用量
+
+    首个token延迟只在流式调用中可以测得；调度器重试时每次尝试各记录一个span
+    """
+
+    def __init__(self, trace: TurnTrace):
+        self.trace = trace
+        self._runs: Dict[Any, Dict[str, Optional[float]]] = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._runs[run_id] = {"start": time.perf_counter(), "first_token": None}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._runs[run_id] = {"start": time.perf_counter(), "first_token": None}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and run["first_token"] is None and token:
+            run["first_token"] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        end = time.perf_counter()
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self.trace.add_tokens(prompt_tokens, completion_tokens)
+        attrs = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        if run["first_token"] is not None:
+            self.trace.add_span("llm_ttft", run["first_token"] - run["start"])
+            self.trace.add_span("llm_generation", end - run["first_token"])
+            attrs["ttft_ms"] = round((run["first_token"] - run["start"]) * 1000, 3)
+        self.trace.add_span("llm", end - run["start"], **attrs)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            self.trace.add_span("llm", time.perf_counter() - run["start"], error=type(error).__name__)
+
+
+def _token_usage(response) -> tuple:
+    """从LLM结果中读取token用量，兼容 llm_output 和消息上的 usage_metadata"""
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    completion_tokens = usage.get("completion_tokens") or 0
+    if not prompt_tokens and not completion_tokens:
+        for generations in response.generations:
+            for generation in generations:
+                metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += metadata.get("input_tokens", 0)
+                completion_tokens += metadata.get("output_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+class Histogram:
+    """Prometheus 格式的累积直方图，按标签值分组"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series: Dict[str, Dict[str, Any]] = {}
+
+    def observe(self, label_value: str, value: float):
+        series = self.series.setdefault(label_value, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series["counts"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series["count"]}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series["sum"]:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series["count"]}')
+        return lines
+
+
+class Tracer:
+    """
+    对话追踪：每轮对话结束后将追踪记录追加写入JSON-lines日志，
+    并汇总为 Prometheus 格式的阶段耗时直方图和计数器
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, enabled: bool = True, buckets=DEFAULT_BUCKETS):
+        """
+        :param jsonl_path: 追踪日志路径，为None时只汇总指标不写日志
+        :param enabled: 为False时不记录任何追踪
+        :param buckets: 直方图桶边界（秒）
+        """
+        self.jsonl_path = jsonl_path
+        self.enabled = enabled
+        self.stage_seconds = Histogram("chatbot_stage_duration_seconds", "各阶段耗时", "stage", buckets)
+        self.turn_seconds = Histogram("chatbot_turn_duration_seconds", "整轮对话耗时", "bot", buckets)
+        self.counters = {"turns": 0, "errors": 0, "cache_hits": 0, "cache_misses": 0,
+                         "prompt_tokens": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def turn(self, bot: str, session_id: Optional[str] = None, mode: str = "sync"):
+        """
+        追踪一轮对话，期间通过 span() 登记的阶段都归入这一轮
+        :param bot: 机器人类型，如 "rag"、"chat"
+        :param session_id: 会话ID
+        :param mode: "sync"、"stream"、"async" 等
+        """
+        if not self.enabled:
+            yield None
+            return
+        trace = TurnTrace(bot, session_id, mode)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # 生成器在其他上下文中结束时无法还原，直接清空
+                _current_trace.set(None)
+            trace.duration = time.perf_counter() - trace.start
+            self.finish(trace)
+
+    def finish(self, trace: TurnTrace):
+        """汇总一轮对话的指标并写入日志"""
+        record = trace.to_dict()
+        with self._lock:
+            self.counters["turns"] += 1
+            if "error" in record:
+                self.counters["errors"] += 1
+            if "cache_hit" in record:
+                self.counters["cache_hits" if record["cache_hit"] else "cache_misses"] += 1
+            self.counters["prompt_tokens"] += trace.tokens["prompt"]
+            self.counters["completion_tokens"] += trace.tokens["completion"]
+            self.turn_seconds.observe(trace.bot, trace.duration)
+            for span in trace.spans:
+                self.stage_seconds.observe(span["name"], span["duration_ms"] / 1000)
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                except OSError as e:
+                    print(f"写入追踪日志失败: {str(e)}")
+
+    def render_prometheus(self) -> str:
+        """导出 Prometheus 文本格式的指标"""
+        with self._lock:
+            lines = self.stage_seconds.render() + self.turn_seconds.render()
+            for name, value in self.counters.items():
+                metric = f"chatbot_{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def current_trace() -> Optional[TurnTrace]:
+    """当前对话轮次的追踪记录，不在追踪中时返回None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    登记一个阶段的耗时到当前对话轮次，不在追踪中时不做任何事
+    :param name: 阶段名称，如 "retrieval"、"prompt_build"、"memory_update"、"db_send"
+    :return: 属性字典，可在阶段内补充属性
+    """
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        if trace is not None:
+            trace.add_span(name, time.perf_counter() - start, **attrs)
+
+
+def llm_callbacks() -> List[BaseCallbackHandler]:
+    """当前对话轮次的LLM回调列表，传给 invoke/stream 的 config"""
+    trace = _current_trace.get()
+    return [trace.callback()] if trace is not None else []
+
+
+_default_tracer: Optional[Tracer] = None
+_default_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """获取进程内共享的追踪器，日志路径默认取环境变量 CHATBOT_TRACE_PATH"""
+    global _default_tracer
+    with _default_lock:
+        if _default_tracer is None:
+            _default_tracer = Tracer(jsonl_path=os.environ.get("CHATBOT_TRACE_PATH"))
+        return _default_tracer
+
+
+def configure_tracer(**kwargs) -> Tracer:
+    """用新的参数替换进程内共享的追踪器，参数同 Tracer"""
+    global _default_tracer
+    with _default_lock:
+        _default_tracer = Tracer(**kwargs)
+        return _default_tracer